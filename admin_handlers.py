@@ -1,23 +1,36 @@
 # admin_handlers.py
 
+import io
 import os
+import csv
 import logging
 import re
+import secrets
+from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes, ConversationHandler, MessageHandler, filters, CommandHandler, \
     CallbackQueryHandler
 
 # Абсолютные импорты
 from db_utils import (
-    find_ticket, activate_ticket, get_all_products,
-    get_product, update_product_price, get_all_promos,
-    add_promocode, toggle_promo_status, get_promo_products,
-    add_promo_product, remove_promo_product, find_promocode
+    set_admin, remove_admin, set_admin_duty,
+    find_ticket, activate_ticket, check_in_ticket, search_tickets, update_product_price,
+    add_promocode, bulk_add_promocodes, toggle_promo_status, save_promo_products, find_promocode, get_promos_page,
+    get_inventory, set_product_capacity, confirm_reservation, release_reservation,
+    resolve_pending_payment, get_pending_payments_page, count_pending_payments,
+    approve_pending_payments, reject_pending_payments, release_promo_redemptions, get_sales_rollup
 )
 # Импорт необходимых хелперов из user_handlers
-from user_handlers import generate_qr_code, send_ticket_success_message, issue_ticket_to_user
+from user_handlers import (
+    generate_qr_code, send_ticket_success_message, issue_ticket_to_user, maybe_sweep_pending_payments,
+    new_ticket_id, deliver_issued_tickets
+)
 # Импорт из utils.py
-from utils import cancel_global, read_qr_code_from_image, escape_html
+from utils import cancel_global, read_qr_code_from_image, escape_html, send_bulk_messages
+from catalog_cache import get_catalog_view, bump_catalog_version, invalidate_stock, update_cached_stock
+from promo_index import bump_promo_version, maybe_reconcile_promo_uses
+from admin_roles import ROLE_PERMISSIONS, get_admin_role, has_permission, get_admin_directory, bump_admin_version
 
 # Загрузка переменных окружения
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")
@@ -28,19 +41,58 @@ ASK_PASSWORD, CHECK_TICKET = range(2)
 ADMIN_MENU, SELECT_PRODUCT_TO_EDIT, ENTER_NEW_PRICE, PROMO_MENU, ENTER_PROMO_DATA, SELECT_PROMO_PRODUCTS = range(2, 8)
 ADMIN_ISSUE_TICKET_START, ADMIN_ISSUE_TICKET_PRODUCT, ADMIN_ISSUE_TICKET_NAME, ADMIN_ISSUE_TICKET_EMAIL, ADMIN_ISSUE_TICKET_CONFIRM = range(
     8, 13)
+SCAN_MODE = 13
+SELECT_PRODUCT_CAPACITY, ENTER_CAPACITY = range(14, 16)
+PENDING_PAYMENTS = 16
+ENTER_PROMO_SEARCH = 17
+SEARCH_TICKETS = 18
+
+# Сколько промокодов показывается на одной странице списка
+PROMO_PAGE_SIZE = int(os.getenv("PROMO_PAGE_SIZE", "10"))
+
+# Массовая генерация промокодов (/genpromo): максимум кодов за раз и длина случайной части
+PROMO_BULK_MAX = int(os.getenv("PROMO_BULK_MAX", "10000"))
+PROMO_BULK_CODE_LENGTH = 8
+# Без похожих символов (0/O, 1/I), чтобы коды было проще переписать вручную
+PROMO_BULK_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+
+# Сколько билетов показывается на одной странице поиска по имени/email
+TICKET_SEARCH_PAGE_SIZE = int(os.getenv("TICKET_SEARCH_PAGE_SIZE", "5"))
+# Короче триграммный индекс не используется — поиск ушел бы в полный скан
+TICKET_SEARCH_MIN_LENGTH = 3
+
+# Сколько последних дней показывается в статистике продаж
+STATS_DAYS = int(os.getenv("STATS_DAYS", "7"))
+
+# Сколько запросов оплаты показывается на одной странице
+PENDING_PAGE_SIZE = int(os.getenv("PENDING_PAGE_SIZE", "8"))
+
+
+# Пункты главного меню и права, которые для них нужны (см. ROLE_PERMISSIONS)
+ADMIN_MENU_ITEMS = [
+    ("🔍 Проверить/Активировать билет", "menu_check_ticket", 'scan'),
+    ("🔎 Найти билет по имени/email", "menu_search_tickets", 'scan'),
+    ("📷 Режим сканирования (вход)", "menu_scan_mode", 'scan'),
+    ("💳 Ожидающие оплаты", "menu_pending", 'payments'),
+    ("💲 Управление ценами", "menu_edit_price", 'manage'),
+    ("📦 Лимиты билетов", "menu_capacity", 'manage'),
+    ("📊 Статистика продаж", "menu_stats", 'manage'),
+    ("🎁 Управление промокодами", "menu_promo", 'manage'),
+    ("🎫 Ручная выдача билета", "menu_issue_ticket", 'payments'),
+]
+MENU_PERMISSIONS = {callback_data: permission for _, callback_data, permission in ADMIN_MENU_ITEMS}
 
 
 # --- ХЕЛПЕРЫ ДЛЯ МЕНЮ ---
 
-def get_admin_main_menu_keyboard():
-    """Возвращает основную клавиатуру меню администратора."""
+def get_admin_main_menu_keyboard(role: str | None = None):
+    """Возвращает основную клавиатуру меню администратора (только пункты, доступные роли)."""
+    permissions = ROLE_PERMISSIONS.get(role, set())
     keyboard = [
-        [InlineKeyboardButton("🔍 Проверить/Активировать билет", callback_data="menu_check_ticket")],
-        [InlineKeyboardButton("💲 Управление ценами", callback_data="menu_edit_price")],
-        [InlineKeyboardButton("🎁 Управление промокодами", callback_data="menu_promo")],
-        [InlineKeyboardButton("🎫 Ручная выдача билета", callback_data="menu_issue_ticket")],
-        [InlineKeyboardButton("🚪 Выход", callback_data="menu_exit")]
+        [InlineKeyboardButton(text, callback_data=callback_data)]
+        for text, callback_data, permission in ADMIN_MENU_ITEMS if permission in permissions
     ]
+    keyboard.append([InlineKeyboardButton("🚪 Выход", callback_data="menu_exit")])
     return InlineKeyboardMarkup(keyboard)
 
 
@@ -69,8 +121,8 @@ def get_ticket_check_keyboard(ticket_id: str | None = None, is_active: bool | No
 
 async def admin_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обрабатывает команду /admin, запрашивает пароль."""
-    if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("⛔ Доступ только для главного администратора.")
+    if get_admin_role(update.effective_user.id) is None:
+        await update.message.reply_text("⛔ Доступ только для сотрудников.")
         return ConversationHandler.END
 
     await update.message.reply_text("🔑 Введите пароль администратора:")
@@ -81,9 +133,10 @@ async def check_password(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     """Проверяет введенный пароль и отображает меню."""
     if update.message.text == ADMIN_PASSWORD:
         context.user_data['is_admin'] = True
+        context.user_data['admin_role'] = get_admin_role(update.effective_user.id)
         await update.message.reply_text(
             "✅ Пароль верный. Добро пожаловать в панель администратора!",
-            reply_markup=get_admin_main_menu_keyboard()
+            reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role'))
         )
         return ADMIN_MENU
     else:
@@ -100,13 +153,13 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         await update.callback_query.answer()
         await update.callback_query.edit_message_text(
             text,
-            reply_markup=get_admin_main_menu_keyboard(),
+            reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role')),
             parse_mode='Markdown'
         )
     elif update.message:
         await update.message.reply_text(
             text,
-            reply_markup=get_admin_main_menu_keyboard(),
+            reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role')),
             parse_mode='Markdown'
         )
 
@@ -120,6 +173,14 @@ async def admin_menu_navigate(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     callback_data = query.data
 
+    # Права проверяются по актуальному справочнику: снятый с роли сотрудник теряет доступ без перезахода
+    permission = MENU_PERMISSIONS.get(callback_data)
+    if permission and not has_permission(query.from_user.id, permission):
+        context.user_data['admin_role'] = get_admin_role(query.from_user.id)
+        await query.edit_message_text("⛔ Недостаточно прав для этого раздела.",
+                                      reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role')))
+        return ADMIN_MENU
+
     if callback_data == "menu_exit":
         await query.edit_message_text("🚪 Выход из режима администратора.")
         context.user_data.clear()
@@ -132,9 +193,49 @@ async def admin_menu_navigate(update: Update, context: ContextTypes.DEFAULT_TYPE
                                       )
         return CHECK_TICKET
 
+    elif callback_data == "menu_search_tickets":
+        await query.edit_message_text(
+            "🔎 **Поиск билета**\nВведите часть имени или email покупателя (от 3 символов):",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В главное меню", callback_data="menu_main")]]),
+            parse_mode='Markdown'
+        )
+        return SEARCH_TICKETS
+
+    elif callback_data == "menu_scan_mode":
+        await query.edit_message_text(
+            "📷 **Режим сканирования**\n"
+            "Отправляйте QR-коды или ID билетов подряд — каждый валидный билет активируется сразу.\n"
+            "Для выхода нажмите кнопку ниже или /cancel.",
+            reply_markup=InlineKeyboardMarkup(
+                [[InlineKeyboardButton("🛑 Завершить сканирование", callback_data="menu_main")]]),
+            parse_mode='Markdown'
+        )
+        return SCAN_MODE
+
+    elif callback_data == "menu_pending":
+        context.user_data['pp_cursors'] = [None]
+        context.user_data['pp_selected'] = set()
+        return await show_pending_payments(query, context)
+
+    elif callback_data == "menu_stats":
+        await query.edit_message_text(
+            format_sales_stats(get_sales_rollup()),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В главное меню", callback_data="menu_main")]]),
+            parse_mode='HTML'
+        )
+        return ADMIN_MENU
+
+    elif callback_data == "menu_main":
+        await query.edit_message_text("⚙️ **Панель администратора**\nВыберите действие:",
+                                      reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role')), parse_mode='Markdown')
+        return ADMIN_MENU
+
     elif callback_data == "menu_edit_price":
         return await start_edit_price(query, context)
 
+    elif callback_data == "menu_capacity":
+        return await start_edit_capacity(query, context)
+
     elif callback_data == "menu_promo":
         return await promo_menu_handler(query, context)
 
@@ -144,37 +245,78 @@ async def admin_menu_navigate(update: Update, context: ContextTypes.DEFAULT_TYPE
     return ADMIN_MENU
 
 
-# --- ПРОВЕРКА И АКТИВАЦИЯ БИЛЕТА (НОВЫЕ ФУНКЦИИ) ---
+# --- СТАТИСТИКА ПРОДАЖ ---
 
-async def process_ticket_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """
-    Обрабатывает ввод ID билета (из текста или QR) и ищет его.
-    """
-    ticket_id = None
+def format_sales_stats(rows: list | None, days: int = STATS_DAYS) -> str:
+    """Текст статистики (HTML) из строк sales_daily: итоги, разбивка по тарифам и последние дни."""
+    if rows is None:
+        return "❌ Ошибка при загрузке статистики."
+    if not rows:
+        return "📊 Продаж пока нет."
+
+    by_product = {}
+    by_day = {}
+    for r in rows:
+        for totals, key in ((by_product, r['product_name']), (by_day, r['day'])):
+            sold, revenue, activated = totals.get(key, (0, 0, 0))
+            totals[key] = (sold + r['tickets_sold'], revenue + r['revenue'], activated + r['activated'])
+
+    total_sold = sum(v[0] for v in by_product.values())
+    total_revenue = sum(v[1] for v in by_product.values())
+    total_activated = sum(v[2] for v in by_product.values())
 
-    if update.message.photo:
-        # 1. Обработка фото (QR-код)
+    lines = [
+        "📊 <b>Статистика продаж</b>",
+        f"Всего: {total_sold} бил. · {total_revenue} ₽ · вошли {total_activated}",
+        "",
+        "<b>По тарифам:</b>",
+    ]
+    for name, (sold, revenue, activated) in sorted(by_product.items()):
+        lines.append(f"{escape_html(name)}: {sold} бил. · {revenue} ₽ · вошли {activated}")
+
+    lines += ["", f"<b>Последние {days} дн.:</b>"]
+    for day in sorted(by_day, reverse=True)[:days]:
+        sold, revenue, activated = by_day[day]
+        lines.append(f"{day.strftime('%d.%m')}: {sold} бил. · {revenue} ₽ · вошли {activated}")
+
+    return "\n".join(lines)
+
+
+# --- ПРОВЕРКА И АКТИВАЦИЯ БИЛЕТА (НОВЫЕ ФУНКЦИИ) ---
+
+async def read_ticket_id(message) -> str | None:
+    """Извлекает ID билета из сообщения: из QR-кода на фото или из текста."""
+    if message.photo:
         # Получаем объект File (самое большое разрешение)
-        photo_file = await update.message.photo[-1].get_file()
+        photo_file = await message.photo[-1].get_file()
         image_bytes = await photo_file.download_as_bytes()
 
         # Используем функцию из utils
-        ticket_id = read_qr_code_from_image(image_bytes)
+        return read_qr_code_from_image(image_bytes)
+
+    if message.text:
+        return message.text.strip().upper() or None
 
-        if not ticket_id:
-            await update.message.reply_text("❌ QR-код не распознан. Попробуйте снова или введите ID вручную.")
-            return CHECK_TICKET  # Остаемся в состоянии
+    return None
 
-    elif update.message.text:
-        # 2. Обработка текста (ID билета)
-        ticket_id = update.message.text.strip().upper()
+
+async def process_ticket_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Обрабатывает ввод ID билета (из текста или QR) и ищет его.
+    """
+    ticket_id = await read_ticket_id(update.message)
+
+    if update.message.photo and not ticket_id:
+        await update.message.reply_text("❌ QR-код не распознан. Попробуйте снова или введите ID вручную.")
+        return CHECK_TICKET  # Остаемся в состоянии
 
     if not ticket_id:
         await update.message.reply_text("❌ Введите ID билета или отправьте QR-код.")
         return CHECK_TICKET
 
     # 3. Поиск билета в БД
-    ticket = find_ticket(ticket_id)
+    # Только просмотр статуса: можно с реплики (активация все равно идет в основную БД)
+    ticket = find_ticket(ticket_id, allow_stale=True)
 
     if not ticket:
         text = f"❌ **Билет ID: `{ticket_id}`** не найден."
@@ -220,15 +362,15 @@ async def handle_ticket_activation(update: Update, context: ContextTypes.DEFAULT
         # Отправка уведомления пользователю
         ticket_data = find_ticket(ticket_id)
         if ticket_data and ticket_data.get('buyer_chat_id'):
-            # send_ticket_success_message из user_handlers.py
-            await send_ticket_success_message(context.bot, ticket_data['buyer_chat_id'], ticket_id)
+            # send_ticket_success_message из user_handlers.py (повторная отправка берет file_id из кэша)
+            await send_ticket_success_message(context.bot, ticket_data)
 
             # Обновление сообщения для администратора
         await query.edit_message_text(
             f"✅ **Билет ID: `{ticket_id}`** успешно активирован!\n\n"
             "Покупателю отправлено подтверждение (если доступен chat_id).",
             parse_mode='Markdown',
-            reply_markup=get_admin_main_menu_keyboard()
+            reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role'))
         )
 
     else:
@@ -237,19 +379,160 @@ async def handle_ticket_activation(update: Update, context: ContextTypes.DEFAULT
             f"❌ Не удалось активировать **Билет ID: `{ticket_id}`**. "
             "Он либо уже активен, либо произошла ошибка БД.",
             parse_mode='Markdown',
-            reply_markup=get_admin_main_menu_keyboard()
+            reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role'))
         )
 
     context.user_data.pop('temp_ticket_id', None)
     return ADMIN_MENU
 
 
+async def process_scan_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Режим сканирования: каждый скан сразу активирует билет и получает один короткий ответ.
+    Диалог остается в SCAN_MODE, поэтому сканер может отправлять коды подряд.
+    """
+    ticket_id = await read_ticket_id(update.message)
+
+    if not ticket_id:
+        await update.message.reply_text("❓ QR-код не распознан")
+        return SCAN_MODE
+
+    result = check_in_ticket(ticket_id)
+
+    if result is None:
+        text = f"⚠️ {ticket_id} — ошибка БД, повторите скан"
+    elif result['status'] == 'activated':
+        text = f"✅ ВХОД · {result['product_name']} · {result['buyer_name']} · {ticket_id}"
+    elif result['status'] == 'already_used':
+        activated_at = result['activated_at']
+        entry_time = activated_at.strftime('%d.%m %H:%M:%S') if activated_at else 'время неизвестно'
+        text = f"⛔ УЖЕ ИСПОЛЬЗОВАН · вход {entry_time} · {result['product_name']} · {ticket_id}"
+    else:
+        text = f"❌ НЕ НАЙДЕН · {ticket_id}"
+
+    await update.message.reply_text(text)
+    return SCAN_MODE
+
+
+# --- ПОИСК БИЛЕТА ПО ИМЕНИ/EMAIL ---
+
+def build_ticket_search_page(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Собирает текст (HTML) и клавиатуру страницы результатов поиска.
+    Запрос и смещение страницы хранятся в user_data ('ts_query', 'ts_offset').
+    Возвращает (text, reply_markup) или None при ошибке БД.
+    """
+    search_text = context.user_data.get('ts_query', '')
+    offset = context.user_data.get('ts_offset', 0)
+
+    result = search_tickets(search_text, offset, TICKET_SEARCH_PAGE_SIZE)
+    if result is None:
+        return None
+    tickets, has_next = result
+
+    if not tickets:
+        text = f"🔎 По запросу «{escape_html(search_text)}» билеты не найдены.\nВведите другой запрос:"
+    else:
+        text = f"🔎 <b>Поиск:</b> «{escape_html(search_text)}»\n\n"
+
+    keyboard = []
+    for ticket in tickets:
+        status = "🟢 активен" if ticket['is_active'] else "🔴 не активирован"
+        text += (
+            f"<code>{ticket['ticket_id']}</code> · {escape_html(ticket['product_name'])} · {status}\n"
+            f"{escape_html(ticket['buyer_name'])} ({escape_html(ticket['buyer_email'])}), "
+            f"{ticket['purchase_date'].strftime('%d.%m.%Y')}\n\n"
+        )
+        if not ticket['is_active']:
+            keyboard.append([InlineKeyboardButton(
+                f"✅ Активировать {ticket['ticket_id']} · {ticket['buyer_name'][:20]}",
+                callback_data=f"ts_activate_{ticket['ticket_id']}"
+            )])
+
+    navigation = []
+    if offset > 0:
+        navigation.append(InlineKeyboardButton("◀️ Назад", callback_data="ts_prev"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Вперед ▶️", callback_data="ts_next"))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("🔙 В главное меню", callback_data="menu_main")])
+
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+async def process_ticket_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Принимает текст запроса и показывает первую страницу найденных билетов."""
+    search_text = update.message.text.strip()
+    if len(search_text) < TICKET_SEARCH_MIN_LENGTH:
+        await update.message.reply_text(
+            f"❌ Введите не меньше {TICKET_SEARCH_MIN_LENGTH} символов имени или email.")
+        return SEARCH_TICKETS
+
+    context.user_data['ts_query'] = search_text[:100]
+    context.user_data['ts_offset'] = 0
+
+    page = build_ticket_search_page(context)
+    if page is None:
+        await update.message.reply_text("❌ Ошибка БД при поиске. Попробуйте позже.")
+        return SEARCH_TICKETS
+
+    text, reply_markup = page
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='HTML')
+    return SEARCH_TICKETS
+
+
+async def handle_ticket_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Листает результаты поиска и активирует выбранный билет."""
+    query = update.callback_query
+    callback_data = query.data
+
+    if callback_data == 'menu_main':
+        context.user_data.pop('ts_query', None)
+        context.user_data.pop('ts_offset', None)
+        return await admin_menu(update, context)
+
+    if callback_data.startswith('ts_activate_'):
+        ticket_id = callback_data[len('ts_activate_'):]
+        if activate_ticket(ticket_id):
+            ticket_data = find_ticket(ticket_id)
+            if ticket_data and ticket_data.get('buyer_chat_id'):
+                await send_ticket_success_message(context.bot, ticket_data)
+            await query.answer(f"✅ Билет {ticket_id} активирован.", show_alert=True)
+        else:
+            await query.answer(f"❌ Билет {ticket_id} уже активен или произошла ошибка БД.", show_alert=True)
+    else:
+        await query.answer()
+        offset = context.user_data.get('ts_offset', 0)
+        if callback_data == 'ts_next':
+            context.user_data['ts_offset'] = offset + TICKET_SEARCH_PAGE_SIZE
+        elif callback_data == 'ts_prev':
+            context.user_data['ts_offset'] = max(0, offset - TICKET_SEARCH_PAGE_SIZE)
+
+    if not context.user_data.get('ts_query'):
+        return SEARCH_TICKETS
+
+    page = build_ticket_search_page(context)
+    if page is None:
+        await query.edit_message_text("❌ Ошибка БД при поиске. Попробуйте позже.",
+                                      reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role')))
+        return ADMIN_MENU
+
+    text, reply_markup = page
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='HTML')
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    return SEARCH_TICKETS
+
+
 # --- УПРАВЛЕНИЕ ЦЕНАМИ ---
 
 async def start_edit_price(query: Update.callback_query, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Отображает меню выбора продукта для редактирования цены."""
-    products = get_all_products()
-    if not products:
+    catalog = get_catalog_view()
+    if not catalog:
         await query.edit_message_text("❌ Нет доступных продуктов для редактирования.",
                                       reply_markup=InlineKeyboardMarkup(
                                           [[InlineKeyboardButton("🔙 В главное меню", callback_data="menu_main")]])
@@ -257,13 +540,8 @@ async def start_edit_price(query: Update.callback_query, context: ContextTypes.D
         return ADMIN_MENU
 
     text = "💲 **Редактирование цен**\nВыберите продукт, цену которого хотите изменить:"
-    keyboard = []
-    for p in products:
-        keyboard.append([InlineKeyboardButton(f"{p['name']} ({p['price']} ₽)", callback_data=f"editprice_{p['id']}")])
-
-    keyboard.append([InlineKeyboardButton("🔙 В главное меню", callback_data="menu_main")])
 
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await query.edit_message_text(text, reply_markup=catalog['edit_price_markup'], parse_mode='Markdown')
     return SELECT_PRODUCT_TO_EDIT
 
 
@@ -276,13 +554,15 @@ async def select_product_to_edit(update: Update, context: ContextTypes.DEFAULT_T
         return await admin_menu(update, context)
 
     product_id = int(query.data.split('_')[1])
-    product = get_product(product_id)
+    catalog = get_catalog_view()
+    product = catalog['products_by_id'].get(product_id) if catalog else None
 
     if not product:
-        await query.edit_message_text("❌ Продукт не найден.", reply_markup=get_admin_main_menu_keyboard())
+        await query.edit_message_text("❌ Продукт не найден.", reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role')))
         return ADMIN_MENU
 
     context.user_data['edit_product_id'] = product_id
+    context.user_data['edit_product_name'] = product['name']
 
     await query.edit_message_text(
         f"✍️ Вы выбрали **{product['name']}** (текущая цена: **{product['price']}** ₽).\n"
@@ -303,17 +583,95 @@ async def process_new_price(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ENTER_NEW_PRICE
 
     product_id = context.user_data.get('edit_product_id')
-    if update_product_price(product_id, new_price):
+    product_name = context.user_data.get('edit_product_name')
+    if update_product_price(product_name, new_price):
+        # Новая цена должна сразу попасть в текст /buy и клавиатуры админки
+        bump_catalog_version()
         await update.message.reply_text(
-            f"✅ Цена для продукта ID {product_id} успешно обновлена до **{new_price}** ₽.",
-            reply_markup=get_admin_main_menu_keyboard(),
+            f"✅ Цена для продукта {product_name} (ID {product_id}) успешно обновлена до **{new_price}** ₽.",
+            reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role')),
             parse_mode='Markdown'
         )
     else:
         await update.message.reply_text("❌ Ошибка при обновлении цены в БД.",
-                                        reply_markup=get_admin_main_menu_keyboard())
+                                        reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role')))
 
     context.user_data.pop('edit_product_id', None)
+    context.user_data.pop('edit_product_name', None)
+    return ADMIN_MENU
+
+
+# --- УПРАВЛЕНИЕ ЛИМИТАМИ БИЛЕТОВ ---
+
+async def start_edit_capacity(query: Update.callback_query, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Показывает тарифы с текущими лимитами и остатками."""
+    catalog = get_catalog_view()
+    inventory = get_inventory() or {}
+    if not catalog:
+        await query.edit_message_text("❌ Нет доступных продуктов.", reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role')))
+        return ADMIN_MENU
+
+    text = "📦 **Лимиты билетов**\nВыберите тариф, чтобы изменить лимит:"
+    keyboard = []
+    for p in catalog['products']:
+        row = inventory.get(p['id'])
+        limit_text = f"{row['taken']}/{row['capacity']}" if row else "без лимита"
+        keyboard.append([InlineKeyboardButton(f"{p['name']} ({limit_text})", callback_data=f"capacity_{p['id']}")])
+
+    keyboard.append([InlineKeyboardButton("🔙 В главное меню", callback_data="menu_main")])
+
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    return SELECT_PRODUCT_CAPACITY
+
+
+async def select_product_capacity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Сохраняет ID тарифа и запрашивает новый лимит."""
+    query = update.callback_query
+    await query.answer()
+
+    if query.data == "menu_main":
+        return await admin_menu(update, context)
+
+    product_id = int(query.data.split('_')[1])
+    catalog = get_catalog_view()
+    product = catalog['products_by_id'].get(product_id) if catalog else None
+
+    if not product:
+        await query.edit_message_text("❌ Продукт не найден.", reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role')))
+        return ADMIN_MENU
+
+    context.user_data['capacity_product_id'] = product_id
+
+    await query.edit_message_text(
+        f"✍️ Введите лимит билетов для **{product['name']}** (число, `0` — без лимита):",
+        parse_mode='Markdown'
+    )
+    return ENTER_CAPACITY
+
+
+async def process_new_capacity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Сохраняет новый лимит тарифа."""
+    try:
+        capacity = int(update.message.text.strip())
+        if capacity < 0:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("❌ Введите целое неотрицательное число.")
+        return ENTER_CAPACITY
+
+    product_id = context.user_data.pop('capacity_product_id', None)
+    if set_product_capacity(product_id, capacity or None):
+        invalidate_stock()
+        limit_text = f"**{capacity}**" if capacity else "без лимита"
+        await update.message.reply_text(
+            f"✅ Лимит для продукта ID {product_id}: {limit_text}.",
+            reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role')),
+            parse_mode='Markdown'
+        )
+    else:
+        await update.message.reply_text("❌ Ошибка при обновлении лимита в БД.",
+                                        reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role')))
+
     return ADMIN_MENU
 
 
@@ -338,8 +696,9 @@ async def start_add_promocode(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     text = (
         "✍️ **Введите данные для нового промокода в формате:**\n\n"
-        "`КОД ПРОЦЕНТ`\n\n"
-        "Например: `SALE15 15` (создаст промокод SALE15 со скидкой 15%)."
+        "`КОД ПРОЦЕНТ [ЛИМИТ] [ДД.ММ.ГГГГ]`\n\n"
+        "Например: `SALE15 15` (создаст промокод SALE15 со скидкой 15%).\n"
+        "`FLASH 30 100 31.12.2025` — скидка 30% для первых 100 покупателей, действует по 31.12.2025 включительно."
     )
 
     keyboard = [[InlineKeyboardButton("🔙 Назад в меню промокодов", callback_data="menu_promo")]]
@@ -357,16 +716,18 @@ async def process_promo_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """Обрабатывает введенные данные для создания промокода."""
     text = update.message.text
 
-    match = re.match(r'^\s*([A-Z0-9]+)\s+(\d{1,2})\s*$', text.strip(), re.IGNORECASE)
+    match = re.match(r'^\s*([A-Z0-9]+)\s+(\d{1,2})(?:\s+(\d+))?(?:\s+(\d{2}\.\d{2}\.\d{4}))?\s*$',
+                     text.strip(), re.IGNORECASE)
 
     if not match:
         await update.message.reply_text(
-            "❌ Неверный формат. Пожалуйста, введите в формате `КОД ПРОЦЕНТ` (например, `SALE15 15`).",
+            "❌ Неверный формат. Пожалуйста, введите в формате `КОД ПРОЦЕНТ [ЛИМИТ] [ДД.ММ.ГГГГ]` "
+            "(например, `SALE15 15` или `FLASH 30 100 31.12.2025`).",
             parse_mode='Markdown'
         )
         return ENTER_PROMO_DATA
 
-    code, discount_percent_str = match.groups()
+    code, discount_percent_str, max_uses_str, expires_str = match.groups()
     discount_percent = int(discount_percent_str)
     code_upper = code.upper()
 
@@ -374,36 +735,58 @@ async def process_promo_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("❌ Процент скидки должен быть от 1 до 99.")
         return ENTER_PROMO_DATA
 
+    max_uses = int(max_uses_str) if max_uses_str else None
+    if max_uses is not None and max_uses < 1:
+        await update.message.reply_text("❌ Лимит использований должен быть больше нуля.")
+        return ENTER_PROMO_DATA
+
+    expires_at = None
+    if expires_str:
+        try:
+            # Промокод действует до конца указанного дня
+            expires_at = datetime.strptime(expires_str, '%d.%m.%Y') + timedelta(days=1)
+        except ValueError:
+            await update.message.reply_text("❌ Неверная дата. Используйте формат ДД.ММ.ГГГГ.")
+            return ENTER_PROMO_DATA
+        if expires_at <= datetime.now():
+            await update.message.reply_text("❌ Дата окончания уже прошла.")
+            return ENTER_PROMO_DATA
+
     existing_promo = find_promocode(code_upper)
     if existing_promo:
         await update.message.reply_text(f"❌ Промокод `{code_upper}` уже существует!", parse_mode='Markdown')
         return ENTER_PROMO_DATA
 
     # Добавление в базу данных
-    promo_id = add_promocode(code_upper, discount_percent)
+    promo_id = add_promocode(code_upper, discount_percent, max_uses, expires_at)
 
     if promo_id:
+        bump_promo_version()
         context.user_data['temp_promo_id'] = promo_id
         context.user_data['temp_promo_code'] = code_upper
-        context.user_data['temp_promo_products'] = []
+        context.user_data['temp_promo_discount'] = discount_percent
+        # Черновик привязок: выбор хранится здесь и сохраняется в БД одним изменением по кнопке "Готово".
+        # temp_promo_saved — привязки, уже записанные в БД (у нового промокода их нет)
+        context.user_data['temp_promo_products'] = set()
+        context.user_data['temp_promo_saved'] = set()
 
         # Переход к выбору продуктов
-        # В этом случае вызываем start функцию, передавая update.message
-        return await select_promo_products_start(update.message, context)
+        return await select_promo_products_start(update, context)
     else:
         await update.message.reply_text("❌ Произошла ошибка при добавлении промокода в БД.")
         return ENTER_PROMO_DATA
 
 
 async def select_promo_products_start(update: Update | None, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Начинает процесс выбора продуктов, к которым применяется промокод."""
-    products = get_all_products()
+    """
+    Показывает выбор продуктов, к которым применяется промокод.
+    Меню перерисовывается из черновика в user_data и кэша каталога — без запросов к БД.
+    """
+    catalog = get_catalog_view()
+    products = catalog['products'] if catalog else None
     promo_id = context.user_data.get('temp_promo_id')
     promo_code = context.user_data.get('temp_promo_code')
-
-    # Получаем процент скидки для отображения
-    promo_data = find_promocode(promo_code)
-    discount_percent = promo_data['discount_percent'] if promo_data else '??'
+    discount_percent = context.user_data.get('temp_promo_discount', '??')
 
     if not products or not promo_id:
         if update and update.message:
@@ -413,11 +796,11 @@ async def select_promo_products_start(update: Update | None, context: ContextTyp
     text = (
         f"✅ Промокод `{promo_code}` ({discount_percent}%) успешно создан. Выберите продукты, "
         "к которым он будет применяться (нажмите, чтобы добавить/удалить). "
+        "Без выбранных продуктов промокод действует на все тарифы. "
         "Нажмите **Готово**, чтобы завершить."
     )
 
-    current_products = get_promo_products(promo_id)
-    selected_ids = {p['id'] for p in current_products}
+    selected_ids = context.user_data.setdefault('temp_promo_products', set())
 
     keyboard = []
     for p in products:
@@ -439,16 +822,26 @@ async def select_promo_products_start(update: Update | None, context: ContextTyp
 
 
 async def handle_promo_product_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Добавляет или удаляет продукт из списка промокодов."""
+    """Добавляет или удаляет продукт в черновике; по "Готово" сохраняет изменения одной транзакцией."""
     query = update.callback_query
-    await query.answer()
 
     promo_id = context.user_data.get('temp_promo_id')
     callback_data = query.data
 
     if callback_data == "finish_promo_products":
+        selected_ids = context.user_data.get('temp_promo_products', set())
+        saved_ids = context.user_data.get('temp_promo_saved', set())
+
+        if not save_promo_products(promo_id, selected_ids - saved_ids, saved_ids - selected_ids):
+            await query.answer("❌ Ошибка при сохранении привязок. Попробуйте еще раз.", show_alert=True)
+            return SELECT_PROMO_PRODUCTS
+        await query.answer()
+        if selected_ids != saved_ids:
+            bump_promo_version()
+
         promo_code = context.user_data.pop('temp_promo_code', 'промокод')
-        context.user_data.pop('temp_promo_id', None)
+        for key in ('temp_promo_id', 'temp_promo_discount', 'temp_promo_products', 'temp_promo_saved'):
+            context.user_data.pop(key, None)
 
         await query.edit_message_text(
             f"🎉 Привязка продуктов для промокода `{promo_code}` завершена!",
@@ -457,16 +850,13 @@ async def handle_promo_product_selection(update: Update, context: ContextTypes.D
         )
         return PROMO_MENU
 
+    await query.answer()
+
     if callback_data.startswith("promoprod_"):
         product_id = int(callback_data.split('_')[1])
 
-        current_products = get_promo_products(promo_id)
-        is_attached = any(p['id'] == product_id for p in current_products)
-
-        if is_attached:
-            remove_promo_product(promo_id, product_id)
-        else:
-            add_promo_product(promo_id, product_id)
+        selected_ids = context.user_data.setdefault('temp_promo_products', set())
+        selected_ids ^= {product_id}
 
         # Обновляем меню с новым статусом
         return await select_promo_products_start(update, context)
@@ -474,14 +864,65 @@ async def handle_promo_product_selection(update: Update, context: ContextTypes.D
     return SELECT_PROMO_PRODUCTS
 
 
+def build_promo_page(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Собирает текст и клавиатуру текущей страницы промокодов.
+    Страницы листаются по коду (keyset): стек ключей и префикс поиска хранятся в user_data.
+    Возвращает (text, reply_markup) или None при ошибке БД.
+    """
+    prefix = context.user_data.setdefault('promo_prefix', '')
+    cursors = context.user_data.setdefault('promo_cursors', [None])
+
+    page = get_promos_page(prefix, cursors[-1], PROMO_PAGE_SIZE)
+    if page is None:
+        return None
+    promos, has_next = page
+    context.user_data['promo_next_after'] = promos[-1]['code'] if promos else None
+
+    text = "📋 **Список промокодов**\n"
+    if prefix:
+        text += f"Поиск: `{prefix}*`\n"
+    text += "Нажмите, чтобы изменить статус:\n" if promos else "Промокоды не найдены.\n"
+
+    keyboard = []
+    for promo in promos:
+        status = "🟢 Активен" if promo['is_active'] else "🔴 Неактивен"
+        action = "deactivate" if promo['is_active'] else "activate"
+        uses = f"{promo['uses']}/{promo['max_uses']}" if promo['max_uses'] is not None else f"{promo['uses']}"
+        if promo['expires_at'] is not None:
+            # expires_at — начало следующего дня; показываем последний день действия
+            uses += f", до {(promo['expires_at'] - timedelta(days=1)).strftime('%d.%m.%Y')}"
+
+        keyboard.append([
+            InlineKeyboardButton(
+                f"{promo['code']} ({promo['discount_percent']}%) · {uses} — {status}",
+                callback_data=f"{action}_promo_{promo['id']}"
+            )
+        ])
+
+    navigation = []
+    if len(cursors) > 1:
+        navigation.append(InlineKeyboardButton("◀️ Назад", callback_data="promo_page_prev"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Вперед ▶️", callback_data="promo_page_next"))
+    if navigation:
+        keyboard.append(navigation)
+
+    search_row = [InlineKeyboardButton("🔎 Поиск по коду", callback_data="promo_search")]
+    if prefix:
+        search_row.append(InlineKeyboardButton("✖️ Сбросить поиск", callback_data="promo_search_clear"))
+    keyboard.append(search_row)
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="menu_promo")])
+
+    return text, InlineKeyboardMarkup(keyboard)
+
+
 async def manage_promo_actions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обрабатывает список промокодов и их активацию/деактивацию."""
+    """Обрабатывает постраничный список промокодов, поиск по префиксу и активацию/деактивацию."""
     query = update.callback_query
-    await query.answer()
-
     callback_data = query.data
 
-    # 1. Активация/деактивация
+    # 1. Активация/деактивация (ответ на нажатие — всплывающим уведомлением)
     if callback_data.startswith("activate_promo_") or callback_data.startswith("deactivate_promo_"):
         parts = callback_data.split('_')
         action = parts[0]
@@ -490,64 +931,254 @@ async def manage_promo_actions(update: Update, context: ContextTypes.DEFAULT_TYP
         is_active = (action == 'activate')
 
         if toggle_promo_status(promo_id, is_active):
+            bump_promo_version()
             await query.answer(f"Промокод {'активирован' if is_active else 'деактивирован'}.", show_alert=True)
-            # Переходим к отображению обновленного списка
-            callback_data = 'promo_list'
         else:
             await query.answer("❌ Ошибка при изменении статуса.", show_alert=True)
             return PROMO_MENU
+    else:
+        await query.answer()
 
-    # 2. Отображение списка
-    if callback_data == 'promo_list':
-        promos = get_all_promos()
+    # 2. Навигация
+    if callback_data == 'menu_promo':
+        return await promo_menu_handler(query, context)
 
-        if not promos:
-            text = "📋 **Список промокодов**\nПромокоды не найдены."
-            await query.edit_message_text(text, reply_markup=get_promo_menu_keyboard(), parse_mode='Markdown')
-            return PROMO_MENU
+    if callback_data == 'promo_search':
+        await query.edit_message_text(
+            "🔎 Введите начало кода промокода (например, `FLASH`):",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К списку", callback_data="promo_list")]]),
+            parse_mode='Markdown'
+        )
+        return ENTER_PROMO_SEARCH
+
+    if callback_data == 'promo_list':
+        # Счетчики слотов сводятся не чаще раза в PROMO_RECONCILE_INTERVAL: полная сверка затрагивает все коды
+        maybe_reconcile_promo_uses()
+        context.user_data['promo_cursors'] = [None]
+    elif callback_data == 'promo_search_clear':
+        context.user_data['promo_prefix'] = ''
+        context.user_data['promo_cursors'] = [None]
+    elif callback_data == 'promo_page_next' and context.user_data.get('promo_next_after'):
+        context.user_data.setdefault('promo_cursors', [None]).append(context.user_data['promo_next_after'])
+    elif callback_data == 'promo_page_prev' and len(context.user_data.get('promo_cursors', [])) > 1:
+        context.user_data['promo_cursors'].pop()
+
+    # 3. Отображение текущей страницы
+    page = build_promo_page(context)
+    if page is None:
+        await query.edit_message_text("❌ Ошибка при загрузке промокодов.", reply_markup=get_promo_menu_keyboard())
+        return PROMO_MENU
 
-        text = "📋 **Список промокодов**\nНажмите, чтобы изменить статус:\n"
-        keyboard = []
+    text, reply_markup = page
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+    return PROMO_MENU
 
-        for promo in promos:
-            status = "🟢 Активен" if promo['is_active'] else "🔴 Неактивен"
-            action = "deactivate" if promo['is_active'] else "activate"
 
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"{promo['code']} ({promo['discount_percent']}%) — {status}",
-                    callback_data=f"{action}_promo_{promo['id']}"
-                )
-            ])
+async def process_promo_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Сохраняет префикс поиска и показывает первую страницу найденных промокодов."""
+    prefix = update.message.text.strip().upper()
+    if not re.fullmatch(r'[A-Z0-9]{1,50}', prefix):
+        await update.message.reply_text("❌ Код может содержать только латинские буквы и цифры. Попробуйте снова:")
+        return ENTER_PROMO_SEARCH
 
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="menu_promo")])
+    context.user_data['promo_prefix'] = prefix
+    context.user_data['promo_cursors'] = [None]
 
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    page = build_promo_page(context)
+    if page is None:
+        await update.message.reply_text("❌ Ошибка при загрузке промокодов.", reply_markup=get_promo_menu_keyboard())
         return PROMO_MENU
 
-    return PROMO_MENU  # По умолчанию
+    text, reply_markup = page
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+    return PROMO_MENU
+
+
+# --- МАССОВАЯ ГЕНЕРАЦИЯ ПРОМОКОДОВ ---
+
+def generate_promo_codes(count: int, prefix: str = '') -> set:
+    """Генерирует count различных случайных кодов вида ПРЕФИКС + 8 символов."""
+    codes = set()
+    while len(codes) < count:
+        codes.add(prefix + ''.join(secrets.choice(PROMO_BULK_ALPHABET) for _ in range(PROMO_BULK_CODE_LENGTH)))
+    return codes
+
+
+def build_promo_csv(codes: list, discount_percent: int, product_names: list) -> bytes:
+    """CSV для партнера: код, скидка, лимит использований и тарифы (UTF-8 с BOM для Excel)."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['code', 'discount_percent', 'max_uses', 'products'])
+    products = ', '.join(product_names) or 'все тарифы'
+    for code in codes:
+        writer.writerow([code, discount_percent, 1, products])
+    return buffer.getvalue().encode('utf-8-sig')
+
+
+async def genpromo_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Обрабатывает команду /genpromo КОЛИЧЕСТВО ПРОЦЕНТ [ПРЕФИКС] [ID_ТАРИФОВ]:
+    создает одноразовые промокоды одной загрузкой в БД и присылает их CSV-файлом.
+    """
+    if not has_permission(update.effective_user.id, 'manage'):
+        return
+
+    usage = (
+        "Формат: `/genpromo КОЛИЧЕСТВО ПРОЦЕНТ [ПРЕФИКС] [ID_ТАРИФОВ]`\n"
+        "Например: `/genpromo 500 20 PARTNER 1,2` — 500 одноразовых кодов PARTNER… со скидкой 20% "
+        "на тарифы 1 и 2. Без тарифов коды действуют на все тарифы."
+    )
+    args = context.args or []
+    if len(args) < 2 or not args[0].isdigit() or not args[1].isdigit():
+        await update.message.reply_text(usage, parse_mode='Markdown')
+        return
+
+    count, discount_percent = int(args[0]), int(args[1])
+    prefix = ''
+    product_ids = []
+    for arg in args[2:]:
+        if re.fullmatch(r'\d+(,\d+)*', arg):
+            product_ids = sorted({int(product_id) for product_id in arg.split(',')})
+        elif re.fullmatch(r'[A-Za-z][A-Za-z0-9]{0,19}', arg):
+            prefix = arg.upper()
+        else:
+            await update.message.reply_text(usage, parse_mode='Markdown')
+            return
+
+    if not 1 <= count <= PROMO_BULK_MAX:
+        await update.message.reply_text(f"❌ Количество должно быть от 1 до {PROMO_BULK_MAX}.")
+        return
+    if not 1 <= discount_percent <= 99:
+        await update.message.reply_text("❌ Процент скидки должен быть от 1 до 99.")
+        return
+
+    catalog = get_catalog_view()
+    products_by_id = catalog['products_by_id'] if catalog else {}
+    unknown = [product_id for product_id in product_ids if product_id not in products_by_id]
+    if unknown:
+        await update.message.reply_text(f"❌ Тарифы не найдены: {', '.join(map(str, unknown))}.")
+        return
+
+    # Совпадения с существующими кодами пропускаются в БД; недостающие догенерируются (обычно хватает одного прохода)
+    created = []
+    db_failed = False
+    for _ in range(3):
+        inserted = bulk_add_promocodes(sorted(generate_promo_codes(count - len(created), prefix)),
+                                       discount_percent, 1, product_ids)
+        if inserted is None:
+            db_failed = True
+            break
+        created.extend(inserted)
+        if len(created) >= count:
+            break
+
+    if not created:
+        await update.message.reply_text("❌ Ошибка при сохранении промокодов в БД.")
+        return
+
+    bump_promo_version()
+    product_names = [products_by_id[product_id]['name'] for product_id in product_ids]
+    logging.info(f"Сгенерировано промокодов: {len(created)} (скидка {discount_percent}%, тарифы {product_ids or 'все'}).")
+
+    caption = f"✅ Создано {len(created)} одноразовых промокодов со скидкой {discount_percent}%."
+    if len(created) < count:
+        reason = ("часть не сохранилась из-за ошибки БД" if db_failed
+                  else "после трех попыток остались совпадения с существующими кодами — "
+                       "попробуйте другой префикс")
+        caption += f"\n⚠️ Запрошено {count}: {reason}."
+    await update.message.reply_document(
+        document=build_promo_csv(sorted(created), discount_percent, product_names),
+        filename=f"promo_{prefix or 'codes'}_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
+        caption=caption
+    )
+
+
+# --- СОТРУДНИКИ И РОЛИ ---
+
+ROLE_TITLES = {'scanner': "сканер", 'cashier': "кассир", 'owner': "владелец"}
+
+
+async def staff_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Обрабатывает команду /staff (только владельцы):
+    без аргументов — список сотрудников; `add ID РОЛЬ [ИМЯ]` — добавить или сменить роль; `remove ID` — удалить.
+    """
+    if not has_permission(update.effective_user.id, 'manage'):
+        return
+
+    args = context.args or []
+    usage = (
+        "Формат: `/staff` — список, `/staff add ID РОЛЬ [ИМЯ]`, `/staff remove ID`.\n"
+        "Роли: `scanner` — вход, `cashier` — вход и оплаты, `owner` — все разделы."
+    )
+
+    if not args:
+        admins = get_admin_directory()
+        lines = [f"👑 <code>{ADMIN_ID}</code> — владелец (ADMIN_ID)"] if ADMIN_ID else []
+        for admin in admins.values():
+            duty = "🟢 на смене" if admin['on_duty'] else "⚪ не на смене"
+            lines.append(f"<code>{admin['user_id']}</code> {escape_html(admin['name'] or '')} — "
+                         f"{ROLE_TITLES[admin['role']]}, {duty}")
+        await update.message.reply_html("👥 <b>Сотрудники</b>\n\n" + "\n".join(lines))
+        return
+
+    if args[0] == 'add' and len(args) >= 3 and args[1].isdigit() and args[2] in ROLE_PERMISSIONS:
+        user_id, role = int(args[1]), args[2]
+        name = ' '.join(args[3:])[:100] or None
+        if not set_admin(user_id, role, name):
+            await update.message.reply_text("❌ Ошибка при сохранении сотрудника в БД.")
+            return
+        bump_admin_version()
+        await update.message.reply_text(f"✅ Сотрудник {user_id}: роль «{ROLE_TITLES[role]}».")
+        return
+
+    if args[0] == 'remove' and len(args) == 2 and args[1].isdigit():
+        if remove_admin(int(args[1])):
+            bump_admin_version()
+            await update.message.reply_text(f"✅ Сотрудник {args[1]} удален.")
+        else:
+            await update.message.reply_text("❌ Сотрудник не найден или ошибка БД.")
+        return
+
+    await update.message.reply_text(usage, parse_mode='Markdown')
+
+
+async def duty_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обрабатывает команду /duty: кассир встает на смену или уходит с нее (уведомления об оплатах)."""
+    user_id = update.effective_user.id
+    if not has_permission(user_id, 'payments'):
+        return
+
+    admin = get_admin_directory().get(user_id)
+    if admin is None:
+        await update.message.reply_text(
+            "ℹ️ Главный администратор получает уведомления, только когда на смене нет ни одного кассира.")
+        return
+
+    on_duty = not admin['on_duty']
+    if not set_admin_duty(user_id, on_duty):
+        await update.message.reply_text("❌ Ошибка БД. Попробуйте позже.")
+        return
+    bump_admin_version()
+    await update.message.reply_text(
+        "🟢 Вы на смене: уведомления об оплатах будут приходить вам по очереди с другими кассирами."
+        if on_duty else "⚪ Вы ушли со смены: уведомления об оплатах больше не приходят.")
 
 
 # --- РУЧНАЯ ВЫДАЧА БИЛЕТА ---
 
 async def start_issue_ticket(query: Update.callback_query, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начинает процесс ручной выдачи билета."""
-    products = get_all_products()
-    if not products:
+    catalog = get_catalog_view()
+    if not catalog:
         await query.edit_message_text("❌ Нет доступных продуктов.",
-                                      reply_markup=get_admin_main_menu_keyboard()
+                                      reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role'))
                                       )
         return ADMIN_MENU
 
     text = "🎫 **Ручная выдача**\nВыберите продукт для выдачи:"
-    keyboard = []
-    for p in products:
-        keyboard.append(
-            [InlineKeyboardButton(f"{p['name']} ({p['price']} ₽)", callback_data=f"issue_product_{p['id']}")])
-
-    keyboard.append([InlineKeyboardButton("🔙 В главное меню", callback_data="menu_main")])
 
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await query.edit_message_text(text, reply_markup=catalog['issue_markup'], parse_mode='Markdown')
     return ADMIN_ISSUE_TICKET_PRODUCT
 
 
@@ -585,7 +1216,11 @@ async def admin_issue_ticket_email(update: Update, context: ContextTypes.DEFAULT
     context.user_data['issue_email'] = email
 
     # Подтверждение
-    product = get_product(context.user_data['issue_product_id'])
+    catalog = get_catalog_view()
+    product = catalog['products_by_id'].get(context.user_data['issue_product_id']) if catalog else None
+    if not product:
+        await update.message.reply_text("❌ Продукт не найден.", reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role')))
+        return ADMIN_MENU
 
     text = (
         "❓ **Подтвердите выдачу билета (БЕСПЛАТНО):**\n\n"
@@ -604,30 +1239,45 @@ async def admin_issue_ticket_email(update: Update, context: ContextTypes.DEFAULT
 
 
 async def handle_issue_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обрабатывает подтверждение и выдает билет."""
+    """Обрабатывает подтверждение и выдает билет (копия с QR-кодом уходит выдавшему сотруднику)."""
     query = update.callback_query
     await query.answer()
 
-    if query.data == "issue_confirm":
-        # Вызов функции, которая создает билет и отправляет его
-        await issue_ticket_to_user(
-            chat_id=ADMIN_ID,  # Отправляем себе
-            name=context.user_data['issue_name'],
-            email=context.user_data['issue_email'],
-            product_id=context.user_data['issue_product_id'],
-            final_price=0,  # Бесплатно
-            context=context
-        )
+    if not has_permission(query.from_user.id, 'payments'):
+        await query.edit_message_text("⛔ Недостаточно прав для выдачи билетов.")
+        return ConversationHandler.END
+
+    catalog = get_catalog_view()
+    product = catalog['products_by_id'].get(context.user_data.get('issue_product_id')) if catalog else None
+    if product is None:
+        await query.edit_message_text("❌ Продукт не найден.",
+                                      reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role')))
+        return ADMIN_MENU
 
-        await query.edit_message_text(f"🎉 **БЕСПЛАТНЫЙ** билет для {context.user_data['issue_name']} выдан!",
-                                      parse_mode='Markdown')
+    # Билет создается, ставится в очередь email и отправляется выдавшему сотруднику
+    issued = await issue_ticket_to_user(context.bot, query.from_user.id, {
+        'product_id': context.user_data['issue_product_id'],
+        'product_name': product['name'],
+        'buyer_name': context.user_data['issue_name'],
+        'buyer_email': context.user_data['issue_email'],
+        'final_price': 0,  # Бесплатно
+    })
+
+    if issued:
+        # Билет занял место в лимите тарифа: остатки в каталоге перечитываются
+        invalidate_stock()
+        text = f"🎉 **БЕСПЛАТНЫЙ** билет для {context.user_data['issue_name']} выдан!"
+    else:
+        text = "❌ Не удалось выдать билет. Попробуйте еще раз."
+    await query.edit_message_text(text, parse_mode='Markdown',
+                                  reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role')))
 
-        # Очистка контекста
-        context.user_data.pop('issue_product_id', None)
-        context.user_data.pop('issue_name', None)
-        context.user_data.pop('issue_email', None)
+    # Очистка контекста
+    context.user_data.pop('issue_product_id', None)
+    context.user_data.pop('issue_name', None)
+    context.user_data.pop('issue_email', None)
 
-    return await admin_menu(update, context)
+    return ADMIN_MENU
 
 
 async def admin_issue_ticket_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -648,17 +1298,18 @@ async def issue_ticket_from_admin_notification(update: Update, context: ContextT
     query = update.callback_query
     await query.answer()
 
-    # Проверка, что действие совершает именно ADMIN_ID
-    # (ADMIN_ID должен быть импортирован из os.getenv("ADMIN_ID") в начале файла)
-    if query.from_user.id != ADMIN_ID:
+    # Подтверждать оплаты могут кассиры и владельцы
+    if not has_permission(query.from_user.id, 'payments'):
         await query.edit_message_text("⛔ Вы не являетесь администратором.")
         return
 
-    # 1. Парсинг данных: 'issue_REF' или 'reject_REF'
-    action, payment_ref = query.data.split('_', 1)
+    # 1. Парсинг данных: 'issue_ticket_REF' или 'reject_ticket_REF'
+    action, payment_ref = query.data.split('_ticket_', 1)
 
-    # 2. Извлечение сохраненных деталей из bot_data и их удаление
-    transaction_data = context.application.bot_data.pop(payment_ref, None)
+    # 2. Атомарный перевод запроса из 'pending' в итоговый статус: повторное нажатие
+    # (или нажатие в другом инстансе) получит None и не выдаст второй билет
+    new_status = 'approved' if action == 'issue' else 'rejected'
+    transaction_data = resolve_pending_payment(payment_ref, new_status)
 
     if not transaction_data:
         await query.edit_message_text(
@@ -671,19 +1322,30 @@ async def issue_ticket_from_admin_notification(update: Update, context: ContextT
     if action == 'issue':
         # Вызов функции для создания билета
         try:
-            # issue_ticket_to_user(chat_id, name, email, product_id, final_price, context)
-            await issue_ticket_to_user(
-                chat_id=transaction_data['chat_id'],
-                name=transaction_data['name'],
-                email=transaction_data['email'],
-                product_id=transaction_data['product_id'],
-                final_price=transaction_data['final_price'],
-                context=context
-            )
+            # Резерв превращается в продажу; False — лимит исчерпан, но оплата уже получена
+            within_limit = confirm_reservation(transaction_data.get('reservation_id'), transaction_data['product_id'])
+
+            # Контрольная копия билета уходит администратору, нажавшему кнопку
+            issued = await issue_ticket_to_user(context.bot, query.from_user.id, {
+                'product_name': transaction_data['product_name'],
+                'buyer_name': transaction_data['buyer_name'],
+                'buyer_email': transaction_data['buyer_email'],
+                'final_price': transaction_data['final_price'],
+                'buyer_chat_id': transaction_data['chat_id']
+            })
+
+            if not issued:
+                await query.edit_message_text(
+                    f"⚠️ Оплата `{payment_ref}` подтверждена, но билет не удалось выдать или доставить. "
+                    "Проверьте логи и при необходимости выдайте билет вручную.",
+                    parse_mode='Markdown'
+                )
+                return
 
             # Уведомление администратора (редактируем исходное сообщение)
             await query.edit_message_text(
-                f"✅ Билет для **{escape_html(transaction_data['name'])}** ({transaction_data['final_price']} ₽) успешно выдан!",
+                f"✅ Билет для **{escape_html(transaction_data['buyer_name'])}** ({transaction_data['final_price']} ₽) успешно выдан!"
+                + ("" if within_limit else "\n⚠️ Лимит тарифа был исчерпан — билет выдан сверх лимита."),
                 parse_mode='Markdown'
             )
 
@@ -695,6 +1357,14 @@ async def issue_ticket_from_admin_notification(update: Update, context: ContextT
             )
 
     elif action == 'reject':
+        # Место и использование промокода возвращаются
+        if transaction_data.get('reservation_id') is not None:
+            released = release_reservation(transaction_data['reservation_id'])
+            if released:
+                update_cached_stock(*released)
+        if transaction_data['promo_redeemed']:
+            release_promo_redemptions([transaction_data['promo_code']])
+
         # Уведомление администратора об отклонении
         await query.edit_message_text(
             f"❌ Транзакция `{payment_ref}` отклонена.",
@@ -710,6 +1380,153 @@ async def issue_ticket_from_admin_notification(update: Update, context: ContextT
             logging.warning(
                 f"Не удалось уведомить пользователя {transaction_data['chat_id']} об отклонении оплаты: {e}")
 
+    await maybe_sweep_pending_payments(context.bot)
+
+
+
+# --- ОЖИДАЮЩИЕ ОПЛАТЫ (ПАКЕТНОЕ ПОДТВЕРЖДЕНИЕ) ---
+
+async def show_pending_payments(query: Update.callback_query, context: ContextTypes.DEFAULT_TYPE,
+                                notice: str = "") -> int:
+    """
+    Показывает текущую страницу ожидающих оплат с отметками выбора.
+    Страницы листаются по ключу (created_at, payment_ref): стек ключей хранится в user_data.
+    """
+    cursors = context.user_data.setdefault('pp_cursors', [None])
+    selected = context.user_data.setdefault('pp_selected', set())
+
+    page = get_pending_payments_page(cursors[-1], PENDING_PAGE_SIZE)
+    if page is None:
+        await query.edit_message_text("❌ Ошибка при загрузке запросов оплаты.",
+                                      reply_markup=get_admin_main_menu_keyboard(context.user_data.get('admin_role')))
+        return ADMIN_MENU
+
+    payments, has_next = page
+    if not payments and len(cursors) > 1:
+        # Страница опустела (запросы обработаны) — возвращаемся к началу списка
+        context.user_data['pp_cursors'] = cursors = [None]
+        payments, has_next = get_pending_payments_page(None, PENDING_PAGE_SIZE) or ([], False)
+
+    context.user_data['pp_page_refs'] = [p['payment_ref'] for p in payments]
+    context.user_data['pp_next_after'] = (payments[-1]['created_at'], payments[-1]['payment_ref']) if payments else None
+
+    text = f"{notice}\n\n" if notice else ""
+    text += f"💳 <b>Ожидающие оплаты</b> (всего: {count_pending_payments()}, выбрано: {len(selected)})\n"
+    if not payments:
+        text += "\nНовых запросов нет."
+
+    keyboard = []
+    for p in payments:
+        mark = "✅" if p['payment_ref'] in selected else "⬜"
+        text += (f"\n{mark} <code>{p['payment_ref']}</code> {p['created_at'].strftime('%d.%m %H:%M')}\n"
+                 f"    {escape_html(p['buyer_name'])} ({escape_html(p['buyer_email'])}), "
+                 f"{escape_html(p['product_name'])}, {p['final_price']} ₽")
+        keyboard.append([InlineKeyboardButton(
+            f"{mark} {p['payment_ref']} · {p['buyer_name'][:20]} · {p['final_price']} ₽",
+            callback_data=f"pp_toggle_{p['payment_ref']}")])
+
+    navigation = []
+    if len(cursors) > 1:
+        navigation.append(InlineKeyboardButton("◀️ Назад", callback_data="pp_prev"))
+    if payments:
+        navigation.append(InlineKeyboardButton("☑️ Вся страница", callback_data="pp_page"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Вперед ▶️", callback_data="pp_next"))
+    if navigation:
+        keyboard.append(navigation)
+
+    if selected:
+        keyboard.append([
+            InlineKeyboardButton(f"✅ Выдать ({len(selected)})", callback_data="pp_approve"),
+            InlineKeyboardButton(f"❌ Отклонить ({len(selected)})", callback_data="pp_reject"),
+        ])
+        keyboard.append([InlineKeyboardButton("🧹 Снять выбор", callback_data="pp_clear")])
+    keyboard.append([InlineKeyboardButton("🔄 Обновить", callback_data="pp_refresh"),
+                     InlineKeyboardButton("🔙 В главное меню", callback_data="menu_main")])
+
+    try:
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
+    except BadRequest as e:
+        # "Обновить" без новых запросов: Telegram отклоняет редактирование без изменений
+        if "not modified" not in str(e):
+            raise
+    return PENDING_PAYMENTS
+
+
+async def handle_pending_payments(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Обрабатывает выбор, навигацию и пакетные действия на странице ожидающих оплат."""
+    query = update.callback_query
+    await query.answer()
+
+    data = query.data
+    selected = context.user_data.setdefault('pp_selected', set())
+    cursors = context.user_data.setdefault('pp_cursors', [None])
+
+    if data == "menu_main":
+        for key in ('pp_cursors', 'pp_selected', 'pp_page_refs', 'pp_next_after'):
+            context.user_data.pop(key, None)
+        return await admin_menu(update, context)
+
+    if data.startswith("pp_toggle_"):
+        selected ^= {data[len("pp_toggle_"):]}
+    elif data == "pp_page":
+        page_refs = set(context.user_data.get('pp_page_refs', []))
+        # Повторное нажатие снимает выбор со страницы
+        if page_refs <= selected:
+            selected -= page_refs
+        else:
+            selected |= page_refs
+    elif data == "pp_clear":
+        selected.clear()
+    elif data == "pp_next" and context.user_data.get('pp_next_after'):
+        cursors.append(context.user_data['pp_next_after'])
+    elif data == "pp_prev" and len(cursors) > 1:
+        cursors.pop()
+    elif data == "pp_approve" and selected:
+        return await approve_selected_payments(query, context)
+    elif data == "pp_reject" and selected:
+        return await reject_selected_payments(query, context)
+
+    return await show_pending_payments(query, context)
+
+
+async def approve_selected_payments(query: Update.callback_query, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Выдает билеты по всем выбранным оплатам одной транзакцией и рассылает их с ограничением частоты."""
+    selected = context.user_data['pp_selected']
+    await query.edit_message_text(f"⏳ Выдаю билеты: {len(selected)}...")
+
+    approved = approve_pending_payments({ref: new_ticket_id() for ref in selected})
+    if approved is None:
+        return await show_pending_payments(query, context, "❌ Ошибка БД: ни один билет не выдан, выбор сохранен.")
+
+    selected.clear()
+    invalidate_stock()
+    delivered = await deliver_issued_tickets(context.bot, approved)
+
+    notice = f"✅ Выдано билетов: {len(approved)}, доставлено: {delivered}."
+    over_limit = [p['payment_ref'] for p in approved if not p['within_limit']]
+    if over_limit:
+        notice += f"\n⚠️ Сверх лимита: {', '.join(over_limit)}"
+    if delivered < len(approved):
+        notice += "\n⚠️ Часть билетов не доставлена (подробности в логах), их можно найти через проверку билета."
+
+    await maybe_sweep_pending_payments(context.bot)
+    return await show_pending_payments(query, context, notice)
+
+
+async def reject_selected_payments(query: Update.callback_query, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Отклоняет выбранные оплаты одной транзакцией и уведомляет покупателей."""
+    selected = context.user_data['pp_selected']
+    rejected = reject_pending_payments(list(selected))
+    selected.clear()
+    invalidate_stock()
+    release_promo_redemptions([p['promo_code'] for p in rejected if p['promo_redeemed']])
+
+    await send_bulk_messages(context.bot, [
+        (p['chat_id'], "❌ Администратор отклонил подтверждение вашей оплаты. Пожалуйста, свяжитесь с поддержкой.")
+        for p in rejected
+    ])
+    return await show_pending_payments(query, context, f"❌ Отклонено запросов: {len(rejected)}.")
 
 
 # --- РЕГИСТРАЦИЯ КОНВЕРСЕЙШЕН ХЕНДЛЕРОВ ---
@@ -730,21 +1547,41 @@ admin_conv_handler = ConversationHandler(
             CallbackQueryHandler(handle_ticket_activation, pattern=r'^(activate_|menu_main)$')
         ],
 
+        SEARCH_TICKETS: [
+            MessageHandler(filters.TEXT & ~filters.COMMAND, process_ticket_search),
+            CallbackQueryHandler(handle_ticket_search, pattern=r'^ts_|^menu_main$')
+        ],
+
+        SCAN_MODE: [
+            MessageHandler(filters.TEXT & ~filters.COMMAND | filters.PHOTO, process_scan_input),
+            CallbackQueryHandler(admin_menu, pattern=r'^menu_main$')
+        ],
+
+        PENDING_PAYMENTS: [CallbackQueryHandler(handle_pending_payments, pattern=r'^pp_|^menu_main$')],
+
+        SELECT_PRODUCT_CAPACITY: [CallbackQueryHandler(select_product_capacity, pattern=r'^capacity_|^menu_main$')],
+        ENTER_CAPACITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_new_capacity)],
+
         SELECT_PRODUCT_TO_EDIT: [CallbackQueryHandler(select_product_to_edit, pattern=r'^editprice_|^menu_main$')],
         ENTER_NEW_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_new_price)],
 
         # УПРАВЛЕНИЕ ПРОМОКОДАМИ
         PROMO_MENU: [
             CallbackQueryHandler(start_add_promocode, pattern=r'^promo_add$'),
-            CallbackQueryHandler(manage_promo_actions, pattern=r'^(promo_list|activate_promo_|deactivate_promo_)'),
+            CallbackQueryHandler(manage_promo_actions,
+                                 pattern=r'^(promo_list|promo_page_|promo_search|menu_promo|activate_promo_|deactivate_promo_)'),
             CallbackQueryHandler(admin_menu, pattern=r'^menu_main$'),
         ],
+        ENTER_PROMO_SEARCH: [
+            MessageHandler(filters.TEXT & ~filters.COMMAND, process_promo_search),
+            CallbackQueryHandler(manage_promo_actions, pattern=r'^promo_list$')
+        ],
         ENTER_PROMO_DATA: [
             MessageHandler(filters.TEXT & ~filters.COMMAND, process_promo_data),
             CallbackQueryHandler(promo_menu_handler, pattern=r'^menu_promo$')  # Кнопка "назад"
         ],
         SELECT_PROMO_PRODUCTS: [
-            CallbackQueryHandler(handle_promo_product_selection, pattern=r'^(promoprod_|finish_promo_products)$'),
+            CallbackQueryHandler(handle_promo_product_selection, pattern=r'^promoprod_|^finish_promo_products$'),
         ],
 
         # РУЧНАЯ ВЫДАЧА БИЛЕТА
@@ -0,0 +1,82 @@
+# admin_roles.py
+
+import os
+import time
+import random
+import logging
+
+# Абсолютные импорты
+from db_utils import get_admins
+from versioned_cache import new_cache_state, bump_version, is_fresh, store
+
+# Главный администратор: всегда владелец, даже если таблица admins пуста или БД недоступна
+ADMIN_ID = int(os.getenv("ADMIN_ID")) if os.getenv("ADMIN_ID") else None
+
+# Справочник читается на каждом апдейте (rate_limit, проверки прав). Сотрудник, снятый с роли
+# или смены в другом инстансе, теряет доступ здесь не позже чем через этот срок
+ADMIN_ROLES_TTL = int(os.getenv("ADMIN_ROLES_TTL", "60"))
+
+# Что разрешено каждой роли:
+# 'scan' — проверка, поиск и активация билетов; 'payments' — подтверждение оплат и ручная выдача;
+# 'manage' — цены, лимиты, промокоды, статистика и сотрудники
+ROLE_PERMISSIONS = {
+    'scanner': {'scan'},
+    'cashier': {'scan', 'payments'},
+    'owner': {'scan', 'payments', 'manage'},
+}
+
+# Версия списка сотрудников и последний загруженный справочник (value).
+# rr_next — счетчик очереди кассиров; случайный старт, чтобы холодные старты разных инстансов
+# не отправляли первое уведомление одному и тому же кассиру
+roles_state = new_cache_state(rr_next=random.randrange(1 << 16))
+
+
+def bump_admin_version() -> int:
+    """Инвалидирует справочник (вызывается после изменения сотрудников или смены)."""
+    return bump_version(roles_state)
+
+
+def get_admin_directory() -> dict:
+    """
+    Возвращает {user_id: сотрудник}; БД читается только при смене версии или по истечении ADMIN_ROLES_TTL.
+    При ошибке БД используется прошлый справочник (или пустой — тогда доступ есть только у ADMIN_ID),
+    а повторная попытка откладывается на ADMIN_ROLES_TTL: справочник читается на каждом апдейте (rate_limit).
+    """
+    now = time.monotonic()
+    if is_fresh(roles_state, ADMIN_ROLES_TTL, now):
+        return roles_state['value']
+
+    admins = get_admins()
+    if admins is None:
+        return store(roles_state, roles_state['value'] or {}, now)
+
+    logging.info(f"Справочник сотрудников перечитан (версия {roles_state['version']}, сотрудников: {len(admins)}).")
+    return store(roles_state, {admin['user_id']: admin for admin in admins}, now)
+
+
+def get_admin_role(user_id: int) -> str | None:
+    """Роль пользователя ('scanner', 'cashier', 'owner') или None, если он не сотрудник."""
+    if user_id == ADMIN_ID:
+        return 'owner'
+    admin = get_admin_directory().get(user_id)
+    return admin['role'] if admin else None
+
+
+def has_permission(user_id: int, permission: str) -> bool:
+    """Проверяет право пользователя ('scan', 'payments' или 'manage')."""
+    role = get_admin_role(user_id)
+    return role is not None and permission in ROLE_PERMISSIONS[role]
+
+
+def next_cashier() -> int | None:
+    """
+    Выбирает получателя уведомления об оплате по кругу среди сотрудников на смене с правом 'payments'.
+    Если на смене никого нет, уведомление получает главный администратор.
+    """
+    cashiers = [user_id for user_id, admin in get_admin_directory().items()
+                if admin['on_duty'] and 'payments' in ROLE_PERMISSIONS[admin['role']]]
+    if not cashiers:
+        return ADMIN_ID
+
+    roles_state['rr_next'] += 1
+    return cashiers[roles_state['rr_next'] % len(cashiers)]
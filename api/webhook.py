@@ -5,13 +5,24 @@ import json
 import asyncio
 import logging
 from telegram import Update
-from bot import setup_application
+from bot import setup_application, flush_logs
 from db_utils import create_tables
+from metrics import render_prometheus
+from email_sender import drain_outbox
+from live_counters import get_live_counters
 
 # Настройка логирования для вывода в консоль Vercel
 logging.basicConfig(level=logging.INFO)
 
 TOKEN = os.getenv("TELEGRAM_TOKEN")
+# Токен для /api/metrics (заголовок Authorization: Bearer <токен>); без него эндпоинт отключен (404)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# Токен для /api/email-dispatch; Vercel Cron передает его как Authorization: Bearer <CRON_SECRET>.
+# Без него эндпоинт отключен, чтобы рассылку нельзя было запустить извне
+CRON_SECRET = os.getenv("CRON_SECRET")
+# Токен для /api/checkin (табло на входе): заголовок Authorization: Bearer <токен> или ?token=.
+# Без него эндпоинт отключен (404): счетчики продаж не должны быть публичными
+CHECKIN_TOKEN = os.getenv("CHECKIN_TOKEN")
 APPLICATION = None
 
 def get_application():
@@ -58,11 +69,75 @@ async def process_telegram_update(event):
         logging.error(f"Error processing update (логика бота): {e}")
         return {'statusCode': 200, 'body': 'Update processed with error'}
 
-# Синхронная точка входа Vercel
-def handler(event, context):
-    """Основная точка входа Vercel Serverless Function."""
+def process_metrics_request(event):
+    """Отдает метрики инстанса в текстовом формате Prometheus (GET /api/metrics)."""
+    if not METRICS_TOKEN:
+        return {'statusCode': 404, 'body': 'Not Found'}
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    if headers.get('authorization') != f"Bearer {METRICS_TOKEN}":
+        return {'statusCode': 401, 'body': 'Unauthorized'}
+
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+        'body': render_prometheus()
+    }
+
+
+def process_email_dispatch(event):
+    """Разбирает очередь писем с билетами (GET /api/email-dispatch, вызывается по расписанию)."""
+    if not CRON_SECRET:
+        return {'statusCode': 503, 'body': 'CRON_SECRET is not configured'}
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    if headers.get('authorization') != f"Bearer {CRON_SECRET}":
+        return {'statusCode': 401, 'body': 'Unauthorized'}
+
+    sent, failed = asyncio.run(drain_outbox())
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps({'sent': sent, 'failed': failed})
+    }
+
+
+def process_checkin_request(event):
+    """Отдает счетчики входа в JSON для табло (GET /api/checkin); данные из кэша live_counters."""
+    if not CHECKIN_TOKEN:
+        return {'statusCode': 404, 'body': 'Not Found'}
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    query = event.get('queryStringParameters') or {}
+    if headers.get('authorization') != f"Bearer {CHECKIN_TOKEN}" and query.get('token') != CHECKIN_TOKEN:
+        return {'statusCode': 401, 'body': 'Unauthorized'}
+
+    snapshot = get_live_counters()
+    if snapshot is None:
+        return {'statusCode': 503, 'body': 'Counters unavailable'}
+
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json; charset=utf-8', 'Cache-Control': 'no-store'},
+        'body': json.dumps(snapshot, ensure_ascii=False)
+    }
+
+
+def route_request(event):
+    """Выбирает обработчик по методу и пути запроса."""
+    if event.get('httpMethod') == 'GET' and (event.get('path') or '').rstrip('/').endswith('/metrics'):
+        return process_metrics_request(event)
+    if event.get('httpMethod') == 'GET' and (event.get('path') or '').rstrip('/').endswith('/email-dispatch'):
+        return process_email_dispatch(event)
+    if event.get('httpMethod') == 'GET' and (event.get('path') or '').rstrip('/').endswith('/checkin'):
+        return process_checkin_request(event)
+
     # Используем asyncio.run() для запуска асинхронной логики
     return asyncio.run(process_telegram_update(event))
-        logging.error(f"Ошибка обработки обновления: {e}")
 
-        return {'statusCode': 200, 'body': 'OK (Error logged)'}
+
+# Синхронная точка входа Vercel
+def handler(event, context):
+    """Основная точка входа Vercel Serverless Function."""
+    try:
+        return route_request(event)
+    finally:
+        # Логи пишет фоновый поток; после ответа инстанс замораживается, поэтому очередь дописывается сейчас
+        flush_logs()
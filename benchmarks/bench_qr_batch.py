@@ -0,0 +1,65 @@
+# benchmarks/bench_qr_batch.py
+#
+# Сравнение текущего рендера generate_qr_code (по одному билету) с пакетным
+# векторизованным рендером из qr_render.py.
+#
+# Запуск из корня репозитория:
+#   python -m benchmarks.bench_qr_batch --count 2000 --workers 4 --out bench_qr_batch.json
+
+import os
+import uuid
+import argparse
+
+from benchmarks.common import timed, write_results
+from qr_render import render_qr_batch
+from user_handlers import generate_qr_code
+
+
+def make_ticket_ids(count: int) -> list:
+    """Генерирует ID билетов в том же формате, что и issue_ticket_to_user."""
+    return [str(uuid.uuid4()).upper().replace('-', '')[:12] for _ in range(count)]
+
+
+def render_legacy(ticket_ids: list) -> dict:
+    """Текущий путь: PIL-фабрика qrcode, по одному вызову на билет."""
+    return {ticket_id: generate_qr_code(ticket_id).getvalue() for ticket_id in ticket_ids}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк пакетного рендера QR-кодов")
+    parser.add_argument('--count', type=int, default=1000, help="Количество билетов в пачке")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Процессов для параллельного рендера")
+    parser.add_argument('--out', default=None, help="Путь для JSON с результатами")
+    args = parser.parse_args()
+
+    ticket_ids = make_ticket_ids(args.count)
+
+    # Прогрев: импорт модулей и первая компиляция матриц не должны попасть в замер
+    render_legacy(ticket_ids[:5])
+    render_qr_batch(ticket_ids[:5])
+
+    legacy, legacy_s = timed(render_legacy, ticket_ids)
+    batch, batch_s = timed(render_qr_batch, ticket_ids)
+    parallel, parallel_s = timed(render_qr_batch, ticket_ids, workers=args.workers)
+
+    def row(images: dict, seconds: float) -> dict:
+        return {
+            'seconds': round(seconds, 4),
+            'tickets_per_second': round(len(images) / seconds, 1) if seconds else 0.0,
+            'avg_png_bytes': round(sum(len(b) for b in images.values()) / len(images), 1) if images else 0.0,
+        }
+
+    write_results(args.out, {
+        'benchmark': 'qr_batch_render',
+        'count': args.count,
+        'workers': args.workers,
+        'legacy_per_ticket': row(legacy, legacy_s),
+        'vectorized_batch': row(batch, batch_s),
+        'vectorized_parallel': row(parallel, parallel_s),
+        'speedup_batch': round(legacy_s / batch_s, 2) if batch_s else 0.0,
+        'speedup_parallel': round(legacy_s / parallel_s, 2) if parallel_s else 0.0,
+    })
+
+
+if __name__ == '__main__':
+    main()
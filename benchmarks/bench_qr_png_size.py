@@ -0,0 +1,90 @@
+# benchmarks/bench_qr_png_size.py
+#
+# Сравнение текущего PNG из generate_qr_code с компактным 1-битным режимом:
+# размер файла, время кодирования и доля успешно распознанных кодов.
+#
+# Запуск из корня репозитория:
+#   python -m benchmarks.bench_qr_png_size --count 300 --out bench_qr_png_size.json
+
+import io
+import argparse
+
+from PIL import Image
+
+from benchmarks.common import timed, summarize_latencies, write_results
+from benchmarks.bench_qr_batch import make_ticket_ids
+from qr_render import render_qr_png, QR_COMPACT_BOX_SIZE
+from user_handlers import generate_qr_code
+from utils import read_qr_code_from_image
+
+# Размеры модуля, которые перебираются для компактного режима
+BOX_SIZES = (4, 6, 8, 10)
+
+
+def telegram_photo(png_bytes: bytes, quality: int = 80) -> bytes:
+    """Имитирует пересжатие фото Telegram: RGB + JPEG."""
+    image = Image.open(io.BytesIO(png_bytes)).convert('RGB')
+    bio = io.BytesIO()
+    image.save(bio, 'JPEG', quality=quality)
+    return bio.getvalue()
+
+
+def half_size(png_bytes: bytes) -> bytes:
+    """Имитирует маленький снимок экрана: уменьшение в 2 раза с интерполяцией."""
+    image = Image.open(io.BytesIO(png_bytes)).convert('L')
+    image = image.resize((image.width // 2, image.height // 2), Image.BILINEAR)
+    bio = io.BytesIO()
+    image.save(bio, 'PNG')
+    return bio.getvalue()
+
+
+def measure(name: str, render, ticket_ids: list) -> dict:
+    """Рендерит все билеты одним способом и проверяет распознавание в трех вариантах."""
+    timings, sizes = [], []
+    decoded = {'png': 0, 'telegram_jpeg': 0, 'half_size': 0}
+
+    for ticket_id in ticket_ids:
+        png_bytes, seconds = timed(render, ticket_id)
+        timings.append(seconds)
+        sizes.append(len(png_bytes))
+
+        for variant, data in (('png', png_bytes),
+                              ('telegram_jpeg', telegram_photo(png_bytes)),
+                              ('half_size', half_size(png_bytes))):
+            if read_qr_code_from_image(data) == ticket_id:
+                decoded[variant] += 1
+
+    return {
+        'name': name,
+        'avg_bytes': round(sum(sizes) / len(sizes), 1),
+        'encode': summarize_latencies(timings),
+        'decode_success_rate': {k: round(v / len(ticket_ids), 4) for k, v in decoded.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение размеров и распознаваемости PNG QR-кодов")
+    parser.add_argument('--count', type=int, default=200, help="Количество билетов")
+    parser.add_argument('--out', default=None, help="Путь для JSON с результатами")
+    args = parser.parse_args()
+
+    ticket_ids = make_ticket_ids(args.count)
+
+    variants = [measure('legacy', lambda t: generate_qr_code(t, compact=False).getvalue(), ticket_ids)]
+    for box_size in BOX_SIZES:
+        variants.append(measure(
+            f'compact_box{box_size}',
+            lambda t, b=box_size: render_qr_png(t, box_size=b, optimize=True, compress_level=9),
+            ticket_ids
+        ))
+
+    write_results(args.out, {
+        'benchmark': 'qr_png_size',
+        'count': args.count,
+        'default_compact_box_size': QR_COMPACT_BOX_SIZE,
+        'variants': variants,
+    })
+
+
+if __name__ == '__main__':
+    main()
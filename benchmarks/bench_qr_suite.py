@@ -0,0 +1,131 @@
+# benchmarks/bench_qr_suite.py
+#
+# Бенчмарк-набор для QR: задержка и доля распознавания read_qr_code_from_image
+# на синтетическом корпусе снимков + пропускная способность generate_qr_code.
+# Результаты пишутся в JSON со стабильной схемой; с --baseline набор сравнивает
+# их с прошлым прогоном и завершается с кодом 1 при регрессии.
+#
+# Запуск из корня репозитория:
+#   python -m benchmarks.bench_qr_suite --tickets 50 --out bench_qr_suite.json
+#   python -m benchmarks.bench_qr_suite --baseline bench_qr_suite.json
+
+import os
+import sys
+import json
+import random
+import argparse
+
+from benchmarks.common import timed, summarize_latencies, write_results
+from benchmarks.qr_corpus import DISTORTIONS, generate_corpus
+from qr_render import render_qr_batch
+from user_handlers import generate_qr_code
+from utils import read_qr_code_from_image
+
+SCHEMA_VERSION = 1
+
+
+def make_ticket_ids(count: int, seed: int) -> list:
+    """Детерминированные ID билетов (12 hex-символов, как у issue_ticket_to_user)."""
+    rng = random.Random(seed)
+    return [f"{rng.getrandbits(48):012X}" for _ in range(count)]
+
+
+def bench_scan(corpus: list) -> dict:
+    """Распознает каждый снимок корпуса и группирует задержки и успехи по видам искажений."""
+    timings = {d: [] for d in DISTORTIONS}
+    successes = {d: 0 for d in DISTORTIONS}
+
+    for ticket_id, distortion, image_bytes in corpus:
+        decoded, seconds = timed(read_qr_code_from_image, image_bytes)
+        timings[distortion].append(seconds)
+        if decoded == ticket_id:
+            successes[distortion] += 1
+
+    all_timings = [s for values in timings.values() for s in values]
+    return {
+        'overall': dict(summarize_latencies(all_timings),
+                        success_rate=round(sum(successes.values()) / len(corpus), 4)),
+        'by_distortion': {
+            d: dict(summarize_latencies(timings[d]), success_rate=round(successes[d] / len(timings[d]), 4))
+            for d in DISTORTIONS
+        },
+    }
+
+
+def bench_render(ticket_ids: list) -> dict:
+    """Пропускная способность генерации: старый и компактный generate_qr_code и пакетный рендер."""
+    results = {}
+    for name, compact in (('generate_qr_code_legacy', False), ('generate_qr_code_compact', True)):
+        timings = [timed(generate_qr_code, t, compact=compact)[1] for t in ticket_ids]
+        results[name] = dict(summarize_latencies(timings),
+                             tickets_per_second=round(len(timings) / sum(timings), 1))
+
+    _, seconds = timed(render_qr_batch, ticket_ids)
+    results['render_qr_batch'] = {'count': len(ticket_ids),
+                                  'tickets_per_second': round(len(ticket_ids) / seconds, 1)}
+    return results
+
+
+def find_regressions(current: dict, baseline: dict, max_latency_growth: float, max_success_drop: float) -> list:
+    """Сравнивает p90 и долю распознавания по каждому искажению с базовым прогоном."""
+    regressions = []
+    for distortion, now in current['scan']['by_distortion'].items():
+        before = baseline.get('scan', {}).get('by_distortion', {}).get(distortion)
+        if not before:
+            continue
+        if before['p90_ms'] and now['p90_ms'] > before['p90_ms'] * (1 + max_latency_growth):
+            regressions.append(f"{distortion}: p90 {before['p90_ms']} -> {now['p90_ms']} ms")
+        if now['success_rate'] < before['success_rate'] - max_success_drop:
+            regressions.append(f"{distortion}: success {before['success_rate']} -> {now['success_rate']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк сканирования и генерации QR-кодов")
+    parser.add_argument('--tickets', type=int, default=30, help="Билетов в корпусе (каждый во всех искажениях)")
+    parser.add_argument('--render-count', type=int, default=500, help="Билетов для замера генерации")
+    parser.add_argument('--seed', type=int, default=2024, help="Seed корпуса")
+    parser.add_argument('--corpus-dir', default=None, help="Сохранить снимки корпуса в папку для просмотра")
+    parser.add_argument('--out', default=None, help="Путь для JSON с результатами")
+    parser.add_argument('--baseline', default=None, help="JSON прошлого прогона для поиска регрессий")
+    parser.add_argument('--max-latency-growth', type=float, default=0.25, help="Допустимый рост p90 (доля)")
+    parser.add_argument('--max-success-drop', type=float, default=0.02, help="Допустимое падение доли распознавания")
+    args = parser.parse_args()
+
+    # Базовый прогон читается до записи результатов: --out может указывать на тот же файл
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    corpus = generate_corpus(make_ticket_ids(args.tickets, args.seed), seed=args.seed)
+
+    if args.corpus_dir:
+        os.makedirs(args.corpus_dir, exist_ok=True)
+        for ticket_id, distortion, image_bytes in corpus:
+            with open(os.path.join(args.corpus_dir, f"{distortion}_{ticket_id}.jpg"), 'wb') as f:
+                f.write(image_bytes)
+
+    # Прогрев декодера, чтобы загрузка libzbar не попала в перцентили
+    read_qr_code_from_image(corpus[0][2])
+
+    results = {
+        'schema_version': SCHEMA_VERSION,
+        'benchmark': 'qr_suite',
+        'seed': args.seed,
+        'corpus_size': len(corpus),
+        'scan': bench_scan(corpus),
+        'render': bench_render(make_ticket_ids(args.render_count, args.seed + 1)),
+    }
+    write_results(args.out, results)
+
+    if baseline is not None:
+        regressions = find_regressions(results, baseline, args.max_latency_growth, args.max_success_drop)
+        for line in regressions:
+            print(f"REGRESSION: {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+# benchmarks/common.py
+
+import json
+import time
+import statistics
+
+
+def percentile(values: list, pct: float) -> float:
+    """Возвращает перцентиль (0-100) по методу ближайшего ранга."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize_latencies(seconds: list) -> dict:
+    """Сводка задержек в миллисекундах: среднее и перцентили p50/p90/p99."""
+    ms = [s * 1000 for s in seconds]
+    return {
+        'count': len(ms),
+        'mean_ms': round(statistics.fmean(ms), 3) if ms else 0.0,
+        'p50_ms': round(percentile(ms, 50), 3),
+        'p90_ms': round(percentile(ms, 90), 3),
+        'p99_ms': round(percentile(ms, 99), 3),
+        'max_ms': round(max(ms), 3) if ms else 0.0,
+    }
+
+
+def timed(func, *args, **kwargs):
+    """Вызывает функцию и возвращает (результат, длительность в секундах)."""
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def write_results(path: str | None, results: dict) -> None:
+    """Печатает результаты и (если задан путь) сохраняет их в JSON со стабильным порядком ключей."""
+    text = json.dumps(results, ensure_ascii=False, indent=2, sort_keys=True)
+    print(text)
+    if path:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
@@ -0,0 +1,111 @@
+# benchmarks/email_outbox_check.py
+#
+# Сквозная проверка очереди писем: билет сохраняется через insert_ticket (и ставится в email_outbox
+# в той же транзакции), затем dispatch_email_batch отправляет его на локальную заглушку SMTP (aiosmtpd).
+# Проверяется, что письмо дошло до получателя с QR-кодом во вложении, а строка очереди стала 'sent'.
+#
+# ВНИМАНИЕ: проверка пишет в БД билет и строку очереди — запускайте ее только на отдельной локальной базе.
+#
+# Запуск из корня репозитория (нужен pip install aiosmtpd):
+#   python -m benchmarks.email_outbox_check --database-url postgresql://localhost/readytodie_sim
+
+import os
+import sys
+import asyncio
+import argparse
+from email import message_from_bytes, policy
+
+CHECK_EMAIL = "buyer@example.com"
+CHECK_PRODUCT = "Email check"
+
+
+class CollectingHandler:
+    """Обработчик aiosmtpd: складывает принятые письма в список."""
+
+    def __init__(self):
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append((envelope.rcpt_tos, message_from_bytes(envelope.content, policy=policy.default)))
+        return '250 OK'
+
+
+def outbox_status(ticket_id: str):
+    """Статус и число попыток строки очереди для билета."""
+    from db_utils import connect_db
+
+    conn = connect_db()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT status, attempts FROM email_outbox WHERE ticket_id = %s;", (ticket_id,))
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def run_check() -> list:
+    """Выполняет проверку; возвращает список ошибок (пустой — все в порядке)."""
+    from aiosmtpd.controller import Controller
+    from db_utils import create_tables, insert_ticket, new_ticket_id
+    from email_sender import dispatch_email_batch
+
+    smtp_handler = CollectingHandler()
+    controller = Controller(smtp_handler, hostname='127.0.0.1', port=int(os.environ['SMTP_PORT']))
+    controller.start()
+    try:
+        create_tables()
+        saved = insert_ticket(new_ticket_id(), CHECK_PRODUCT, "Проверка", CHECK_EMAIL, 0, 0)
+        if not saved:
+            return ["insert_ticket не сохранил билет"]
+        ticket_id = saved['ticket_id']
+        if outbox_status(ticket_id) is None:
+            return ["билет не поставлен в email_outbox (EMAIL_OUTBOX_ENABLED?)"]
+
+        # В очереди могут быть письма прошлых запусков: разбираем, пока строка билета не обработана
+        for _ in range(20):
+            sent, failed = asyncio.run(dispatch_email_batch())
+            if outbox_status(ticket_id)[0] != 'pending' or sent + failed == 0:
+                break
+    finally:
+        controller.stop()
+
+    errors = []
+    status, attempts = outbox_status(ticket_id)
+    if status != 'sent':
+        errors.append(f"строка очереди в статусе {status!r} после {attempts} попыток")
+
+    received = [message for rcpt_tos, message in smtp_handler.messages
+                if CHECK_EMAIL in rcpt_tos and ticket_id in message.get_body(('plain',)).get_content()]
+    if not received:
+        errors.append("письмо с билетом не дошло до заглушки SMTP")
+    elif f"ticket_{ticket_id}.png" not in [part.get_filename() for part in received[0].iter_attachments()]:
+        errors.append("в письме нет QR-кода во вложении")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сквозная проверка очереди писем с локальной заглушкой SMTP")
+    parser.add_argument('--database-url', required=True, help="Локальная тестовая БД (будет изменена!)")
+    parser.add_argument('--smtp-port', type=int, default=8025, help="Порт заглушки SMTP")
+    args = parser.parse_args()
+
+    # Окружение задается до импорта модулей бота: они читают его при импорте
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ['SMTP_HOST'] = '127.0.0.1'
+    os.environ['SMTP_PORT'] = str(args.smtp_port)
+    os.environ['SMTP_TLS'] = '0'
+    os.environ['SMTP_FROM'] = 'tickets@example.com'
+    os.environ['EMAIL_OUTBOX_ENABLED'] = '1'
+    os.environ.pop('SMTP_USERNAME', None)
+
+    errors = run_check()
+    for error in errors:
+        print(f"FAIL: {error}")
+    if errors:
+        sys.exit(1)
+    print("OK: билет поставлен в очередь и доставлен на заглушку SMTP.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+# benchmarks/load_sim.py
+#
+# Сквозной нагрузочный симулятор: генерирует JSON-апдейты Telegram для тысяч
+# виртуальных покупателей (/buy -> тариф -> промокод -> имя -> email -> оплата)
+# и сканеров на входе, прогоняет их через setup_application с заглушкой Bot API
+# и локальной PostgreSQL. Отчет: пропускная способность, перцентили задержки
+# по шагам диалога, количество запросов к БД и рост памяти.
+#
+# ВНИМАНИЕ: симулятор пишет в БД билеты, резервы и запросы оплаты —
+# запускайте его только на отдельной локальной базе.
+#
+# Запуск из корня репозитория:
+#   python -m benchmarks.load_sim --database-url postgresql://localhost/readytodie_sim \
+#       --buyers 2000 --concurrency 200 --scanners 4 --out load_sim.json
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import tracemalloc
+
+from benchmarks.common import summarize_latencies, write_results
+
+SIM_TOKEN = "123456:SIMULATED-TOKEN"
+SIM_ADMIN_ID = 42
+SIM_ADMIN_PASSWORD = "sim-password"
+SIM_PROMO_CODE = "SIMLOAD10"
+
+BUYER_CHAT_BASE = 10_000_000
+SCANNER_CHAT_BASE = -1_000_000
+
+
+class UpdateFactory:
+    """Собирает JSON апдейтов в формате Bot API (сообщения и нажатия кнопок)."""
+
+    def __init__(self):
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f"Sim{user_id}", 'language_code': 'ru'}
+
+    def chat(self, chat_id: int) -> dict:
+        if chat_id > 0:
+            return {'id': chat_id, 'type': 'private'}
+        return {'id': chat_id, 'type': 'group', 'title': f"Scanner {chat_id}"}
+
+    def message(self, chat_id: int, user_id: int, text: str) -> dict:
+        message = {
+            'message_id': next(self.message_ids), 'date': int(time.time()),
+            'chat': self.chat(chat_id), 'from': self.user(user_id), 'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': next(self.update_ids), 'message': message}
+
+    def callback(self, chat_id: int, user_id: int, data: str) -> dict:
+        return {
+            'update_id': next(self.update_ids),
+            'callback_query': {
+                'id': str(next(self.update_ids)), 'from': self.user(user_id), 'chat_instance': str(chat_id),
+                'data': data,
+                'message': {
+                    'message_id': next(self.message_ids), 'date': int(time.time()),
+                    'chat': self.chat(chat_id), 'from': {'id': 1, 'is_bot': True, 'first_name': 'bot'},
+                    'text': '...',
+                },
+            },
+        }
+
+
+def buyer_script(factory: UpdateFactory, index: int, products: list, rng: random.Random,
+                 promo_share: float, abandon_share: float) -> list:
+    """Последовательность (шаг, апдейт) одного виртуального покупателя."""
+    chat_id = user_id = BUYER_CHAT_BASE + index
+    steps = [
+        ('buy', factory.message(chat_id, user_id, '/buy')),
+        ('select_product', factory.callback(chat_id, user_id, rng.choice(products))),
+    ]
+    if rng.random() < promo_share:
+        steps.append(('promo', factory.message(chat_id, user_id, SIM_PROMO_CODE)))
+    else:
+        steps.append(('skip_promo', factory.callback(chat_id, user_id, 'skip_promo')))
+    steps.append(('name', factory.message(chat_id, user_id, f"Виртуальный Покупатель {index}")))
+    steps.append(('email', factory.message(chat_id, user_id, f"sim{index}@example.com")))
+
+    if rng.random() < abandon_share:
+        steps.append(('cancel', factory.callback(chat_id, user_id, 'pay_cancel')))
+        return steps
+
+    steps.append(('pay_start', factory.callback(chat_id, user_id, 'pay_start')))
+    steps.append(('paid_confirmed', factory.callback(chat_id, user_id, 'paid_confirmed')))
+    return steps
+
+
+def scanner_login_script(factory: UpdateFactory, scanner: int) -> list:
+    """Вход сканера в админку и включение режима сканирования."""
+    chat_id = SCANNER_CHAT_BASE - scanner
+    return [
+        ('admin', factory.message(chat_id, SIM_ADMIN_ID, '/admin')),
+        ('admin_password', factory.message(chat_id, SIM_ADMIN_ID, SIM_ADMIN_PASSWORD)),
+        ('scan_mode', factory.callback(chat_id, SIM_ADMIN_ID, 'menu_scan_mode')),
+    ]
+
+
+class Recorder:
+    """Собирает задержки и количество вызовов БД/Bot API по шагам."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.calls = {}
+        self.failures = 0
+
+    async def run_step(self, application, step: str, update_json: dict) -> None:
+        from telegram import Update
+        from metrics import call_counter
+
+        counter = {}
+        call_counter.set(counter)
+        update = Update.de_json(data=update_json, bot=application.bot)
+        started = time.perf_counter()
+        try:
+            await application.process_update(update)
+        except Exception:
+            self.failures += 1
+        self.latencies.setdefault(step, []).append(time.perf_counter() - started)
+        totals = self.calls.setdefault(step, {})
+        for kind, n in counter.items():
+            totals[kind] = totals.get(kind, 0) + n
+
+    def report(self) -> dict:
+        steps = {}
+        for step, timings in sorted(self.latencies.items()):
+            calls = self.calls.get(step, {})
+            steps[step] = dict(
+                summarize_latencies(timings),
+                db_calls_per_update=round(calls.get('db', 0) / len(timings), 2),
+                api_calls_per_update=round(calls.get('telegram', 0) / len(timings), 2),
+            )
+        return steps
+
+
+def db_call_totals() -> dict:
+    """Текущее количество вызовов каждой функции db_utils (по реестру metrics)."""
+    from metrics import snapshot
+    return {row['name']: row['count'] for row in snapshot() if row['kind'] == 'db'}
+
+
+def seed_database() -> list:
+    """Создает таблицы, тестовый промокод и возвращает названия тарифов."""
+    from db_utils import create_tables, get_all_products, find_promo, add_promocode
+
+    create_tables()
+    if not find_promo(SIM_PROMO_CODE):
+        add_promocode(SIM_PROMO_CODE, 10)
+    products = get_all_products()
+    if not products:
+        sys.exit("Нет тарифов в БД: проверьте --database-url.")
+    return [p['name'] for p in products]
+
+
+async def run_buyers(application, recorder: Recorder, scripts: list, concurrency: int) -> None:
+    """Прогоняет сценарии покупателей: каждый сценарий последовательно, сценарии — параллельно."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(script):
+        async with semaphore:
+            for step, update_json in script:
+                await recorder.run_step(application, step, update_json)
+
+    await asyncio.gather(*(run_one(script) for script in scripts))
+
+
+async def run_scanners(application, recorder: Recorder, factory: UpdateFactory, ticket_ids: list,
+                       scanners: int, rng: random.Random, invalid_share: float) -> None:
+    """Сканеры на входе: каждый в своем чате проходит вход в админку и сканирует свою часть билетов."""
+    async def run_one(scanner: int, tickets: list):
+        for step, update_json in scanner_login_script(factory, scanner):
+            await recorder.run_step(application, step, update_json)
+        chat_id = SCANNER_CHAT_BASE - scanner
+        for ticket_id in tickets:
+            if rng.random() < invalid_share:
+                ticket_id = f"{rng.getrandbits(48):012X}"
+            update_json = factory.message(chat_id, SIM_ADMIN_ID, ticket_id)
+            await recorder.run_step(application, 'scan', update_json)
+
+    await asyncio.gather(*(run_one(s, ticket_ids[s::scanners]) for s in range(scanners)))
+
+
+async def simulate(args) -> dict:
+    from bot import setup_application
+    from benchmarks.stub_bot_api import StubRequest
+    from db_utils import approve_pending_payments, get_pending_payments_page
+    from user_handlers import new_ticket_id
+
+    rng = random.Random(args.seed)
+    factory = UpdateFactory()
+    products = seed_database()
+
+    stub = StubRequest(latency=args.api_latency_ms / 1000)
+    application = setup_application(SIM_TOKEN, request=stub)
+    await application.initialize()
+
+    recorder = Recorder()
+    scripts = [buyer_script(factory, i, products, rng, args.promo_share, args.abandon_share)
+               for i in range(args.buyers)]
+
+    # Прогрев: кэш каталога, ленивые импорты, первые соединения — вне замера памяти
+    await run_buyers(application, Recorder(), scripts[:args.warmup], args.concurrency)
+    scripts = scripts[args.warmup:]
+
+    tracemalloc.start(args.trace_frames)
+    memory_before = tracemalloc.take_snapshot()
+    db_before = db_call_totals()
+
+    started = time.perf_counter()
+    await run_buyers(application, recorder, scripts, args.concurrency)
+    buyers_seconds = time.perf_counter() - started
+
+    # Подтверждение накопившихся оплат (как пакетная выдача из админки), затем сканирование на входе
+    ticket_ids = []
+    while True:
+        page = get_pending_payments_page(None, 500)
+        if not page or not page[0]:
+            break
+        approved = approve_pending_payments({p['payment_ref']: new_ticket_id() for p in page[0]})
+        if not approved:
+            break
+        ticket_ids.extend(p['ticket_id'] for p in approved)
+
+    scan_started = time.perf_counter()
+    if args.scanners and ticket_ids:
+        await run_scanners(application, recorder, factory, ticket_ids, args.scanners, rng, args.invalid_scan_share)
+    scan_seconds = time.perf_counter() - scan_started
+
+    memory_after = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    db_after = db_call_totals()
+
+    await application.shutdown()
+
+    steps = recorder.report()
+    updates = sum(step['count'] for step in steps.values())
+    growth = memory_after.compare_to(memory_before, 'lineno')
+    db_calls = {name: db_after.get(name, 0) - db_before.get(name, 0) for name in db_after}
+
+    return {
+        'benchmark': 'load_sim',
+        'seed': args.seed,
+        'buyers': len(scripts),
+        'concurrency': args.concurrency,
+        'scanners': args.scanners,
+        'api_latency_ms': args.api_latency_ms,
+        'throughput': {
+            'updates': updates,
+            'failed_updates': recorder.failures,
+            'buyer_phase_seconds': round(buyers_seconds, 3),
+            'buyers_per_second': round(len(scripts) / buyers_seconds, 1) if buyers_seconds else 0.0,
+            'scan_phase_seconds': round(scan_seconds, 3),
+            'scans_per_second': round(steps.get('scan', {}).get('count', 0) / scan_seconds, 1) if scan_seconds else 0.0,
+            'tickets_issued': len(ticket_ids),
+        },
+        'steps': steps,
+        'db': {
+            'total_calls': sum(db_calls.values()),
+            'calls_per_buyer': round(sum(db_calls.values()) / len(scripts), 2) if scripts else 0.0,
+            'by_function': {name: n for name, n in sorted(db_calls.items(), key=lambda kv: -kv[1]) if n},
+        },
+        'bot_api_calls': dict(sorted(stub.calls.items())),
+        'memory': {
+            'traced_current_kb': round(current / 1024, 1),
+            'traced_peak_kb': round(peak / 1024, 1),
+            'growth_kb': round(sum(stat.size_diff for stat in growth) / 1024, 1),
+            'top_growth': [
+                {'where': str(stat.traceback[0]), 'size_diff_kb': round(stat.size_diff / 1024, 1),
+                 'count_diff': stat.count_diff}
+                for stat in growth[:args.top_allocations]
+            ],
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сквозной нагрузочный симулятор бота")
+    parser.add_argument('--database-url', required=True, help="Локальная тестовая БД (будет изменена!)")
+    parser.add_argument('--buyers', type=int, default=1000, help="Количество виртуальных покупателей")
+    parser.add_argument('--concurrency', type=int, default=100, help="Одновременно активных покупателей")
+    parser.add_argument('--warmup', type=int, default=20, help="Покупателей в прогреве (не входят в отчет)")
+    parser.add_argument('--scanners', type=int, default=2, help="Параллельных сканеров на входе (0 — без сканов)")
+    parser.add_argument('--promo-share', type=float, default=0.3, help="Доля покупателей с промокодом")
+    parser.add_argument('--abandon-share', type=float, default=0.1, help="Доля покупателей, отменивших оплату")
+    parser.add_argument('--invalid-scan-share', type=float, default=0.05, help="Доля сканов несуществующих билетов")
+    parser.add_argument('--api-latency-ms', type=float, default=0.0, help="Искусственная задержка Bot API")
+    parser.add_argument('--trace-frames', type=int, default=1, help="Глубина стека tracemalloc")
+    parser.add_argument('--top-allocations', type=int, default=10, help="Сколько мест роста памяти показать")
+    parser.add_argument('--seed', type=int, default=2024, help="Seed генератора сценариев")
+    parser.add_argument('--verbose', action='store_true', help="Не приглушать логи бота")
+    parser.add_argument('--out', default=None, help="Путь для JSON с результатами")
+    args = parser.parse_args()
+
+    # Окружение задается до импорта модулей бота: они читают его при импорте
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ['TELEGRAM_TOKEN'] = SIM_TOKEN
+    os.environ['ADMIN_ID'] = str(SIM_ADMIN_ID)
+    os.environ['ADMIN_PASSWORD'] = SIM_ADMIN_PASSWORD
+
+    import logging
+    import bot  # noqa: F401 — настраивает логирование
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    write_results(args.out, asyncio.run(simulate(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# benchmarks/qr_corpus.py
+#
+# Синтетический корпус "фотографий" билетов для бенчмарка сканирования:
+# отрендеренный QR на листе бумаги с поворотом, размытием, перспективой,
+# изменением разрешения и JPEG-сжатием. Корпус детерминирован по seed.
+
+import io
+import random
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from qr_render import render_qr_png
+
+# Виды искажений; 'photo' — все искажения сразу, как у реального снимка телефоном
+DISTORTIONS = ('clean', 'rotation', 'blur', 'jpeg', 'perspective', 'resolution', 'photo')
+
+
+def perspective_coeffs(src: list, dst: list) -> list:
+    """Коэффициенты для Image.transform(PERSPECTIVE), переводящие точки dst в src."""
+    rows = []
+    for (x, y), (u, v) in zip(dst, src):
+        rows.append([x, y, 1, 0, 0, 0, -u * x, -u * y])
+        rows.append([0, 0, 0, x, y, 1, -v * x, -v * y])
+    a = np.array(rows, dtype=float)
+    b = np.array(src, dtype=float).reshape(8)
+    return np.linalg.solve(a, b).tolist()
+
+
+def place_on_paper(qr: Image.Image, rng: random.Random) -> Image.Image:
+    """Кладет QR на светло-серый "лист" со случайным отступом."""
+    margin = rng.randint(qr.width // 6, qr.width // 2)
+    shade = rng.randint(200, 245)
+    paper = Image.new('L', (qr.width + 2 * margin, qr.height + 2 * margin), color=shade)
+    paper.paste(qr, (margin, margin))
+    return paper
+
+
+def rotate(image: Image.Image, rng: random.Random) -> Image.Image:
+    return image.rotate(rng.uniform(-35, 35), resample=Image.BILINEAR, expand=True, fillcolor=225)
+
+
+def blur(image: Image.Image, rng: random.Random) -> Image.Image:
+    return image.filter(ImageFilter.GaussianBlur(radius=rng.uniform(0.5, 2.5)))
+
+
+def perspective(image: Image.Image, rng: random.Random) -> Image.Image:
+    w, h = image.size
+    jitter = 0.15
+    src = [(0, 0), (w, 0), (w, h), (0, h)]
+    dst = [(x + rng.uniform(-jitter, jitter) * w, y + rng.uniform(-jitter, jitter) * h) for x, y in src]
+    return image.transform((w, h), Image.PERSPECTIVE, perspective_coeffs(src, dst),
+                           resample=Image.BILINEAR, fillcolor=225)
+
+
+def rescale(image: Image.Image, rng: random.Random) -> Image.Image:
+    scale = rng.uniform(0.35, 1.6)
+    size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+    return image.resize(size, Image.BILINEAR)
+
+
+def encode_jpeg(image: Image.Image, quality: int) -> bytes:
+    bio = io.BytesIO()
+    image.convert('RGB').save(bio, 'JPEG', quality=quality)
+    return bio.getvalue()
+
+
+def make_sample(ticket_id: str, distortion: str, rng: random.Random) -> bytes:
+    """Строит один снимок билета с заданным искажением и возвращает JPEG."""
+    qr = Image.open(io.BytesIO(render_qr_png(ticket_id))).convert('L')
+    image = place_on_paper(qr, rng)
+    quality = 92
+
+    if distortion == 'rotation':
+        image = rotate(image, rng)
+    elif distortion == 'blur':
+        image = blur(image, rng)
+    elif distortion == 'jpeg':
+        quality = rng.randint(15, 60)
+    elif distortion == 'perspective':
+        image = perspective(image, rng)
+    elif distortion == 'resolution':
+        image = rescale(image, rng)
+    elif distortion == 'photo':
+        image = blur(rescale(perspective(rotate(image, rng), rng), rng), rng)
+        quality = rng.randint(40, 85)
+
+    return encode_jpeg(image, quality)
+
+
+def generate_corpus(ticket_ids: list, seed: int = 0) -> list:
+    """Возвращает список (ticket_id, distortion, jpeg_bytes): каждый билет в каждом варианте искажения."""
+    rng = random.Random(seed)
+    return [(ticket_id, distortion, make_sample(ticket_id, distortion, rng))
+            for ticket_id in ticket_ids
+            for distortion in DISTORTIONS]
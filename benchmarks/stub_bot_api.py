@@ -0,0 +1,72 @@
+# benchmarks/stub_bot_api.py
+#
+# Заглушка транспорта Bot API для нагрузочного симулятора: отвечает на вызовы
+# (getMe, sendMessage, editMessageText, sendPhoto, ...) локально, без сети,
+# с необязательной искусственной задержкой. Передается в setup_application(request=...).
+
+import json
+import time
+import asyncio
+import itertools
+
+from telegram.request import BaseRequest
+
+BOT_USER = {
+    'id': 100000001, 'is_bot': True, 'first_name': 'ReadyToDie Sim', 'username': 'readytodie_sim_bot',
+    'can_join_groups': False, 'can_read_all_group_messages': False, 'supports_inline_queries': False,
+}
+
+# Методы, которые возвращают Message; остальные возвращают True
+MESSAGE_METHODS = {'sendMessage', 'sendPhoto', 'sendDocument', 'editMessageText', 'editMessageReplyMarkup',
+                   'editMessageCaption'}
+
+
+class StubRequest(BaseRequest):
+    """Отвечает на вызовы Bot API без сети и считает их по методам."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = {}
+        self.message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def build_result(self, method: str, params: dict):
+        if method == 'getMe':
+            return BOT_USER
+        if method in MESSAGE_METHODS:
+            chat_id = params.get('chat_id', 0)
+            message = {
+                'message_id': params.get('message_id') or next(self.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private' if int(chat_id) > 0 else 'group'},
+                'from': BOT_USER,
+            }
+            if method == 'sendPhoto':
+                message['photo'] = [{'file_id': 'sim-photo', 'file_unique_id': 'sim-photo',
+                                     'width': 290, 'height': 290}]
+                message['caption'] = params.get('caption', '')
+            else:
+                message['text'] = params.get('text', '')
+            return message
+        return True
+
+    async def do_request(self, url: str, method: str, request_data=None,
+                         read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE,
+                         connect_timeout=BaseRequest.DEFAULT_NONE, pool_timeout=BaseRequest.DEFAULT_NONE):
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        params = request_data.parameters if request_data is not None else {}
+        body = {'ok': True, 'result': self.build_result(api_method, params)}
+        return 200, json.dumps(body).encode('utf-8')
@@ -1,22 +1,18 @@
 # bot.py
 
 import os
+import json
+import queue
+import random
+import atexit
 import logging
 import sys
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv
 from telegram import Update, BotCommand, ReplyKeyboardRemove
-from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler
-from datetime import datetime
-
-# --- Настройка логирования для Serverless-окружения ---
-# Удаляем логику FileHandler, т.к. на Vercel нет локальной ФС.
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler, \
+    TypeHandler
+from telegram.request import BaseRequest, HTTPXRequest
 
 # --- Загрузка переменных окружения ---
 # load_dotenv() оставлен для локального тестирования
@@ -24,39 +20,144 @@ load_dotenv()
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 ADMIN_ID = os.getenv("ADMIN_ID")
 
+# Формат логов: 'json' (структурированный, по умолчанию) или 'text'
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Доля логируемых обновлений по типам (1.0 — все, 0.1 — каждое десятое); команды логируются всегда
+LOG_SAMPLE_RATES = {
+    'command': 1.0,
+    'message': float(os.getenv("LOG_SAMPLE_MESSAGES", "1.0")),
+    'photo': float(os.getenv("LOG_SAMPLE_PHOTOS", "1.0")),
+    'callback': float(os.getenv("LOG_SAMPLE_CALLBACKS", "1.0")),
+}
+
+
+# --- Настройка логирования для Serverless-окружения ---
+# Удаляем логику FileHandler, т.к. на Vercel нет локальной ФС.
+# Хендлеры только кладут запись в очередь; форматирование и запись в stdout
+# выполняет фоновый поток QueueListener, поэтому обработка апдейта не ждет вывода.
+
+class LazyQueueHandler(QueueHandler):
+    """QueueHandler без предварительного форматирования: msg % args выполняется в потоке слушателя."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class StructuredFormatter(logging.Formatter):
+    """Одна JSON-строка на запись; дополнительные поля передаются через extra={'fields': {...}}."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# Слушатель очереди логов (нужен flush_logs)
+logging_state = {'listener': None, 'running': False}
+
+
+def setup_logging() -> None:
+    """Настраивает неблокирующее логирование: корневой логгер -> очередь -> поток -> stdout."""
+    root = logging.getLogger()
+    if any(isinstance(h, LazyQueueHandler) for h in root.handlers):
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        stream_handler.setFormatter(StructuredFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    logging_state['listener'] = listener
+    logging_state['running'] = True
+    # При завершении процесса слушатель дописывает оставшиеся записи
+    atexit.register(flush_logs, restart=False)
+
+    root.setLevel(logging.INFO)
+    root.addHandler(LazyQueueHandler(log_queue))
+
+
+def flush_logs(restart: bool = True) -> None:
+    """
+    Дописывает в stdout все записи из очереди. На Vercel вызывается перед возвратом ответа:
+    после него инстанс замораживается, а atexit при его утилизации не выполняется.
+    """
+    if not logging_state['running']:
+        return
+    # stop() ставит в очередь маркер и ждет, пока поток запишет все, что было до него
+    logging_state['listener'].stop()
+    logging_state['running'] = restart
+    if restart:
+        logging_state['listener'].start()
+
+
+setup_logging()
+update_logger = logging.getLogger("updates")
+
 if not TOKEN:
     logging.critical("TELEGRAM_TOKEN не найден. Проверьте файл .env")
     # В режиме Vercel sys.exit(1) не нужен, но оставлен для ясности.
 
 # --- Абсолютные импорты ---
-from db_utils import create_tables
+from db_utils import create_tables, get_sales_rollup
 from user_handlers import buy_conv_handler, start_buy
-from admin_handlers import admin_conv_handler, issue_ticket_from_admin_notification
+from admin_handlers import admin_conv_handler, issue_ticket_from_admin_notification, format_sales_stats, \
+    genpromo_command, staff_command, duty_command
 from utils import cancel_global
+from rate_limit import throttle_updates
+from admin_roles import get_admin_role, has_permission
+from live_counters import get_live_counters, format_live_counters
+from metrics import InstrumentedRequest, instrument_application, install_error_counter, render_text
 
 
 # --- Хелперы ---
 
 async def log_updates_and_actions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Логирует все обновления и нажатия кнопок (для отладки)."""
+    """Логирует все обновления и нажатия кнопок (для отладки) с выборкой по типам."""
     # Этот хендлер будет работать и на Vercel, записывая логи в CloudWatch/Vercel Logs
-    log_message = f"[{datetime.now().strftime('%H:%M:%S')}] "
+    if not update_logger.isEnabledFor(logging.INFO):
+        return
 
     if update.message:
-        user = update.message.from_user
-        chat_id = update.message.chat_id
-        text = update.message.text
-
-        log_message += f"MSG | Chat:{chat_id} | User:{user.first_name} ({user.id}) | Text: '{text}'"
+        message = update.message
+        if message.text and message.text.startswith('/'):
+            kind = 'command'
+        elif message.photo:
+            kind = 'photo'
+        else:
+            kind = 'message'
+        user = message.from_user
+        chat_id = message.chat_id
+        payload = message.text
 
     elif update.callback_query:
+        kind = 'callback'
         user = update.callback_query.from_user
-        chat_id = update.callback_query.message.chat_id
-        data = update.callback_query.data
+        chat_id = update.callback_query.message.chat_id if update.callback_query.message else None
+        payload = update.callback_query.data
 
-        log_message += f"CBQ | Chat:{chat_id} | User:{user.first_name} ({user.id}) | Data: '{data}'"
+    else:
+        return
 
-    logging.info(log_message)
+    rate = LOG_SAMPLE_RATES.get(kind, 1.0)
+    if rate < 1.0 and random.random() >= rate:
+        return
+
+    # Аргументы передаются отдельно: строка собирается только в потоке слушателя
+    update_logger.info(
+        "%s | Chat:%s | User:%s (%s) | %r", kind.upper(), chat_id, user.first_name, user.id, payload,
+        extra={'fields': {'kind': kind, 'chat_id': chat_id, 'user_id': user.id, 'sample_rate': rate}}
+    )
 
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -67,7 +168,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         "Я бот для продажи билетов. Чтобы начать покупку, используй команду /buy."
     )
 
-    if str(user.id) == ADMIN_ID:
+    if get_admin_role(user.id) is not None:
         welcome_message += "\n\n🔑 **Режим Администратора**: используй /admin для доступа к меню управления."
 
     await update.message.reply_text(
@@ -77,6 +178,30 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     )
 
 
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обрабатывает команду /metrics: задержки хендлеров, запросов к БД и вызовов Bot API."""
+    if not has_permission(update.effective_user.id, 'manage'):
+        return
+
+    await update.message.reply_html(render_text())
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обрабатывает команду /stats: продажи, выручка и входы по тарифам и дням (одно чтение sales_daily)."""
+    if not has_permission(update.effective_user.id, 'manage'):
+        return
+
+    await update.message.reply_html(format_sales_stats(get_sales_rollup()))
+
+
+async def live_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обрабатывает команду /live: сколько гостей уже вошло (по тарифам), из кэша счетчиков."""
+    if not has_permission(update.effective_user.id, 'scan'):
+        return
+
+    await update.message.reply_html(format_live_counters(get_live_counters()))
+
+
 async def set_bot_commands(application: Application) -> None:
     """
     Устанавливает меню команд бота.
@@ -97,16 +222,22 @@ async def set_bot_commands(application: Application) -> None:
 
 
 # --- ФУНКЦИЯ ИНИЦИАЛИЗАЦИИ ДЛЯ WEBHOOK ---
-def setup_application(token: str) -> Application:
+def setup_application(token: str, request: BaseRequest | None = None) -> Application:
     """
     Создает и настраивает экземпляр Application для Webhook.
-    Используется в api/webhook.py.
+    Используется в api/webhook.py; request позволяет подменить транспорт Bot API
+    (например, заглушкой в нагрузочном симуляторе benchmarks/load_sim.py).
     """
     # 1. Создание Application
-    application = Application.builder().token(token).build()
+    # Все исходящие вызовы Bot API идут через InstrumentedRequest (замер задержек для /metrics)
+    request = InstrumentedRequest(request or HTTPXRequest(connection_pool_size=8))
+    application = Application.builder().token(token).request(request).build()
 
     # 2. Добавление обработчиков
 
+    # ОГРАНИЧЕНИЕ ЧАСТОТЫ: апдейты сверх лимита отбрасываются до всех остальных групп
+    application.add_handler(TypeHandler(Update, throttle_updates), group=-3)
+
     # ХЕНДЛЕРЫ ЛОГИРОВАНИЯ
     application.add_handler(CallbackQueryHandler(log_updates_and_actions), group=-2)
     application.add_handler(MessageHandler(filters.ALL, log_updates_and_actions), group=-1)
@@ -114,13 +245,23 @@ def setup_application(token: str) -> Application:
     # Основные команды
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("cancel", cancel_global))
+    application.add_handler(CommandHandler("metrics", metrics_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("live", live_command))
+    application.add_handler(CommandHandler("genpromo", genpromo_command))
+    application.add_handler(CommandHandler("staff", staff_command))
+    application.add_handler(CommandHandler("duty", duty_command))
 
     # Диалоги
     application.add_handler(buy_conv_handler)
     application.add_handler(admin_conv_handler)
 
     # ГЛОБАЛЬНЫЙ ХЕНДЛЕР для выдачи билета из уведомления
-    application.add_handler(CallbackQueryHandler(issue_ticket_from_admin_notification, pattern=r'^issue_ticket_'))
+    application.add_handler(CallbackQueryHandler(issue_ticket_from_admin_notification, pattern=r'^(issue|reject)_ticket_'))
+
+    # 3. Инструментирование: замер всех зарегистрированных хендлеров и подсчет залогированных ошибок
+    instrument_application(application)
+    install_error_counter()
 
     return application
 
@@ -0,0 +1,114 @@
+# catalog_cache.py
+
+import os
+import time
+import logging
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# Абсолютные импорты
+from db_utils import get_all_products, get_inventory
+from utils import escape_html
+from versioned_cache import new_cache_state, bump_version, is_current_version, is_fresh, store
+
+# Цены и описания меняются редко и только из админки; за этот срок смена цены в другом инстансе
+# доходит до витрины (сама оплата берет цену из основной БД, см. product_selected)
+CATALOG_CACHE_TTL = int(os.getenv("CATALOG_CACHE_TTL", "300"))
+# Как часто перечитываются счетчики лимитов (между перечитываниями остатки
+# обновляются локально по результатам reserve_product/release_reservation)
+STOCK_CACHE_TTL = int(os.getenv("STOCK_CACHE_TTL", "15"))
+
+# Версия каталога и последнее собранное представление (value); built_stock — остатки, с которыми оно собрано
+catalog_state = new_cache_state(built_stock=None)
+# Кэш остатков: {product_id: remaining} для тарифов с лимитом
+stock_state = {'stock': {}, 'fetched_at': None}
+
+
+def bump_catalog_version() -> int:
+    """Инвалидирует готовые тексты и клавиатуры (вызывается после изменения цен)."""
+    return bump_version(catalog_state)
+
+
+def update_cached_stock(product_id: int, remaining: int | None) -> None:
+    """Обновляет локальный остаток тарифа по результату резерва/отмены (без запроса к БД)."""
+    if remaining is not None:
+        stock_state['stock'][product_id] = remaining
+
+
+def invalidate_stock() -> None:
+    """Заставляет перечитать счетчики лимитов при следующем обращении (после смены лимита)."""
+    stock_state['fetched_at'] = None
+
+
+def get_cached_stock() -> dict:
+    """Остатки по тарифам с лимитом; БД читается не чаще раза в STOCK_CACHE_TTL секунд."""
+    now = time.monotonic()
+    if stock_state['fetched_at'] is None or now - stock_state['fetched_at'] >= STOCK_CACHE_TTL:
+        inventory = get_inventory()
+        if inventory is not None:
+            stock_state['stock'] = {product_id: row['remaining'] for product_id, row in inventory.items()}
+        stock_state['fetched_at'] = now
+    return stock_state['stock']
+
+
+def build_catalog_view(products: list, stock: dict | None = None) -> dict:
+    """Собирает готовые к отправке тексты и клавиатуры каталога из списка тарифов."""
+    stock = stock or {}
+    text = "Выберите желаемый тариф:\n\n"
+    buy_keyboard = []
+    edit_price_keyboard = []
+    issue_keyboard = []
+
+    for p in products:
+        remaining = stock.get(p['id'])
+        text += f"<b>{escape_html(p['name'])}</b> - {p['price']} ₽\n"
+        text += f"<i>{escape_html(p['description'])}</i>\n"
+        if remaining is not None:
+            text += f"Осталось: {remaining}\n" if remaining > 0 else "🚫 Распродано\n"
+        text += "\n"
+        if remaining is None or remaining > 0:
+            buy_keyboard.append([InlineKeyboardButton(f"🎫 {p['name']} ({p['price']} ₽)", callback_data=p['name'])])
+        edit_price_keyboard.append(
+            [InlineKeyboardButton(f"{p['name']} ({p['price']} ₽)", callback_data=f"editprice_{p['id']}")])
+        issue_keyboard.append(
+            [InlineKeyboardButton(f"{p['name']} ({p['price']} ₽)", callback_data=f"issue_product_{p['id']}")])
+
+    buy_keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data='pay_cancel')])
+    edit_price_keyboard.append([InlineKeyboardButton("🔙 В главное меню", callback_data="menu_main")])
+    issue_keyboard.append([InlineKeyboardButton("🔙 В главное меню", callback_data="menu_main")])
+
+    return {
+        'products': products,
+        'products_by_name': {p['name']: p for p in products},
+        'products_by_id': {p['id']: p for p in products},
+        'buy_text': text,
+        'buy_markup': InlineKeyboardMarkup(buy_keyboard),
+        'edit_price_markup': InlineKeyboardMarkup(edit_price_keyboard),
+        'issue_markup': InlineKeyboardMarkup(issue_keyboard),
+    }
+
+
+def get_catalog_view() -> dict | None:
+    """
+    Возвращает закэшированное представление каталога.
+    Тарифы читаются из БД только при смене версии или по истечении CATALOG_CACHE_TTL;
+    текст пересобирается, если изменились остатки в кэше лимитов.
+    """
+    now = time.monotonic()
+    stock = dict(get_cached_stock())
+    if is_fresh(catalog_state, CATALOG_CACHE_TTL, now):
+        if catalog_state['built_stock'] != stock:
+            catalog_state['value'] = build_catalog_view(catalog_state['value']['products'], stock)
+            catalog_state['built_stock'] = stock
+        return catalog_state['value']
+
+    # После смены цены в этом процессе (новая версия) читаем основную БД: реплика может отставать.
+    # Плановое обновление по CATALOG_CACHE_TTL читает реплику
+    products = get_all_products(allow_stale=is_current_version(catalog_state))
+    if not products:
+        # Пустой список может означать ошибку БД — такой результат не кэшируем
+        return None
+
+    store(catalog_state, build_catalog_view(products, stock), now)
+    catalog_state['built_stock'] = stock
+    logging.info(f"Каталог пересобран (версия {catalog_state['version']}, тарифов: {len(products)}).")
+    return catalog_state['value']
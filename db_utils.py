@@ -1,22 +1,70 @@
 # db_utils.py
 
+import io
 import os
+import time
+import uuid
+import random
 import logging
 import psycopg2
-from datetime import datetime
+from psycopg2.extras import execute_values
+from datetime import datetime, date
 from dotenv import load_dotenv
 
+from metrics import instrument_functions
+
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Реплики только для чтения (через запятую). Каталог, промокоды и проверка статуса билета читаются с них,
+# записи и чтение сразу после записи идут в DATABASE_URL. Без реплик все запросы идут в основную БД
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+# Таймаут подключения к реплике (с) и на сколько секунд недоступная реплика исключается из ротации
+REPLICA_CONNECT_TIMEOUT = int(os.getenv("REPLICA_CONNECT_TIMEOUT", "3"))
+REPLICA_RETRY_SECONDS = int(os.getenv("REPLICA_RETRY_SECONDS", "30"))
+# На сколько строк-слотов делится счетчик использований промокода (меньше конкуренции за одну строку)
+PROMO_SLOT_COUNT = int(os.getenv("PROMO_SLOT_COUNT", "8"))
+# Ставить ли билеты в очередь email_outbox (по умолчанию — если настроен SMTP, см. email_sender.py)
+EMAIL_OUTBOX_ENABLED = os.getenv("EMAIL_OUTBOX_ENABLED", "1" if os.getenv("SMTP_HOST") else "0") == "1"
+# Сколько попыток отправки письма до статуса 'failed' и базовая пауза между ними (растет вдвое)
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "5"))
+EMAIL_RETRY_BASE_SECONDS = int(os.getenv("EMAIL_RETRY_BASE_SECONDS", "60"))
+# Билеты секционированы по месяцам purchase_date. Поиск по ID сначала идет только по секциям
+# за последние TICKET_HOT_DAYS дней (билеты ближайшего мероприятия), остальные читаются при промахе
+TICKET_HOT_DAYS = int(os.getenv("TICKET_HOT_DAYS", "120"))
+# На сколько месяцев вперед заранее создаются секции (при каждом холодном старте)
+TICKET_PARTITION_MONTHS_AHEAD = int(os.getenv("TICKET_PARTITION_MONTHS_AHEAD", "2"))
 if not DATABASE_URL:
     logging.warning("DATABASE_URL не задан в окружении.")
 
 
 # --- БАЗОВЫЕ ФУНКЦИИ ---
 
-def connect_db():
-    """Устанавливает соединение с PostgreSQL."""
+# Очередь реплик (случайный старт, чтобы инстансы не начинали с одной и той же)
+# и время, до которого реплика считается недоступной: {индекс реплики: time.monotonic()}
+replica_state = {'next': random.randrange(1 << 16), 'down_until': {}}
+
+
+def connect_db(read_only: bool = False):
+    """
+    Устанавливает соединение с PostgreSQL.
+    read_only=True — с очередной доступной репликой по кругу; если реплик нет или все недоступны,
+    с основной БД. Реплика, к которой не удалось подключиться, пропускается REPLICA_RETRY_SECONDS секунд.
+    """
+    if read_only and DATABASE_REPLICA_URLS:
+        now = time.monotonic()
+        count = len(DATABASE_REPLICA_URLS)
+        start = replica_state['next']
+        replica_state['next'] += 1
+        for offset in range(count):
+            index = (start + offset) % count
+            if replica_state['down_until'].get(index, 0) > now:
+                continue
+            try:
+                return psycopg2.connect(DATABASE_REPLICA_URLS[index], connect_timeout=REPLICA_CONNECT_TIMEOUT)
+            except Exception as e:
+                replica_state['down_until'][index] = now + REPLICA_RETRY_SECONDS
+                logging.warning(f"Реплика #{index} недоступна, пропускается {REPLICA_RETRY_SECONDS} с: {e}")
     try:
         conn = psycopg2.connect(DATABASE_URL)
         return conn
@@ -25,6 +73,14 @@ def connect_db():
         return None
 
 
+def retry_on_primary(error: Exception, allow_stale: bool) -> bool:
+    """
+    Нужно ли повторить чтение в основной БД: запрос с реплики прерван на уровне соединения
+    или сервера (OperationalError — обрыв, отмена из-за конфликта с восстановлением реплики).
+    """
+    return allow_stale and bool(DATABASE_REPLICA_URLS) and isinstance(error, psycopg2.OperationalError)
+
+
 def create_tables():
     """Создает необходимые таблицы (tickets, products, promocodes)."""
     conn = connect_db()
@@ -33,17 +89,21 @@ def create_tables():
     cursor = conn.cursor()
 
     # ИЗМЕНЕНИЕ: Добавлено buyer_chat_id
+    # Новая БД сразу создается секционированной по месяцам purchase_date (секции — ensure_ticket_partitions);
+    # существующая несекционированная таблица переводится командой: python ticket_archive.py migrate
     create_ticket_table_query = """
             CREATE TABLE IF NOT EXISTS tickets (
-                ticket_id VARCHAR(50) PRIMARY KEY,
+                ticket_id VARCHAR(50) NOT NULL,
                 product_name VARCHAR(50) NOT NULL, 
                 buyer_name VARCHAR(100) NOT NULL,
                 buyer_email VARCHAR(100) NOT NULL,
                 buyer_chat_id BIGINT NOT NULL,    -- <-- ДОБАВЛЕНО: Идентификатор чата покупателя
                 final_price INTEGER NOT NULL,
                 is_active BOOLEAN DEFAULT FALSE,
-                purchase_date TIMESTAMP WITHOUT TIME ZONE DEFAULT NOW()
-            );
+                purchase_date TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT NOW(),
+                activated_at TIMESTAMP WITHOUT TIME ZONE,
+                PRIMARY KEY (ticket_id, purchase_date)
+            ) PARTITION BY RANGE (purchase_date);
             """
     cursor.execute(create_ticket_table_query)
     # Таблица продуктов
@@ -75,13 +135,164 @@ def create_tables():
         );
         """
 
+    # Лимиты тарифов: taken = проданные + зарезервированные места.
+    # Тарифы без строки в этой таблице продаются без ограничений.
+    create_product_inventory_query = """
+        CREATE TABLE IF NOT EXISTS product_inventory (
+            product_id INTEGER PRIMARY KEY REFERENCES products(id) ON DELETE CASCADE,
+            capacity INTEGER NOT NULL,
+            taken INTEGER NOT NULL DEFAULT 0
+        );
+        """
+
+    # Временные резервы мест на время оформления заказа
+    create_product_reservations_query = """
+        CREATE TABLE IF NOT EXISTS product_reservations (
+            id SERIAL PRIMARY KEY,
+            product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+            chat_id BIGINT NOT NULL,
+            expires_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS product_reservations_expires_idx ON product_reservations (expires_at);
+        """
+
+    # Счетчик использований промокода, разделенный на PROMO_SLOT_COUNT строк:
+    # параллельные покупатели списывают использование из разных слотов.
+    # remaining = NULL — промокод без лимита (слоты только считают использования).
+    create_promo_slots_query = f"""
+        CREATE TABLE IF NOT EXISTS promo_redemption_slots (
+            promocode_id INTEGER REFERENCES promocodes(id) ON DELETE CASCADE,
+            slot SMALLINT NOT NULL,
+            remaining INTEGER,
+            used INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (promocode_id, slot)
+        );
+        -- Промокоды, созданные до появления слотов, получают слоты без лимита
+        INSERT INTO promo_redemption_slots (promocode_id, slot, remaining)
+        SELECT p.id, s.slot, NULL
+        FROM promocodes p CROSS JOIN generate_series(0, {PROMO_SLOT_COUNT} - 1) AS s(slot)
+        WHERE NOT EXISTS (SELECT 1 FROM promo_redemption_slots r WHERE r.promocode_id = p.id);
+        """
+
+    # Ежедневные итоги по тарифам: обновляются в тех же транзакциях, что выдача и активация билетов.
+    # При первом создании таблица заполняется из уже проданных билетов.
+    create_sales_daily_query = """
+        CREATE TABLE IF NOT EXISTS sales_daily (
+            day DATE NOT NULL,
+            product_name VARCHAR(50) NOT NULL,
+            tickets_sold INTEGER NOT NULL DEFAULT 0,
+            revenue BIGINT NOT NULL DEFAULT 0,
+            activated INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, product_name)
+        );
+        INSERT INTO sales_daily (day, product_name, tickets_sold, revenue, activated)
+        SELECT day, product_name, SUM(sold), SUM(revenue), SUM(activated)
+        FROM (
+            SELECT purchase_date::date AS day, product_name, 1 AS sold, final_price AS revenue, 0 AS activated
+            FROM tickets
+            UNION ALL
+            SELECT COALESCE(activated_at, purchase_date)::date, product_name, 0, 0, 1
+            FROM tickets WHERE is_active
+        ) t
+        WHERE NOT EXISTS (SELECT 1 FROM sales_daily)
+        GROUP BY day, product_name;
+        """
+
+    # Итоги за все время по тарифам (продано, вошло) для живого счетчика на входе:
+    # одна строка на тариф, обновляется вместе с sales_daily. Заполняется из sales_daily.
+    create_ticket_counters_query = """
+        CREATE TABLE IF NOT EXISTS ticket_counters (
+            product_name VARCHAR(50) PRIMARY KEY,
+            sold INTEGER NOT NULL DEFAULT 0,
+            activated INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT INTO ticket_counters (product_name, sold, activated)
+        SELECT product_name, SUM(tickets_sold), SUM(activated)
+        FROM sales_daily
+        WHERE NOT EXISTS (SELECT 1 FROM ticket_counters)
+        GROUP BY product_name;
+        """
+
+    # Запросы на подтверждение оплаты (вместо bot_data, который теряется при холодном старте)
+    create_pending_payments_query = """
+        CREATE TABLE IF NOT EXISTS pending_payments (
+            payment_ref VARCHAR(20) PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            buyer_name VARCHAR(100) NOT NULL,
+            buyer_email VARCHAR(100) NOT NULL,
+            product_id INTEGER NOT NULL,
+            product_name VARCHAR(50) NOT NULL,
+            final_price INTEGER NOT NULL,
+            promo_code VARCHAR(50),
+            promo_redeemed BOOLEAN NOT NULL DEFAULT FALSE,
+            reservation_id INTEGER,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',  -- pending | approved | rejected | expired
+            created_at TIMESTAMP WITHOUT TIME ZONE DEFAULT NOW(),
+            resolved_at TIMESTAMP WITHOUT TIME ZONE
+        );
+        -- Очередь ожидающих оплат листается по ключу (created_at, payment_ref)
+        DROP INDEX IF EXISTS pending_payments_status_created_idx;
+        CREATE INDEX IF NOT EXISTS pending_payments_queue_idx ON pending_payments (status, created_at, payment_ref);
+        """
+
     try:
         cursor.execute(create_ticket_table_query)
         cursor.execute(create_product_table_query)
         cursor.execute(create_promocode_table_query)
+        # Побайтовый порядок кодов: keyset-пагинация и поиск по префиксу (LIKE 'ABC%') идут по индексу
+        cursor.execute('CREATE INDEX IF NOT EXISTS promocodes_code_c_idx ON promocodes (code COLLATE "C");')
         cursor.execute(create_promocode_products_query)
+        cursor.execute(create_product_inventory_query)
+        cursor.execute(create_product_reservations_query)
+        cursor.execute(create_pending_payments_query)
+        # Лимит использований и срок действия промокодов; uses — сверенная сумма слотов
+        cursor.execute("""
+            ALTER TABLE promocodes ADD COLUMN IF NOT EXISTS max_uses INTEGER;
+            ALTER TABLE promocodes ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP WITHOUT TIME ZONE;
+            ALTER TABLE promocodes ADD COLUMN IF NOT EXISTS uses INTEGER NOT NULL DEFAULT 0;
+            """)
+        cursor.execute(create_promo_slots_query)
+        # Было ли списано использование промокода (при отмене оплаты оно возвращается)
+        cursor.execute(
+            "ALTER TABLE pending_payments ADD COLUMN IF NOT EXISTS promo_redeemed BOOLEAN NOT NULL DEFAULT FALSE;")
+        # Время первого входа: нужно для ответа "уже использован" в режиме сканирования
+        cursor.execute("ALTER TABLE tickets ADD COLUMN IF NOT EXISTS activated_at TIMESTAMP WITHOUT TIME ZONE;")
+        create_trigram_indexes(cursor)
+        # Секции билетов на текущий и следующие месяцы (для несекционированной таблицы ничего не делает)
+        ensure_ticket_partitions(cursor)
+        cursor.execute(create_ticket_ids_query)
+        # Итоги заполняются из tickets, поэтому создаются после всех миграций tickets
+        cursor.execute(create_sales_daily_query)
+        cursor.execute(create_ticket_counters_query)
+        # Очередь писем с билетами: строка ставится в той же транзакции, что и билет,
+        # и разбирается dispatch_email_batch с повторами по next_attempt_at
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS email_outbox (
+                id BIGSERIAL PRIMARY KEY,
+                ticket_id VARCHAR(50) UNIQUE NOT NULL,
+                email VARCHAR(100) NOT NULL,
+                buyer_name VARCHAR(100) NOT NULL,
+                product_name VARCHAR(50) NOT NULL,
+                status VARCHAR(10) NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT NOW(),
+                last_error TEXT,
+                created_at TIMESTAMP WITHOUT TIME ZONE DEFAULT NOW(),
+                sent_at TIMESTAMP WITHOUT TIME ZONE
+            );
+            -- Частичный индекс: отправитель читает только ожидающие письма
+            CREATE INDEX IF NOT EXISTS email_outbox_due_idx ON email_outbox (next_attempt_at) WHERE status = 'pending';
+            -- Сотрудники и их роли; главный администратор из ADMIN_ID в таблицу не записывается
+            CREATE TABLE IF NOT EXISTS admins (
+                user_id BIGINT PRIMARY KEY,
+                role VARCHAR(20) NOT NULL CHECK (role IN ('scanner', 'cashier', 'owner')),
+                name VARCHAR(100),
+                on_duty BOOLEAN NOT NULL DEFAULT TRUE,
+                added_at TIMESTAMP WITHOUT TIME ZONE DEFAULT NOW()
+            );
+            """)
         conn.commit()
-        logging.info("Все таблицы (tickets, products, promocodes) успешно созданы/обновлены.")
+        logging.info("Все таблицы (tickets, products, promocodes, inventory) успешно созданы/обновлены.")
 
         initialize_products(conn)
 
@@ -115,27 +326,30 @@ def initialize_products(conn):
     conn.commit()
 
 
-def get_all_products():
-    """Получает все доступные тарифы."""
-    conn = connect_db()
+def get_all_products(allow_stale: bool = True):
+    """Получает все доступные тарифы (allow_stale=False — с основной БД, например сразу после смены цены)."""
+    conn = connect_db(read_only=allow_stale)
     if conn is None: return []
     cursor = conn.cursor()
-    select_query = "SELECT name, description, price FROM products WHERE is_active = TRUE ORDER BY price DESC;"
+    select_query = "SELECT id, name, description, price FROM products WHERE is_active = TRUE ORDER BY price DESC;"
     try:
         cursor.execute(select_query)
         results = cursor.fetchall()
-        return [{'name': r[0], 'description': r[1], 'price': r[2]} for r in results]
+        return [{'id': r[0], 'name': r[1], 'description': r[2], 'price': r[3]} for r in results]
     except Exception as e:
-        logging.error(f"Ошибка при получении тарифов: {e}")
-        return []
+        if not retry_on_primary(e, allow_stale):
+            logging.error(f"Ошибка при получении тарифов: {e}")
+            return []
+        logging.warning(f"Ошибка при получении тарифов на реплике, повтор в основной БД: {e}")
     finally:
         cursor.close()
         conn.close()
+    return get_all_products(allow_stale=False)
 
 
-def get_product(name: str):
+def get_product(name: str, allow_stale: bool = True):
     """Получает информацию об одном тарифе."""
-    conn = connect_db()
+    conn = connect_db(read_only=allow_stale)
     if conn is None: return None
     cursor = conn.cursor()
     select_query = "SELECT id, name, description, price, is_active FROM products WHERE name = %s;"
@@ -147,11 +361,14 @@ def get_product(name: str):
                     'is_available': result[4]}
         return None
     except Exception as e:
-        logging.error(f"Ошибка при получении тарифа {name}: {e}")
-        return None
+        if not retry_on_primary(e, allow_stale):
+            logging.error(f"Ошибка при получении тарифа {name}: {e}")
+            return None
+        logging.warning(f"Ошибка при получении тарифа {name} на реплике, повтор в основной БД: {e}")
     finally:
         cursor.close()
         conn.close()
+    return get_product(name, allow_stale=False)
 
 
 def update_product_price(product_name: str, new_price: int) -> bool:
@@ -173,14 +390,15 @@ def update_product_price(product_name: str, new_price: int) -> bool:
         conn.close()
 
 
-def find_promo(code: str):
+def find_promo(code: str, allow_stale: bool = True):
     """Ищет промокод по коду и возвращает данные."""
-    conn = connect_db()
+    conn = connect_db(read_only=allow_stale)
     if conn is None: return None
     cursor = conn.cursor()
     select_query = """
     SELECT p.id, p.code, p.discount_percent, p.is_active, 
-           json_agg(pr.name) FILTER (WHERE pr.name IS NOT NULL) AS affected_products
+           json_agg(pr.name) FILTER (WHERE pr.name IS NOT NULL) AS affected_products,
+           p.expires_at
     FROM promocodes p
     LEFT JOIN promocode_products pp ON p.id = pp.promocode_id
     LEFT JOIN products pr ON pp.product_id = pr.id
@@ -193,52 +411,140 @@ def find_promo(code: str):
         if result:
             return {
                 'id': result[0], 'code': result[1], 'discount_percent': result[2],
-                'is_active': result[3], 'affected_products': result[4] if result[4] else []
+                'is_active': result[3], 'affected_products': result[4] if result[4] else [],
+                'expires_at': result[5]
             }
         return None
     except Exception as e:
-        logging.error(f"Ошибка при поиске промокода {code}: {e}")
-        return None
+        if not retry_on_primary(e, allow_stale):
+            logging.error(f"Ошибка при поиске промокода {code}: {e}")
+            return None
+        logging.warning(f"Ошибка при поиске промокода {code} на реплике, повтор в основной БД: {e}")
     finally:
         cursor.close()
         conn.close()
+    return find_promo(code, allow_stale=False)
 
 
-def get_all_promos():
-    """Получает все промокоды."""
+def get_promos_page(prefix: str = '', after_code: str | None = None, limit: int = 10):
+    """
+    Страница промокодов в порядке кода (keyset-пагинация по promocodes_code_c_idx).
+    prefix — фильтр по началу кода, after_code — последний код предыдущей страницы.
+    Возвращает (список промокодов, есть_ли_следующая_страница) или None при ошибке.
+    """
     conn = connect_db()
-    if conn is None: return []
+    if conn is None: return None
     cursor = conn.cursor()
-    select_query = "SELECT id, code, discount_percent, is_active FROM promocodes ORDER BY id DESC;"
+    # Символы шаблона LIKE в префиксе экранируются
+    pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    select_query = """
+    SELECT id, code, discount_percent, is_active, max_uses, expires_at, uses
+    FROM promocodes
+    WHERE code COLLATE "C" LIKE %s
+      AND (%s::text IS NULL OR code COLLATE "C" > %s)
+    ORDER BY code COLLATE "C"
+    LIMIT %s;
+    """
     try:
-        cursor.execute(select_query)
+        cursor.execute(select_query, (pattern, after_code, after_code, limit + 1))
         results = cursor.fetchall()
-        return [{'id': r[0], 'code': r[1], 'discount_percent': r[2], 'is_active': r[3]} for r in results]
+        promos = [{'id': r[0], 'code': r[1], 'discount_percent': r[2], 'is_active': r[3],
+                   'max_uses': r[4], 'expires_at': r[5], 'uses': r[6]} for r in results[:limit]]
+        return promos, len(results) > limit
     except Exception as e:
-        logging.error(f"Ошибка при получении промокодов: {e}")
-        return []
+        logging.error(f"Ошибка при получении страницы промокодов: {e}")
+        return None
     finally:
         cursor.close()
         conn.close()
 
 
-def add_promocode(code, discount_percent):
-    """Добавляет новый промокод."""
+def add_promocode(code, discount_percent, max_uses=None, expires_at=None):
+    """
+    Добавляет новый промокод вместе со слотами счетчика использований и возвращает его ID
+    (None при ошибке). Лимит max_uses распределяется по слотам поровну; слотов не больше,
+    чем использований, чтобы не создавать строк с нулевым остатком.
+    """
     conn = connect_db()
-    if conn is None: return False
+    if conn is None: return None
     cursor = conn.cursor()
-    insert_query = "INSERT INTO promocodes (code, discount_percent) VALUES (%s, %s);"
+    insert_query = """
+    INSERT INTO promocodes (code, discount_percent, max_uses, expires_at)
+    VALUES (%s, %s, %s, %s) RETURNING id;
+    """
+    insert_slots_query = """
+    WITH n AS (
+        SELECT GREATEST(LEAST(COALESCE(%(max_uses)s::int, %(slots)s), %(slots)s), 1) AS slots
+    )
+    INSERT INTO promo_redemption_slots (promocode_id, slot, remaining)
+    SELECT %(promo_id)s, s, CASE WHEN %(max_uses)s::int IS NULL THEN NULL
+                                 ELSE %(max_uses)s::int / n.slots
+                                      + CASE WHEN s < %(max_uses)s::int %% n.slots THEN 1 ELSE 0 END END
+    FROM n CROSS JOIN generate_series(0, n.slots - 1) AS s;
+    """
     try:
-        cursor.execute(insert_query, (code, discount_percent))
+        cursor.execute(insert_query, (code, discount_percent, max_uses, expires_at))
+        promo_id = cursor.fetchone()[0]
+        cursor.execute(insert_slots_query, {'promo_id': promo_id, 'max_uses': max_uses, 'slots': PROMO_SLOT_COUNT})
         conn.commit()
-        return True
+        return promo_id
     except psycopg2.errors.UniqueViolation:
         logging.warning(f"Промокод {code} уже существует.")
-        return False
+        conn.rollback()
+        return None
     except Exception as e:
         logging.error(f"Ошибка при добавлении промокода: {e}")
         conn.rollback()
-        return False
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def bulk_add_promocodes(codes, discount_percent, max_uses=None, product_ids=()) -> list | None:
+    """
+    Массово добавляет промокоды одной транзакцией: коды загружаются через COPY во временную таблицу,
+    затем один запрос вставляет промокоды (совпавшие с существующими пропускаются через ON CONFLICT),
+    их слоты счетчика (не больше max_uses, как в add_promocode) и привязки к тарифам.
+    Возвращает список фактически добавленных кодов или None при ошибке.
+    """
+    if not codes:
+        return []
+    conn = connect_db()
+    if conn is None: return None
+    cursor = conn.cursor()
+    insert_query = """
+    WITH new_promos AS (
+        INSERT INTO promocodes (code, discount_percent, max_uses)
+        SELECT DISTINCT code, %(discount)s, %(max_uses)s FROM promo_import
+        ON CONFLICT (code) DO NOTHING
+        RETURNING id, code
+    ), slot_count AS (
+        SELECT GREATEST(LEAST(COALESCE(%(max_uses)s::int, %(slots)s), %(slots)s), 1) AS slots
+    ), slots AS (
+        INSERT INTO promo_redemption_slots (promocode_id, slot, remaining)
+        SELECT n.id, s, CASE WHEN %(max_uses)s::int IS NULL THEN NULL
+                             ELSE %(max_uses)s::int / c.slots
+                                  + CASE WHEN s < %(max_uses)s::int %% c.slots THEN 1 ELSE 0 END END
+        FROM new_promos n CROSS JOIN slot_count c CROSS JOIN generate_series(0, c.slots - 1) AS s
+    ), links AS (
+        INSERT INTO promocode_products (promocode_id, product_id)
+        SELECT n.id, p FROM new_promos n CROSS JOIN unnest(%(product_ids)s::int[]) AS p
+    )
+    SELECT code FROM new_promos;
+    """
+    try:
+        cursor.execute("CREATE TEMP TABLE promo_import (code VARCHAR(50) NOT NULL) ON COMMIT DROP;")
+        cursor.copy_expert("COPY promo_import (code) FROM STDIN", io.StringIO('\n'.join(codes) + '\n'))
+        cursor.execute(insert_query, {'discount': discount_percent, 'max_uses': max_uses,
+                                      'slots': PROMO_SLOT_COUNT, 'product_ids': list(product_ids)})
+        inserted = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+        return inserted
+    except Exception as e:
+        logging.error(f"Ошибка при массовом добавлении промокодов: {e}")
+        conn.rollback()
+        return None
     finally:
         cursor.close()
         conn.close()
@@ -263,129 +569,339 @@ def toggle_promo_status(promo_id, is_active):
         conn.close()
 
 
-def get_promo_products(promo_id):
-    """Получает список продуктов, на которые действует промокод."""
+def save_promo_products(promo_id, added, removed) -> bool:
+    """
+    Применяет изменения привязок промокода к тарифам одной транзакцией:
+    удаляет снятые привязки и добавляет новые (многострочной вставкой).
+    """
+    if not added and not removed:
+        return True
     conn = connect_db()
-    if conn is None: return []
+    if conn is None: return False
+    cursor = conn.cursor()
+    delete_query = "DELETE FROM promocode_products WHERE promocode_id = %s AND product_id = ANY(%s);"
+    insert_query = "INSERT INTO promocode_products (promocode_id, product_id) VALUES %s ON CONFLICT DO NOTHING;"
+    try:
+        if removed:
+            cursor.execute(delete_query, (promo_id, list(removed)))
+        if added:
+            execute_values(cursor, insert_query, [(promo_id, product_id) for product_id in added])
+        conn.commit()
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении продуктов промокода {promo_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def find_promocode(code):
+    """
+    Ищет промокод по его строковому значению (коду) и возвращает данные.
+    """
+    conn = connect_db()
+    if conn is None: return None
+    cursor = conn.cursor()
+    select_query = """
+    SELECT id, code, discount_percent, is_active
+    FROM promocodes
+    WHERE code = %s;
+    """
+    try:
+        cursor.execute(select_query, (code,))
+        result = cursor.fetchone()
+
+        if result:
+            return {
+                'id': result[0],
+                'code': result[1],
+                'discount_percent': result[2],
+                'is_active': result[3]
+            }
+        return None
+    except Exception as e:
+        logging.error(f"Ошибка при поиске промокода: {e}")
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def get_promo_index_rows(allow_stale: bool = True):
+    """
+    Все промокоды с привязанными тарифами одним запросом (для индекса promo_index):
+    строки (code, id, discount_percent, is_active, max_uses, expires_at, product_id);
+    product_id = None у промокодов без привязок. Возвращает None при ошибке.
+    allow_stale=False — с основной БД (сразу после изменения промокодов).
+    """
+    conn = connect_db(read_only=allow_stale)
+    if conn is None: return None
+    cursor = conn.cursor()
+    select_query = """
+    SELECT p.code, p.id, p.discount_percent, p.is_active, p.max_uses, p.expires_at, pp.product_id
+    FROM promocodes p
+    LEFT JOIN promocode_products pp ON p.id = pp.promocode_id;
+    """
+    try:
+        cursor.execute(select_query)
+        return cursor.fetchall()
+    except Exception as e:
+        if not retry_on_primary(e, allow_stale):
+            logging.error(f"Ошибка при загрузке индекса промокодов: {e}")
+            return None
+        logging.warning(f"Ошибка при загрузке индекса промокодов на реплике, повтор в основной БД: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+    return get_promo_index_rows(allow_stale=False)
+
+
+def get_promo_remaining(promo_id: int):
+    """Остаток использований промокода по слотам; None — без лимита."""
+    conn = connect_db()
+    if conn is None: return None
     cursor = conn.cursor()
     select_query = """
-    SELECT p.id, p.name 
-    FROM products p
-    JOIN promocode_products pp ON p.id = pp.product_id
-    WHERE pp.promocode_id = %s;
+    SELECT SUM(remaining), COUNT(remaining) FROM promo_redemption_slots WHERE promocode_id = %s;
     """
     try:
         cursor.execute(select_query, (promo_id,))
-        results = cursor.fetchall()
-        return [{'id': r[0], 'name': r[1]} for r in results]
+        total, limited_slots = cursor.fetchone()
+        return int(total) if limited_slots else None
     except Exception as e:
-        logging.error(f"Ошибка при получении продуктов промокода {promo_id}: {e}")
-        return []
+        logging.error(f"Ошибка при получении остатка промокода {promo_id}: {e}")
+        return None
     finally:
         cursor.close()
         conn.close()
 
 
-def add_promo_product(promo_id, product_name):
-    """Добавляет продукт к промокоду."""
+def redeem_promo(promo_id: int) -> bool:
+    """
+    Списывает одно использование промокода из случайного свободного слота.
+    Слот, занятый параллельной транзакцией, пропускается (SKIP LOCKED), поэтому покупатели
+    не выстраиваются в очередь за одной строкой. Активность и срок действия проверяются здесь же
+    по часам БД: индекс промокодов в памяти может отставать. False — промокод выключен, истек или исчерпан.
+    """
     conn = connect_db()
     if conn is None: return False
     cursor = conn.cursor()
+    valid_query = """
+    SELECT 1 FROM promocodes
+    WHERE id = %s AND is_active AND (expires_at IS NULL OR expires_at > NOW())
+    FOR SHARE;
+    """
+    left_query = """
+    SELECT COUNT(*), bool_or(remaining IS NULL), COALESCE(SUM(remaining), 0)
+    FROM promo_redemption_slots WHERE promocode_id = %s;
+    """
+    redeem_query = f"""
+    UPDATE promo_redemption_slots s SET remaining = s.remaining - 1, used = s.used + 1
+    FROM (
+        SELECT promocode_id, slot FROM promo_redemption_slots
+        WHERE promocode_id = %s AND (remaining IS NULL OR remaining > 0)
+        ORDER BY (slot + %s) %% {PROMO_SLOT_COUNT}
+        LIMIT 1
+        FOR UPDATE {{lock}}
+    ) free
+    WHERE s.promocode_id = free.promocode_id AND s.slot = free.slot;
+    """
+    try:
+        cursor.execute(valid_query, (promo_id,))
+        if cursor.fetchone() is None:
+            conn.commit()
+            return False
 
-    # 1. Найти ID продукта
-    product_data = get_product(product_name)
-    if not product_data:
-        logging.error(f"Продукт {product_name} не найден.")
+        redeemed = False
+        for _ in range(PROMO_SLOT_COUNT):
+            start_slot = random.randrange(PROMO_SLOT_COUNT)
+            cursor.execute(redeem_query.format(lock='SKIP LOCKED'), (promo_id, start_slot))
+            if cursor.rowcount > 0:
+                redeemed = True
+                break
+            # Все свободные слоты заняты параллельными транзакциями — ждем любой из них.
+            # После ожидания слот мог опустеть (тогда строк 0), хотя в других еще есть использования
+            cursor.execute(redeem_query.format(lock=''), (promo_id, start_slot))
+            if cursor.rowcount > 0:
+                redeemed = True
+                break
+            cursor.execute(left_query, (promo_id,))
+            slots, unlimited, remaining = cursor.fetchone()
+            if slots == 0:
+                # Слотов нет вовсе — промокод создан до их появления и не ограничен
+                redeemed = True
+                break
+            if not unlimited and remaining <= 0:
+                break
+        conn.commit()
+        return redeemed
+    except Exception as e:
+        logging.error(f"Ошибка при списании использования промокода {promo_id}: {e}")
+        conn.rollback()
         return False
-    product_id = product_data['id']
+    finally:
+        cursor.close()
+        conn.close()
 
-    # 2. Вставить связь
-    insert_query = "INSERT INTO promocode_products (promocode_id, product_id) VALUES (%s, %s) ON CONFLICT DO NOTHING;"
+
+def release_promo_redemptions(promo_codes: list) -> int:
+    """Возвращает использования промокодов (по одному на каждый код в списке) после отмены оплаты."""
+    codes = [code for code in promo_codes if code]
+    if not codes:
+        return 0
+    conn = connect_db()
+    if conn is None: return 0
+    cursor = conn.cursor()
+    release_query = """
+    UPDATE promo_redemption_slots s SET remaining = s.remaining + 1, used = s.used - 1
+    FROM (
+        SELECT r.promocode_id, r.slot FROM promo_redemption_slots r
+        JOIN promocodes p ON p.id = r.promocode_id
+        WHERE p.code = %s AND r.used > 0
+        LIMIT 1
+        FOR UPDATE OF r
+    ) taken
+    WHERE s.promocode_id = taken.promocode_id AND s.slot = taken.slot;
+    """
+    released = 0
     try:
-        cursor.execute(insert_query, (promo_id, product_id))
+        for code in codes:
+            cursor.execute(release_query, (code,))
+            released += cursor.rowcount
         conn.commit()
-        return True
+        return released
     except Exception as e:
-        logging.error(f"Ошибка при добавлении продукта к промокоду: {e}")
+        logging.error(f"Ошибка при возврате использований промокодов: {e}")
         conn.rollback()
-        return False
+        return 0
     finally:
         cursor.close()
         conn.close()
 
 
-def remove_promo_product(promo_id, product_id):
-    """Удаляет связь между промокодом и продуктом."""
+def reconcile_promo_uses() -> int:
+    """Сводит суммы слотов в promocodes.uses (только изменившиеся строки). Возвращает число обновленных."""
     conn = connect_db()
-    if conn is None: return False
+    if conn is None: return 0
     cursor = conn.cursor()
-    delete_query = """
-    DELETE FROM promocode_products 
-    WHERE promocode_id = %s AND product_id = %s;
+    reconcile_query = """
+    UPDATE promocodes p SET uses = totals.used
+    FROM (
+        SELECT promocode_id, SUM(used)::int AS used FROM promo_redemption_slots GROUP BY promocode_id
+    ) totals
+    WHERE p.id = totals.promocode_id AND p.uses <> totals.used;
     """
     try:
-        cursor.execute(delete_query, (promo_id, product_id))
+        cursor.execute(reconcile_query)
         conn.commit()
-        return True
+        return cursor.rowcount
     except Exception as e:
-        logging.error(f"Ошибка при удалении продукта из промокода: {e}")
+        logging.error(f"Ошибка при сверке использований промокодов: {e}")
         conn.rollback()
-        return False
+        return 0
     finally:
         cursor.close()
         conn.close()
 
 
-def find_promocode(code):
+# --- ФУНКЦИИ ЛИМИТОВ И РЕЗЕРВОВ ---
+
+def release_expired_reservations(conn=None) -> int:
+    """Удаляет просроченные резервы одним запросом и возвращает места в счетчики тарифов."""
+    own_conn = conn is None
+    if own_conn:
+        conn = connect_db()
+        if conn is None: return 0
+    cursor = conn.cursor()
+    release_query = """
+    WITH expired AS (
+        DELETE FROM product_reservations WHERE expires_at < NOW() RETURNING product_id
+    ), counts AS (
+        SELECT product_id, COUNT(*) AS n FROM expired GROUP BY product_id
+    )
+    UPDATE product_inventory i SET taken = GREATEST(i.taken - c.n, 0)
+    FROM counts c WHERE i.product_id = c.product_id
+    RETURNING c.n;
     """
-    Ищет промокод по его строковому значению (коду) и возвращает данные.
+    try:
+        cursor.execute(release_query)
+        released = sum(r[0] for r in cursor.fetchall())
+        conn.commit()
+        if released:
+            logging.info(f"Освобождено просроченных резервов: {released}")
+        return released
+    except Exception as e:
+        logging.error(f"Ошибка при освобождении просроченных резервов: {e}")
+        conn.rollback()
+        return 0
+    finally:
+        cursor.close()
+        if own_conn:
+            conn.close()
+
+
+def reserve_product(product_id: int, chat_id: int, ttl_seconds: int):
+    """
+    Резервирует одно место тарифа на ttl_seconds.
+
+    Место занимается условным UPDATE счетчика (taken < capacity) — без COUNT(*) по tickets,
+    поэтому параллельные покупатели не могут перепродать лимит.
+    Возвращает {'reservation_id': id | None, 'remaining': int | None}
+    (None в обоих полях — тариф без лимита) или None, если мест нет или произошла ошибка.
     """
     conn = connect_db()
     if conn is None: return None
     cursor = conn.cursor()
-    select_query = """
-    SELECT id, code, discount_percent, is_active
-    FROM promocodes
-    WHERE code = %s;
+    reserve_query = """
+    WITH seat AS (
+        UPDATE product_inventory SET taken = taken + 1
+        WHERE product_id = %s AND taken < capacity
+        RETURNING product_id, capacity - taken AS remaining
+    )
+    INSERT INTO product_reservations (product_id, chat_id, expires_at)
+    SELECT product_id, %s, NOW() + make_interval(secs => %s) FROM seat
+    RETURNING id, (SELECT remaining FROM seat);
     """
     try:
-        cursor.execute(select_query, (code,))
-        result = cursor.fetchone()
+        for attempt in range(2):
+            cursor.execute(reserve_query, (product_id, chat_id, ttl_seconds))
+            result = cursor.fetchone()
+            conn.commit()
+            if result:
+                return {'reservation_id': result[0], 'remaining': result[1]}
 
-        if result:
-            return {
-                'id': result[0],
-                'code': result[1],
-                'discount_percent': result[2],
-                'is_active': result[3]
-            }
+            cursor.execute("SELECT capacity, taken FROM product_inventory WHERE product_id = %s;", (product_id,))
+            if cursor.fetchone() is None:
+                # Лимит для тарифа не задан
+                return {'reservation_id': None, 'remaining': None}
+
+            # Лимит исчерпан: освобождаем просроченные резервы и пробуем еще раз
+            if attempt == 0 and not release_expired_reservations(conn):
+                break
         return None
     except Exception as e:
-        logging.error(f"Ошибка при поиске промокода: {e}")
+        logging.error(f"Ошибка при резервировании тарифа {product_id}: {e}")
+        conn.rollback()
         return None
     finally:
         cursor.close()
         conn.close()
 
 
-# --- ФУНКЦИИ БИЛЕТОВ ---
-
-# ИЗМЕНЕНИЕ: Добавлен buyer_chat_id в параметры и запрос
-def insert_ticket(ticket_id, product_name, buyer_name, buyer_email, buyer_chat_id, final_price):
-    """Добавляет новый билет в БД."""
+def extend_reservation(reservation_id: int, ttl_seconds: int) -> bool:
+    """Продлевает резерв (например, пока администратор подтверждает оплату)."""
     conn = connect_db()
     if conn is None: return False
     cursor = conn.cursor()
-    insert_query = """
-        INSERT INTO tickets (ticket_id, product_name, buyer_name, buyer_email, buyer_chat_id, final_price, is_active)
-        VALUES (%s, %s, %s, %s, %s, %s, FALSE)
-        """
+    update_query = "UPDATE product_reservations SET expires_at = NOW() + make_interval(secs => %s) WHERE id = %s;"
     try:
-        cursor.execute(insert_query, (ticket_id, product_name, buyer_name, buyer_email, buyer_chat_id, final_price))
+        cursor.execute(update_query, (ttl_seconds, reservation_id))
         conn.commit()
-        return True
+        return cursor.rowcount > 0
     except Exception as e:
-        logging.error(f"Ошибка при добавлении билета: {e}")
+        logging.error(f"Ошибка при продлении резерва {reservation_id}: {e}")
         conn.rollback()
         return False
     finally:
@@ -393,54 +909,1159 @@ def insert_ticket(ticket_id, product_name, buyer_name, buyer_email, buyer_chat_i
         conn.close()
 
 
-def find_ticket(ticket_id: str):
-    """Ищет билет по ID и возвращает все данные."""
+def release_reservation(reservation_id: int):
+    """
+    Отменяет резерв и возвращает место в счетчик тарифа.
+    Возвращает (product_id, remaining) или None, если резерв уже снят.
+    """
     conn = connect_db()
     if conn is None: return None
     cursor = conn.cursor()
-    # ИЗМЕНЕНИЕ: Добавлен buyer_chat_id в выборку
-    select_query = """
-    SELECT ticket_id, product_name, buyer_name, buyer_email, buyer_chat_id, final_price, is_active, purchase_date
-    FROM tickets WHERE ticket_id = %s;
+    release_query = """
+    WITH released AS (
+        DELETE FROM product_reservations WHERE id = %s RETURNING product_id
+    )
+    UPDATE product_inventory i SET taken = GREATEST(i.taken - 1, 0)
+    FROM released r WHERE i.product_id = r.product_id
+    RETURNING i.product_id, i.capacity - i.taken;
     """
     try:
-        cursor.execute(select_query, (ticket_id,))
+        cursor.execute(release_query, (reservation_id,))
         result = cursor.fetchone()
-
-        if result:
-            return {
-                'ticket_id': result[0],
-                'product_name': result[1],
-                'buyer_name': result[2],
-                'buyer_email': result[3],
-                'buyer_chat_id': result[4],  # <--- ДОБАВЛЕНО
-                'final_price': result[5],
-                'is_active': result[6],
-                'purchase_date': result[7]
-            }
-        return None
+        conn.commit()
+        return (result[0], result[1]) if result else None
     except Exception as e:
-        logging.error(f"Ошибка при поиске билета: {e}")
+        logging.error(f"Ошибка при отмене резерва {reservation_id}: {e}")
+        conn.rollback()
         return None
     finally:
         cursor.close()
         conn.close()
 
 
-def activate_ticket(ticket_id: str) -> bool:
-    """Активирует билет (устанавливает is_active = TRUE)."""
+def confirm_reservation(reservation_id: int | None, product_id: int) -> bool:
+    """
+    Превращает резерв в продажу: строка резерва удаляется, место остается занятым.
+    Если резерв уже истек, место занимается заново (при наличии).
+    Возвращает False, если билет выдается сверх лимита.
+    """
     conn = connect_db()
     if conn is None: return False
     cursor = conn.cursor()
-    update_query = "UPDATE tickets SET is_active = TRUE WHERE ticket_id = %s AND is_active = FALSE;"
+    take_seat_query = """
+    UPDATE product_inventory SET taken = taken + 1
+    WHERE product_id = %s AND taken < capacity;
+    """
     try:
-        cursor.execute(update_query, (ticket_id,))
+        if reservation_id is not None:
+            cursor.execute("DELETE FROM product_reservations WHERE id = %s;", (reservation_id,))
+            if cursor.rowcount > 0:
+                conn.commit()
+                return True
+
+        cursor.execute(take_seat_query, (product_id,))
+        if cursor.rowcount > 0:
+            conn.commit()
+            return True
+
+        cursor.execute("SELECT 1 FROM product_inventory WHERE product_id = %s;", (product_id,))
+        unlimited = cursor.fetchone() is None
         conn.commit()
-        return cursor.rowcount > 0
+        return unlimited
     except Exception as e:
-        logging.error(f"Ошибка при активации билета: {e}")
+        logging.error(f"Ошибка при подтверждении резерва {reservation_id}: {e}")
         conn.rollback()
         return False
     finally:
         cursor.close()
-        conn.close()
\ No newline at end of file
+        conn.close()
+
+
+def set_product_capacity(product_id: int, capacity: int | None) -> bool:
+    """
+    Устанавливает лимит тарифа (None — без лимита).
+    При первом задании лимита счетчик заполняется уже проданными билетами и активными резервами.
+    """
+    conn = connect_db()
+    if conn is None: return False
+    cursor = conn.cursor()
+    upsert_query = """
+    INSERT INTO product_inventory (product_id, capacity, taken)
+    SELECT p.id, %s,
+           (SELECT COUNT(*) FROM tickets t WHERE t.product_name = p.name)
+         + (SELECT COUNT(*) FROM product_reservations r WHERE r.product_id = p.id)
+    FROM products p WHERE p.id = %s
+    ON CONFLICT (product_id) DO UPDATE SET capacity = EXCLUDED.capacity;
+    """
+    try:
+        if capacity is None:
+            cursor.execute("DELETE FROM product_inventory WHERE product_id = %s;", (product_id,))
+        else:
+            cursor.execute(upsert_query, (capacity, product_id))
+        conn.commit()
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка при установке лимита тарифа {product_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def get_inventory():
+    """Возвращает счетчики лимитов {product_id: {'capacity', 'taken', 'remaining'}} одним запросом."""
+    conn = connect_db()
+    if conn is None: return None
+    cursor = conn.cursor()
+    select_query = "SELECT product_id, capacity, taken FROM product_inventory;"
+    try:
+        release_expired_reservations(conn)
+        cursor.execute(select_query)
+        return {r[0]: {'capacity': r[1], 'taken': r[2], 'remaining': max(r[1] - r[2], 0)}
+                for r in cursor.fetchall()}
+    except Exception as e:
+        logging.error(f"Ошибка при получении лимитов тарифов: {e}")
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+# --- ФУНКЦИИ ОЖИДАЮЩИХ ОПЛАТ ---
+
+PENDING_PAYMENT_COLUMNS = """
+    payment_ref, chat_id, buyer_name, buyer_email, product_id, product_name,
+    final_price, promo_code, reservation_id, status, created_at, promo_redeemed
+"""
+
+
+def pending_payment_from_row(row) -> dict:
+    """Преобразует строку pending_payments (в порядке PENDING_PAYMENT_COLUMNS) в словарь."""
+    return {
+        'payment_ref': row[0], 'chat_id': row[1], 'buyer_name': row[2], 'buyer_email': row[3],
+        'product_id': row[4], 'product_name': row[5], 'final_price': row[6], 'promo_code': row[7],
+        'reservation_id': row[8], 'status': row[9], 'created_at': row[10], 'promo_redeemed': row[11]
+    }
+
+
+def create_pending_payment(payment_ref, chat_id, buyer_name, buyer_email, product_id, product_name,
+                           final_price, promo_code=None, reservation_id=None, promo_redeemed=False) -> bool:
+    """Сохраняет запрос на подтверждение оплаты."""
+    conn = connect_db()
+    if conn is None: return False
+    cursor = conn.cursor()
+    insert_query = """
+    INSERT INTO pending_payments (payment_ref, chat_id, buyer_name, buyer_email, product_id, product_name,
+                                  final_price, promo_code, reservation_id, promo_redeemed)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
+    """
+    try:
+        cursor.execute(insert_query, (payment_ref, chat_id, buyer_name, buyer_email, product_id, product_name,
+                                      final_price, promo_code, reservation_id, promo_redeemed))
+        conn.commit()
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении запроса оплаты {payment_ref}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def get_pending_payment(payment_ref: str):
+    """Возвращает запрос оплаты по референсу (поиск по первичному ключу)."""
+    conn = connect_db()
+    if conn is None: return None
+    cursor = conn.cursor()
+    select_query = f"SELECT {PENDING_PAYMENT_COLUMNS} FROM pending_payments WHERE payment_ref = %s;"
+    try:
+        cursor.execute(select_query, (payment_ref,))
+        result = cursor.fetchone()
+        return pending_payment_from_row(result) if result else None
+    except Exception as e:
+        logging.error(f"Ошибка при поиске запроса оплаты {payment_ref}: {e}")
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def resolve_pending_payment(payment_ref: str, new_status: str, from_status: str = 'pending'):
+    """
+    Атомарно переводит запрос оплаты из from_status в new_status и возвращает его данные.
+    Возвращает None, если запрос не найден или уже обработан (например, другим администратором).
+    """
+    conn = connect_db()
+    if conn is None: return None
+    cursor = conn.cursor()
+    update_query = f"""
+    UPDATE pending_payments
+    SET status = %s, resolved_at = CASE WHEN %s = 'pending' THEN NULL ELSE NOW() END
+    WHERE payment_ref = %s AND status = %s
+    RETURNING {PENDING_PAYMENT_COLUMNS};
+    """
+    try:
+        cursor.execute(update_query, (new_status, new_status, payment_ref, from_status))
+        result = cursor.fetchone()
+        conn.commit()
+        return pending_payment_from_row(result) if result else None
+    except Exception as e:
+        logging.error(f"Ошибка при обработке запроса оплаты {payment_ref}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def expire_stale_payments(max_age_seconds: int, limit: int = 500) -> list:
+    """
+    Одним запросом помечает устаревшие запросы оплаты как 'expired', снимает их резервы
+    и возвращает [(payment_ref, chat_id, promo_code | None), ...] для уведомления покупателей
+    и возврата использований промокодов (promo_code — только если использование было списано).
+    """
+    conn = connect_db()
+    if conn is None: return []
+    cursor = conn.cursor()
+    expire_query = """
+    WITH expired AS (
+        UPDATE pending_payments SET status = 'expired', resolved_at = NOW()
+        WHERE payment_ref IN (
+            SELECT payment_ref FROM pending_payments
+            WHERE status = 'pending' AND created_at < NOW() - make_interval(secs => %s)
+            ORDER BY created_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING payment_ref, chat_id, reservation_id, CASE WHEN promo_redeemed THEN promo_code END AS promo_code
+    ), released AS (
+        DELETE FROM product_reservations r USING expired e
+        WHERE r.id = e.reservation_id
+        RETURNING r.product_id
+    ), counts AS (
+        SELECT product_id, COUNT(*) AS n FROM released GROUP BY product_id
+    ), restocked AS (
+        UPDATE product_inventory i SET taken = GREATEST(i.taken - c.n, 0)
+        FROM counts c WHERE i.product_id = c.product_id
+    )
+    SELECT payment_ref, chat_id, promo_code FROM expired;
+    """
+    try:
+        cursor.execute(expire_query, (max_age_seconds, limit))
+        results = cursor.fetchall()
+        conn.commit()
+        return [(r[0], r[1], r[2]) for r in results]
+    except Exception as e:
+        logging.error(f"Ошибка при истечении запросов оплаты: {e}")
+        conn.rollback()
+        return []
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def get_pending_payments_page(after: tuple | None = None, limit: int = 10):
+    """
+    Страница ожидающих оплат в порядке поступления (keyset-пагинация).
+    after — ключ (created_at, payment_ref) последней строки предыдущей страницы.
+    Возвращает (список запросов, есть_ли_следующая_страница) или None при ошибке.
+    """
+    conn = connect_db()
+    if conn is None: return None
+    cursor = conn.cursor()
+    if after is None:
+        select_query = f"""
+        SELECT {PENDING_PAYMENT_COLUMNS} FROM pending_payments
+        WHERE status = 'pending'
+        ORDER BY created_at, payment_ref LIMIT %s;
+        """
+        params = (limit + 1,)
+    else:
+        select_query = f"""
+        SELECT {PENDING_PAYMENT_COLUMNS} FROM pending_payments
+        WHERE status = 'pending' AND (created_at, payment_ref) > (%s, %s)
+        ORDER BY created_at, payment_ref LIMIT %s;
+        """
+        params = (after[0], after[1], limit + 1)
+    try:
+        cursor.execute(select_query, params)
+        rows = cursor.fetchall()
+        return [pending_payment_from_row(r) for r in rows[:limit]], len(rows) > limit
+    except Exception as e:
+        logging.error(f"Ошибка при получении ожидающих оплат: {e}")
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def count_pending_payments() -> int:
+    """Количество запросов, ожидающих подтверждения."""
+    conn = connect_db()
+    if conn is None: return 0
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT COUNT(*) FROM pending_payments WHERE status = 'pending';")
+        return cursor.fetchone()[0]
+    except Exception as e:
+        logging.error(f"Ошибка при подсчете ожидающих оплат: {e}")
+        return 0
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def reject_pending_payments(payment_refs: list) -> list:
+    """
+    Отклоняет несколько запросов оплаты одной транзакцией и возвращает их места в продажу.
+    Возвращает список отклоненных запросов (уже обработанные пропускаются).
+    """
+    conn = connect_db()
+    if conn is None: return []
+    cursor = conn.cursor()
+    reject_query = f"""
+    UPDATE pending_payments SET status = 'rejected', resolved_at = NOW()
+    WHERE payment_ref = ANY(%s) AND status = 'pending'
+    RETURNING {PENDING_PAYMENT_COLUMNS};
+    """
+    release_query = """
+    WITH released AS (
+        DELETE FROM product_reservations WHERE id = ANY(%s) RETURNING product_id
+    ), counts AS (
+        SELECT product_id, COUNT(*) AS n FROM released GROUP BY product_id
+    )
+    UPDATE product_inventory i SET taken = GREATEST(i.taken - c.n, 0)
+    FROM counts c WHERE i.product_id = c.product_id;
+    """
+    try:
+        cursor.execute(reject_query, (list(payment_refs),))
+        rejected = [pending_payment_from_row(r) for r in cursor.fetchall()]
+        reservation_ids = [p['reservation_id'] for p in rejected if p['reservation_id'] is not None]
+        if reservation_ids:
+            cursor.execute(release_query, (reservation_ids,))
+        conn.commit()
+        return rejected
+    except Exception as e:
+        logging.error(f"Ошибка при пакетном отклонении оплат: {e}")
+        conn.rollback()
+        return []
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def approve_pending_payments(ticket_ids: dict) -> list | None:
+    """
+    Подтверждает несколько запросов оплаты одной транзакцией: статус 'approved',
+    билеты (неактивные) и превращение резервов в продажи.
+    ticket_ids — {payment_ref: заранее сгенерированный ID билета}; уже выданные ID заменяются новыми.
+    Возвращает список подтвержденных запросов с ключами 'ticket_id' и 'within_limit'
+    (уже обработанные пропускаются) или None, если транзакция откатилась.
+    """
+    conn = connect_db()
+    if conn is None: return None
+    cursor = conn.cursor()
+    approve_query = f"""
+    UPDATE pending_payments SET status = 'approved', resolved_at = NOW()
+    WHERE payment_ref = ANY(%s) AND status = 'pending'
+    RETURNING {PENDING_PAYMENT_COLUMNS};
+    """
+    insert_tickets_query = """
+    INSERT INTO tickets (ticket_id, product_name, buyer_name, buyer_email, buyer_chat_id, final_price, is_active)
+    VALUES %s
+    """
+    take_seat_query = """
+    UPDATE product_inventory SET taken = taken + 1
+    WHERE product_id = %s AND taken < capacity;
+    """
+    try:
+        cursor.execute(approve_query, (list(ticket_ids),))
+        approved = [pending_payment_from_row(r) for r in cursor.fetchall()]
+        if not approved:
+            conn.commit()
+            return []
+
+        reserved = reserve_ticket_ids(cursor, [ticket_ids[p['payment_ref']] for p in approved])
+        for p, ticket_id in zip(approved, reserved):
+            p['ticket_id'] = ticket_id
+            p['within_limit'] = True
+
+        execute_values(cursor, insert_tickets_query, [
+            (p['ticket_id'], p['product_name'], p['buyer_name'], p['buyer_email'], p['chat_id'], p['final_price'],
+             False)
+            for p in approved
+        ])
+        rollup_sales(cursor, [(p['product_name'], 1, p['final_price']) for p in approved])
+        enqueue_ticket_emails(cursor, [(p['ticket_id'], p['buyer_email'], p['buyer_name'], p['product_name'])
+                                       for p in approved])
+
+        # Резервы удаляются одним запросом; место остается занятым
+        reservation_ids = [p['reservation_id'] for p in approved if p['reservation_id'] is not None]
+        confirmed = set()
+        if reservation_ids:
+            cursor.execute("DELETE FROM product_reservations WHERE id = ANY(%s) RETURNING id;", (reservation_ids,))
+            confirmed = {r[0] for r in cursor.fetchall()}
+
+        # Для истекших резервов место занимается заново, как в confirm_reservation
+        cursor.execute("SELECT product_id FROM product_inventory;")
+        limited = {r[0] for r in cursor.fetchall()}
+        for p in approved:
+            if p['reservation_id'] in confirmed or p['product_id'] not in limited:
+                continue
+            cursor.execute(take_seat_query, (p['product_id'],))
+            p['within_limit'] = cursor.rowcount > 0
+
+        conn.commit()
+        return approved
+    except Exception as e:
+        logging.error(f"Ошибка при пакетном подтверждении оплат: {e}")
+        conn.rollback()
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+# --- ФУНКЦИИ СТАТИСТИКИ ---
+
+def rollup_sales(cursor, sales: list) -> None:
+    """
+    Добавляет продажи в sales_daily за текущий день внутри транзакции вызывающего.
+    sales — [(product_name, количество, выручка), ...]; строки обновляются в порядке
+    названий тарифов, чтобы параллельные транзакции не блокировали друг друга взаимно.
+    """
+    totals = {}
+    for product_name, count, revenue in sales:
+        sold, total = totals.get(product_name, (0, 0))
+        totals[product_name] = (sold + count, total + revenue)
+
+    execute_values(cursor, """
+    INSERT INTO sales_daily (day, product_name, tickets_sold, revenue)
+    VALUES %s
+    ON CONFLICT (day, product_name) DO UPDATE
+    SET tickets_sold = sales_daily.tickets_sold + EXCLUDED.tickets_sold,
+        revenue = sales_daily.revenue + EXCLUDED.revenue;
+    """, [(product_name, sold, total) for product_name, (sold, total) in sorted(totals.items())],
+        template="(CURRENT_DATE, %s, %s, %s)")
+    execute_values(cursor, """
+    INSERT INTO ticket_counters (product_name, sold)
+    VALUES %s
+    ON CONFLICT (product_name) DO UPDATE SET sold = ticket_counters.sold + EXCLUDED.sold;
+    """, [(product_name, sold) for product_name, (sold, _) in sorted(totals.items())])
+
+
+def rollup_activation(cursor, product_name: str) -> None:
+    """Засчитывает активацию (вход) в sales_daily и ticket_counters внутри транзакции вызывающего."""
+    cursor.execute("""
+    INSERT INTO sales_daily (day, product_name, activated) VALUES (CURRENT_DATE, %s, 1)
+    ON CONFLICT (day, product_name) DO UPDATE SET activated = sales_daily.activated + 1;
+    INSERT INTO ticket_counters (product_name, activated) VALUES (%s, 1)
+    ON CONFLICT (product_name) DO UPDATE SET activated = ticket_counters.activated + 1;
+    """, (product_name, product_name))
+
+
+def get_sales_rollup():
+    """Все строки sales_daily (дни × тарифы) одним чтением, новые дни первыми; None при ошибке."""
+    conn = connect_db()
+    if conn is None: return None
+    cursor = conn.cursor()
+    select_query = """
+    SELECT day, product_name, tickets_sold, revenue, activated
+    FROM sales_daily ORDER BY day DESC, product_name;
+    """
+    try:
+        cursor.execute(select_query)
+        return [{'day': r[0], 'product_name': r[1], 'tickets_sold': r[2], 'revenue': r[3], 'activated': r[4]}
+                for r in cursor.fetchall()]
+    except Exception as e:
+        logging.error(f"Ошибка при получении статистики продаж: {e}")
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def get_ticket_counters() -> list | None:
+    """Продано и вошло по каждому тарифу (одна строка на тариф, без подсчета по tickets); None при ошибке."""
+    conn = connect_db()
+    if conn is None: return None
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT product_name, sold, activated FROM ticket_counters ORDER BY product_name;")
+        return [{'product_name': r[0], 'sold': r[1], 'activated': r[2]} for r in cursor.fetchall()]
+    except Exception as e:
+        logging.error(f"Ошибка при получении счетчиков входа: {e}")
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+# --- ФУНКЦИИ ОЧЕРЕДИ EMAIL ---
+
+def enqueue_ticket_emails(cursor, tickets: list) -> None:
+    """
+    Ставит письма с билетами в email_outbox внутри транзакции вызывающего:
+    письмо не теряется, если билет сохранен, и не появляется, если транзакция откатилась.
+    tickets — [(ticket_id, email, buyer_name, product_name), ...].
+    """
+    if not EMAIL_OUTBOX_ENABLED or not tickets:
+        return
+    execute_values(cursor, """
+    INSERT INTO email_outbox (ticket_id, email, buyer_name, product_name) VALUES %s
+    ON CONFLICT (ticket_id) DO NOTHING;
+    """, tickets)
+
+
+def claim_email_batch(limit: int, lease_seconds: int = 300) -> list | None:
+    """
+    Забирает до limit писем, которым пора отправляться, и откладывает их на lease_seconds:
+    параллельный отправитель (cron и CLI одновременно) их не получит, а письма упавшего
+    отправителя вернутся в очередь по истечении аренды. Возвращает список писем или None.
+    """
+    conn = connect_db()
+    if conn is None: return None
+    cursor = conn.cursor()
+    claim_query = """
+    UPDATE email_outbox SET attempts = attempts + 1,
+                            next_attempt_at = NOW() + make_interval(secs => %s)
+    WHERE id IN (
+        SELECT id FROM email_outbox
+        WHERE status = 'pending' AND next_attempt_at <= NOW()
+        ORDER BY next_attempt_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, ticket_id, email, buyer_name, product_name, attempts;
+    """
+    try:
+        cursor.execute(claim_query, (lease_seconds, limit))
+        rows = cursor.fetchall()
+        conn.commit()
+        return [
+            {'id': r[0], 'ticket_id': r[1], 'email': r[2], 'buyer_name': r[3], 'product_name': r[4],
+             'attempts': r[5]}
+            for r in rows
+        ]
+    except Exception as e:
+        logging.error(f"Ошибка при выборке писем из очереди: {e}")
+        conn.rollback()
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def finish_email_batch(sent_ids: list, failures: list) -> bool:
+    """
+    Записывает результат отправки пачки одной транзакцией.
+    failures — [(id, текст ошибки), ...]: письмо откладывается с удвоением паузы,
+    после EMAIL_MAX_ATTEMPTS попыток получает статус 'failed'.
+    """
+    if not sent_ids and not failures:
+        return True
+    conn = connect_db()
+    if conn is None: return False
+    cursor = conn.cursor()
+    sent_query = "UPDATE email_outbox SET status = 'sent', sent_at = NOW(), last_error = NULL WHERE id = ANY(%s);"
+    failed_query = """
+    UPDATE email_outbox AS o
+    SET last_error = f.error,
+        status = CASE WHEN o.attempts >= %s THEN 'failed' ELSE 'pending' END,
+        next_attempt_at = NOW() + make_interval(secs => %s * power(2, o.attempts - 1))
+    FROM (VALUES %%s) AS f (id, error)
+    WHERE o.id = f.id;
+    """
+    try:
+        if sent_ids:
+            cursor.execute(sent_query, (list(sent_ids),))
+        if failures:
+            query = cursor.mogrify(failed_query, (EMAIL_MAX_ATTEMPTS, EMAIL_RETRY_BASE_SECONDS)).decode()
+            execute_values(cursor, query, [(email_id, error[:500]) for email_id, error in failures],
+                           template="(%s::bigint, %s)")
+        conn.commit()
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении результатов отправки писем: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cursor.close()
+        conn.close()
+
+
+# --- ФУНКЦИИ БИЛЕТОВ ---
+
+# Ключ секционированной tickets — (ticket_id, purchase_date), поэтому уникальность ID билета
+# (он же пропуск на вход) держит отдельная несекционированная таблица. ID архивированных билетов
+# в ней остаются и повторно не выдаются. При создании заполняется из tickets
+create_ticket_ids_query = """
+    CREATE TABLE IF NOT EXISTS ticket_ids (
+        ticket_id VARCHAR(50) PRIMARY KEY
+    );
+    INSERT INTO ticket_ids (ticket_id)
+    SELECT ticket_id FROM tickets
+    WHERE NOT EXISTS (SELECT 1 FROM ticket_ids)
+    ON CONFLICT DO NOTHING;
+    """
+
+# Есть ли в БД pg_trgm; без него search_tickets ищет только по ILIKE без сортировки по похожести
+ticket_search_state = {'trigram': True}
+
+
+def create_trigram_indexes(cursor) -> bool:
+    """
+    Триграммные индексы для поиска билета по части имени или email (search_tickets).
+    Создаются под SAVEPOINT: если pg_trgm недоступен (нет прав на CREATE EXTENSION, управляемая БД
+    без расширения), откатывается только эта часть, а остальная транзакция курсора продолжается.
+    """
+    cursor.execute("SAVEPOINT trigram_indexes;")
+    try:
+        cursor.execute("""
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            CREATE INDEX IF NOT EXISTS tickets_buyer_name_trgm_idx ON tickets USING gin (buyer_name gin_trgm_ops);
+            CREATE INDEX IF NOT EXISTS tickets_buyer_email_trgm_idx ON tickets USING gin (buyer_email gin_trgm_ops);
+            """)
+    except psycopg2.Error as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT trigram_indexes;")
+        logging.warning(f"pg_trgm недоступен, поиск билетов будет без триграммных индексов: {e}")
+        return False
+    cursor.execute("RELEASE SAVEPOINT trigram_indexes;")
+    return True
+
+
+# Сколько раз подбирается новый ID, если сгенерированный уже занят
+TICKET_ID_ATTEMPTS = 5
+
+
+def new_ticket_id() -> str:
+    """Генерирует ID билета (12 hex-символов)."""
+    return str(uuid.uuid4()).upper().replace('-', '')[:12]
+
+
+def reserve_ticket_ids(cursor, ticket_ids: list) -> list:
+    """
+    Занимает ID билетов в ticket_ids внутри транзакции вызывающего.
+    Уже выданные (и совпавшие внутри пачки) ID заменяются новыми; возвращает итоговые ID в том же порядке.
+    """
+    result = list(ticket_ids)
+    pending = list(range(len(result)))
+    for _ in range(TICKET_ID_ATTEMPTS):
+        taken = {row[0] for row in execute_values(
+            cursor, "INSERT INTO ticket_ids (ticket_id) VALUES %s ON CONFLICT DO NOTHING RETURNING ticket_id;",
+            [(result[i],) for i in pending], fetch=True
+        )}
+        conflicts = []
+        for i in pending:
+            if result[i] in taken:
+                taken.discard(result[i])
+            else:
+                conflicts.append(i)
+        if not conflicts:
+            return result
+        logging.warning(f"Совпадение ID билета ({len(conflicts)} шт.), генерируется новый.")
+        for i in conflicts:
+            result[i] = new_ticket_id()
+        pending = conflicts
+    raise RuntimeError("не удалось подобрать свободный ID билета")
+
+
+# Условия по purchase_date, по которым планировщик отсекает лишние секции (параметр — TICKET_HOT_DAYS).
+# NOW() одинаков в пределах транзакции, поэтому "свежие" и "старые" билеты не пересекаются
+TICKET_HOT_FILTER = "purchase_date >= NOW() - make_interval(days => %s)"
+TICKET_COLD_FILTER = "purchase_date < NOW() - make_interval(days => %s)"
+
+
+# ИЗМЕНЕНИЕ: Добавлен buyer_chat_id в параметры и запрос
+def insert_ticket(ticket_id, product_name, buyer_name, buyer_email, buyer_chat_id, final_price,
+                  product_id: int | None = None) -> dict | None:
+    """
+    Добавляет новый билет в БД. Если ticket_id уже выдан, билет сохраняется под новым ID.
+    product_id — занять место в лимите тарифа в той же транзакции (ручная выдача без резерва;
+    оплаченные билеты занимают место через резерв).
+    Возвращает {'ticket_id': сохраненный ID, 'within_limit': False — выдан сверх лимита} или None при ошибке.
+    """
+    conn = connect_db()
+    if conn is None: return None
+    cursor = conn.cursor()
+    insert_query = """
+        INSERT INTO tickets (ticket_id, product_name, buyer_name, buyer_email, buyer_chat_id, final_price, is_active)
+        VALUES (%s, %s, %s, %s, %s, %s, FALSE)
+        """
+    try:
+        ticket_id = reserve_ticket_ids(cursor, [ticket_id])[0]
+        cursor.execute(insert_query, (ticket_id, product_name, buyer_name, buyer_email, buyer_chat_id, final_price))
+        rollup_sales(cursor, [(product_name, 1, final_price)])
+        enqueue_ticket_emails(cursor, [(ticket_id, buyer_email, buyer_name, product_name)])
+
+        within_limit = True
+        if product_id is not None:
+            cursor.execute("UPDATE product_inventory SET taken = taken + 1 WHERE product_id = %s AND taken < capacity;",
+                           (product_id,))
+            if cursor.rowcount == 0:
+                cursor.execute("SELECT 1 FROM product_inventory WHERE product_id = %s;", (product_id,))
+                within_limit = cursor.fetchone() is None
+
+        conn.commit()
+        return {'ticket_id': ticket_id, 'within_limit': within_limit}
+    except Exception as e:
+        logging.error(f"Ошибка при добавлении билета: {e}")
+        conn.rollback()
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def find_ticket(ticket_id: str, allow_stale: bool = False):
+    """
+    Ищет билет по ID и возвращает все данные.
+    Сначала читаются только свежие секции (TICKET_HOT_FILTER), старые — только при промахе.
+    allow_stale=True — чтение с реплики (статус может отставать на задержку репликации);
+    если на реплике билет не найден или запрос не удался, он перепроверяется в основной БД.
+    """
+    conn = connect_db(read_only=allow_stale)
+    if conn is None: return None
+    cursor = conn.cursor()
+    # ИЗМЕНЕНИЕ: Добавлен buyer_chat_id в выборку
+    select_query = """
+    SELECT ticket_id, product_name, buyer_name, buyer_email, buyer_chat_id, final_price, is_active, purchase_date
+    FROM tickets WHERE ticket_id = %s AND {};
+    """
+    try:
+        cursor.execute(select_query.format(TICKET_HOT_FILTER), (ticket_id, TICKET_HOT_DAYS))
+        result = cursor.fetchone()
+        if not result:
+            cursor.execute(select_query.format(TICKET_COLD_FILTER), (ticket_id, TICKET_HOT_DAYS))
+            result = cursor.fetchone()
+
+        if result:
+            return {
+                'ticket_id': result[0],
+                'product_name': result[1],
+                'buyer_name': result[2],
+                'buyer_email': result[3],
+                'buyer_chat_id': result[4],  # <--- ДОБАВЛЕНО
+                'final_price': result[5],
+                'is_active': result[6],
+                'purchase_date': result[7]
+            }
+    except Exception as e:
+        logging.error(f"Ошибка при поиске билета: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+    # Билет мог быть выдан только что и еще не дойти до реплики
+    if allow_stale and DATABASE_REPLICA_URLS:
+        return find_ticket(ticket_id)
+    return None
+
+
+def search_tickets(text: str, offset: int = 0, limit: int = 10):
+    """
+    Нечеткий поиск билетов по части имени или email покупателя.
+
+    ILIKE '%текст%' и оператор похожести % обслуживаются GIN-индексами pg_trgm,
+    поэтому запрос не сканирует всю таблицу (нужно от 3 символов).
+    Результаты упорядочены по похожести. Если pg_trgm в БД нет, поиск идет только по ILIKE
+    (новые билеты первыми). Возвращает (список билетов, есть ли следующая страница) или None.
+    """
+    conn = connect_db()
+    if conn is None: return None
+    cursor = conn.cursor()
+    # Спецсимволы LIKE во вводе ищутся буквально
+    pattern = '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    select_query = """
+    SELECT ticket_id, product_name, buyer_name, buyer_email, is_active, purchase_date
+    FROM tickets
+    WHERE buyer_name ILIKE %(pattern)s OR buyer_email ILIKE %(pattern)s
+       OR buyer_name %% %(text)s OR buyer_email %% %(text)s
+    ORDER BY GREATEST(similarity(buyer_name, %(text)s), similarity(buyer_email, %(text)s)) DESC,
+             purchase_date DESC, ticket_id
+    LIMIT %(limit)s OFFSET %(offset)s;
+    """
+    plain_query = """
+    SELECT ticket_id, product_name, buyer_name, buyer_email, is_active, purchase_date
+    FROM tickets
+    WHERE buyer_name ILIKE %(pattern)s OR buyer_email ILIKE %(pattern)s
+    ORDER BY purchase_date DESC, ticket_id
+    LIMIT %(limit)s OFFSET %(offset)s;
+    """
+    params = {'pattern': pattern, 'text': text, 'limit': limit + 1, 'offset': offset}
+    try:
+        if ticket_search_state['trigram']:
+            try:
+                cursor.execute(select_query, params)
+            except psycopg2.errors.UndefinedFunction as e:
+                # Нет оператора % и similarity(): pg_trgm не установлен
+                logging.warning(f"pg_trgm недоступен, поиск билетов переключен на ILIKE: {e}")
+                ticket_search_state['trigram'] = False
+                conn.rollback()
+        if not ticket_search_state['trigram']:
+            cursor.execute(plain_query, params)
+        rows = cursor.fetchall()
+        tickets = [
+            {
+                'ticket_id': row[0],
+                'product_name': row[1],
+                'buyer_name': row[2],
+                'buyer_email': row[3],
+                'is_active': row[4],
+                'purchase_date': row[5]
+            }
+            for row in rows[:limit]
+        ]
+        return tickets, len(rows) > limit
+    except Exception as e:
+        logging.error(f"Ошибка при поиске билетов по '{text}': {e}")
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def activate_ticket(ticket_id: str) -> bool:
+    """Активирует билет (устанавливает is_active = TRUE)."""
+    conn = connect_db()
+    if conn is None: return False
+    cursor = conn.cursor()
+    update_query = """
+    UPDATE tickets SET is_active = TRUE, activated_at = NOW()
+    WHERE ticket_id = %s AND is_active = FALSE AND {}
+    RETURNING product_name;
+    """
+    try:
+        cursor.execute(update_query.format(TICKET_HOT_FILTER), (ticket_id, TICKET_HOT_DAYS))
+        result = cursor.fetchone()
+        if not result:
+            cursor.execute(update_query.format(TICKET_COLD_FILTER), (ticket_id, TICKET_HOT_DAYS))
+            result = cursor.fetchone()
+        if result:
+            rollup_activation(cursor, result[0])
+        conn.commit()
+        return result is not None
+    except Exception as e:
+        logging.error(f"Ошибка при активации билета: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def check_in_ticket(ticket_id: str):
+    """
+    Атомарно активирует билет при сканировании на входе.
+
+    Возвращает {'status': 'activated' | 'already_used' | 'not_found', ...}.
+    Повторный скан с любого сканера отсекается тем же условием is_active = FALSE,
+    что и в activate_ticket, поэтому билет активируется ровно один раз.
+    В обычном случае это один запрос к свежим секциям; остальные нужны только для старых билетов,
+    повторов и ненайденных ID.
+    """
+    conn = connect_db()
+    if conn is None: return None
+    cursor = conn.cursor()
+    update_query = """
+    UPDATE tickets SET is_active = TRUE, activated_at = NOW()
+    WHERE ticket_id = %s AND is_active = FALSE AND {}
+    RETURNING product_name, buyer_name, activated_at;
+    """
+    select_query = "SELECT product_name, buyer_name, activated_at FROM tickets WHERE ticket_id = %s;"
+    try:
+        cursor.execute(update_query.format(TICKET_HOT_FILTER), (ticket_id, TICKET_HOT_DAYS))
+        result = cursor.fetchone()
+        if not result:
+            cursor.execute(update_query.format(TICKET_COLD_FILTER), (ticket_id, TICKET_HOT_DAYS))
+            result = cursor.fetchone()
+        if result:
+            rollup_activation(cursor, result[0])
+        conn.commit()
+        if result:
+            status = 'activated'
+        else:
+            # Отдельный запрос видит активацию, закоммиченную параллельным сканером
+            cursor.execute(select_query, (ticket_id,))
+            result = cursor.fetchone()
+            if not result:
+                return {'status': 'not_found', 'ticket_id': ticket_id}
+            status = 'already_used'
+
+        return {
+            'status': status,
+            'ticket_id': ticket_id,
+            'product_name': result[0],
+            'buyer_name': result[1],
+            'activated_at': result[2]
+        }
+    except Exception as e:
+        logging.error(f"Ошибка при сканировании билета {ticket_id}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+# --- ФУНКЦИИ АДМИНИСТРАТОРОВ ---
+
+def get_admins() -> list | None:
+    """Возвращает всех сотрудников с ролями (None при ошибке БД)."""
+    conn = connect_db()
+    if conn is None: return None
+    cursor = conn.cursor()
+    select_query = "SELECT user_id, role, name, on_duty FROM admins ORDER BY user_id;"
+    try:
+        cursor.execute(select_query)
+        return [{'user_id': r[0], 'role': r[1], 'name': r[2], 'on_duty': r[3]} for r in cursor.fetchall()]
+    except Exception as e:
+        logging.error(f"Ошибка при получении списка администраторов: {e}")
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def set_admin(user_id: int, role: str, name: str | None = None) -> bool:
+    """Добавляет сотрудника или меняет его роль."""
+    conn = connect_db()
+    if conn is None: return False
+    cursor = conn.cursor()
+    upsert_query = """
+    INSERT INTO admins (user_id, role, name) VALUES (%s, %s, %s)
+    ON CONFLICT (user_id) DO UPDATE SET role = EXCLUDED.role, name = COALESCE(EXCLUDED.name, admins.name);
+    """
+    try:
+        cursor.execute(upsert_query, (user_id, role, name))
+        conn.commit()
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении администратора {user_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def remove_admin(user_id: int) -> bool:
+    """Удаляет сотрудника. False — не найден или ошибка БД."""
+    conn = connect_db()
+    if conn is None: return False
+    cursor = conn.cursor()
+    try:
+        cursor.execute("DELETE FROM admins WHERE user_id = %s;", (user_id,))
+        conn.commit()
+        return cursor.rowcount > 0
+    except Exception as e:
+        logging.error(f"Ошибка при удалении администратора {user_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def set_admin_duty(user_id: int, on_duty: bool) -> bool:
+    """Отмечает сотрудника на смене или вне смены (уведомления об оплате получают только те, кто на смене)."""
+    conn = connect_db()
+    if conn is None: return False
+    cursor = conn.cursor()
+    try:
+        cursor.execute("UPDATE admins SET on_duty = %s WHERE user_id = %s;", (on_duty, user_id))
+        conn.commit()
+        return cursor.rowcount > 0
+    except Exception as e:
+        logging.error(f"Ошибка при смене статуса смены администратора {user_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cursor.close()
+        conn.close()
+
+
+# --- ФУНКЦИИ ПАРТИЦИЙ БИЛЕТОВ ---
+
+# Имя месячной секции: tickets_pГГГГММ. Архивируются только такие секции (не tickets_default)
+TICKET_PARTITION_PREFIX = "tickets_p"
+
+
+def month_start(day) -> date:
+    """Первое число месяца даты day."""
+    return date(day.year, day.month, 1)
+
+
+def add_months(month: date, count: int) -> date:
+    """Первое число месяца, отстоящего от month на count месяцев."""
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def ticket_partition_name(month: date) -> str:
+    """Имя секции билетов за месяц month."""
+    return f"{TICKET_PARTITION_PREFIX}{month:%Y%m}"
+
+
+def create_ticket_partitions(cursor, first_month: date, last_month: date) -> None:
+    """Создает секцию по умолчанию и месячные секции с first_month по last_month включительно."""
+    cursor.execute("CREATE TABLE IF NOT EXISTS tickets_default PARTITION OF tickets DEFAULT;")
+    month = first_month
+    while month <= last_month:
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {ticket_partition_name(month)} PARTITION OF tickets "
+            "FOR VALUES FROM (%s) TO (%s);",
+            (month, add_months(month, 1))
+        )
+        month = add_months(month, 1)
+
+
+def ensure_ticket_partitions(cursor, months_ahead: int = TICKET_PARTITION_MONTHS_AHEAD) -> bool:
+    """
+    Создает секции билетов на текущий месяц и months_ahead месяцев вперед (в транзакции курсора).
+    Для несекционированной таблицы (до migrate_tickets_to_partitions) ничего не делает и возвращает False.
+    """
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = 'tickets'::regclass;")
+    if cursor.fetchone()[0] != 'p':
+        logging.warning("Таблица tickets не секционирована: выполните python ticket_archive.py migrate")
+        return False
+
+    current = month_start(date.today())
+    create_ticket_partitions(cursor, current, add_months(current, months_ahead))
+    return True
+
+
+def ensure_ticket_partitions_now(months_ahead: int = TICKET_PARTITION_MONTHS_AHEAD) -> bool:
+    """ensure_ticket_partitions в отдельной транзакции (для ticket_archive.py)."""
+    conn = connect_db()
+    if conn is None: return False
+    cursor = conn.cursor()
+    try:
+        created = ensure_ticket_partitions(cursor, months_ahead)
+        conn.commit()
+        return created
+    except Exception as e:
+        logging.error(f"Ошибка при создании секций билетов: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def migrate_tickets_to_partitions() -> int | None:
+    """
+    Переводит несекционированную таблицу tickets в секционированную по месяцам purchase_date.
+    Все шаги — одна транзакция под эксклюзивной блокировкой: при ошибке остается старая таблица.
+    Возвращает число перенесенных билетов, 0 — если таблица уже секционирована, None — при ошибке.
+    """
+    conn = connect_db()
+    if conn is None: return None
+    cursor = conn.cursor()
+    columns = "ticket_id, product_name, buyer_name, buyer_email, buyer_chat_id, final_price, is_active, activated_at"
+    try:
+        cursor.execute("LOCK TABLE tickets IN ACCESS EXCLUSIVE MODE;")
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = 'tickets'::regclass;")
+        if cursor.fetchone()[0] == 'p':
+            conn.rollback()
+            return 0
+
+        cursor.execute("""
+            DROP INDEX IF EXISTS tickets_buyer_name_trgm_idx;
+            DROP INDEX IF EXISTS tickets_buyer_email_trgm_idx;
+            ALTER TABLE tickets RENAME TO tickets_unpartitioned;
+            ALTER TABLE tickets_unpartitioned RENAME CONSTRAINT tickets_pkey TO tickets_unpartitioned_pkey;
+            CREATE TABLE tickets (LIKE tickets_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (purchase_date);
+            UPDATE tickets_unpartitioned SET purchase_date = NOW() WHERE purchase_date IS NULL;
+            ALTER TABLE tickets ALTER COLUMN purchase_date SET NOT NULL;
+            ALTER TABLE tickets ADD PRIMARY KEY (ticket_id, purchase_date);
+            """)
+        cursor.execute("SELECT MIN(purchase_date) FROM tickets_unpartitioned;")
+        oldest = cursor.fetchone()[0] or datetime.now()
+        current = month_start(date.today())
+        create_ticket_partitions(cursor, month_start(oldest), add_months(current, TICKET_PARTITION_MONTHS_AHEAD))
+
+        cursor.execute(f"""
+            INSERT INTO tickets ({columns}, purchase_date)
+            SELECT {columns}, purchase_date FROM tickets_unpartitioned;
+            """)
+        moved = cursor.rowcount
+        cursor.execute(create_ticket_ids_query)
+        cursor.execute("DROP TABLE tickets_unpartitioned;")
+        create_trigram_indexes(cursor)
+        conn.commit()
+        logging.info(f"Таблица tickets секционирована, перенесено билетов: {moved}.")
+        return moved
+    except Exception as e:
+        logging.error(f"Ошибка при секционировании таблицы tickets: {e}")
+        conn.rollback()
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def get_ticket_partitions() -> list | None:
+    """Секции билетов: [{'name', 'bound', 'rows'}] по возрастанию имени; rows — оценка из статистики."""
+    conn = connect_db()
+    if conn is None: return None
+    cursor = conn.cursor()
+    select_query = """
+    SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), GREATEST(c.reltuples, 0)::BIGINT
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'tickets'::regclass
+    ORDER BY c.relname;
+    """
+    try:
+        cursor.execute(select_query)
+        return [{'name': row[0], 'bound': row[1], 'rows': row[2]} for row in cursor.fetchall()]
+    except Exception as e:
+        logging.error(f"Ошибка при получении секций билетов: {e}")
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def archive_ticket_partition(name: str, fileobj, finalize) -> int | None:
+    """
+    Отсоединяет месячную секцию name, выгружает ее в fileobj (CSV с заголовком) и удаляет.
+    finalize() вызывается после выгрузки, до удаления секции: он должен закрыть файл и сбросить его на диск.
+    Одна транзакция: если выгрузка или finalize не удались, секция остается на месте.
+    Возвращает число выгруженных билетов или None при ошибке.
+    """
+    suffix = name[len(TICKET_PARTITION_PREFIX):]
+    if not name.startswith(TICKET_PARTITION_PREFIX) or len(suffix) != 6 or not suffix.isdigit():
+        logging.error(f"Недопустимое имя секции для архивации: {name}")
+        return None
+
+    conn = connect_db()
+    if conn is None: return None
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"ALTER TABLE tickets DETACH PARTITION {name};")
+        cursor.copy_expert(f"COPY (SELECT * FROM {name} ORDER BY purchase_date) TO STDOUT WITH CSV HEADER", fileobj)
+        cursor.execute(f"SELECT COUNT(*) FROM {name};")
+        archived = cursor.fetchone()[0]
+        finalize()
+        cursor.execute(f"DROP TABLE {name};")
+        conn.commit()
+        logging.info(f"Секция {name} заархивирована, билетов: {archived}.")
+        return archived
+    except Exception as e:
+        logging.error(f"Ошибка при архивации секции {name}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+# --- ИНСТРУМЕНТИРОВАНИЕ ---
+# Все функции модуля оборачиваются замером времени (метрики /metrics).
+# Вызов должен оставаться в самом конце файла, после объявления всех функций.
+# new_ticket_id не обращается к БД и не должен попадать в счетчик запросов
+instrument_functions(globals(), kind='db', exclude={'new_ticket_id'})
\ No newline at end of file
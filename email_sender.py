@@ -0,0 +1,210 @@
+# email_sender.py
+#
+# Отправка билетов на email покупателя из очереди email_outbox.
+# Билеты ставятся в очередь в той же транзакции, что и сохраняются (db_utils.enqueue_ticket_emails),
+# поэтому выдача билета администратором не ждет SMTP. Очередь разбирается пачками:
+#   - на Vercel — запросом GET /api/email-dispatch (Vercel Cron или внешний планировщик);
+#   - на сервере — циклом: python email_sender.py --loop
+#
+# Проверка без реального почтового сервера (локальная заглушка SMTP, печатает письма в консоль):
+#   python -m aiosmtpd -n -l localhost:1025
+#   SMTP_HOST=localhost SMTP_PORT=1025 SMTP_TLS=0 python email_sender.py --once
+
+import os
+import time
+import asyncio
+import logging
+import argparse
+from email.message import EmailMessage
+from dotenv import load_dotenv
+
+try:
+    import aiosmtplib
+except ImportError:
+    print("WARNING: aiosmtplib не установлен. Отправка билетов на email работать не будет.")
+    aiosmtplib = None
+
+load_dotenv()
+
+# Абсолютные импорты
+from db_utils import claim_email_batch, finish_email_batch
+from qr_render import render_compact_qr_png
+from ticket_render import render_ticket
+from metrics import increment
+
+SMTP_HOST = os.getenv("SMTP_HOST")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_USERNAME = os.getenv("SMTP_USERNAME")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+# '1' — STARTTLS (порт 587), 'ssl' — TLS с самого начала (порт 465), '0' — без шифрования (локальная заглушка)
+SMTP_TLS = os.getenv("SMTP_TLS", "1")
+SMTP_FROM = os.getenv("SMTP_FROM") or SMTP_USERNAME
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "20"))
+
+# Сколько SMTP-соединений держится открытыми и сколько писем забирается из очереди за раз
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4"))
+EMAIL_BATCH_SIZE = int(os.getenv("EMAIL_BATCH_SIZE", "50"))
+# Пауза цикла --loop, когда очередь пуста
+EMAIL_POLL_INTERVAL = float(os.getenv("EMAIL_POLL_INTERVAL", "10"))
+# Сколько секунд cron-запрос начинает новые пачки. Должно быть заметно меньше maxDuration функции:
+# иначе ее прервут посреди пачки, уже отправленные письма уйдут повторно после истечения аренды,
+# а каждая аренда расходует попытку
+EMAIL_DISPATCH_BUDGET_SECONDS = float(os.getenv("EMAIL_DISPATCH_BUDGET_SECONDS", "5"))
+
+EVENT_NAME = os.getenv("EVENT_NAME", "ReadyToDie")
+
+
+def build_ticket_email(item: dict, qr_png: bytes, ticket_pdf: bytes | None = None) -> EmailMessage:
+    """Собирает письмо с билетом: текст, QR-код и (если доступен) печатный билет PDF во вложении."""
+    message = EmailMessage()
+    message['From'] = SMTP_FROM
+    message['To'] = item['email']
+    message['Subject'] = f"Ваш билет на {EVENT_NAME}: {item['product_name']}"
+    message.set_content(
+        f"Здравствуйте, {item['buyer_name']}!\n\n"
+        f"Ваш билет «{item['product_name']}» оформлен.\n"
+        f"ID билета: {item['ticket_id']}\n\n"
+        "Покажите QR-код из вложения на входе. Билет активируется при сканировании.\n"
+    )
+    message.add_attachment(qr_png, maintype='image', subtype='png', filename=f"ticket_{item['ticket_id']}.png")
+    if ticket_pdf:
+        message.add_attachment(ticket_pdf, maintype='application', subtype='pdf',
+                               filename=f"ticket_{item['ticket_id']}.pdf")
+    return message
+
+
+def create_smtp_pool(size: int = SMTP_POOL_SIZE) -> asyncio.Queue:
+    """Создает пул SMTP-клиентов; соединение открывается при первом использовании клиента."""
+    pool = asyncio.Queue()
+    for _ in range(size):
+        pool.put_nowait(aiosmtplib.SMTP(
+            hostname=SMTP_HOST, port=SMTP_PORT, username=SMTP_USERNAME, password=SMTP_PASSWORD,
+            use_tls=SMTP_TLS == 'ssl', start_tls=SMTP_TLS == '1', timeout=SMTP_TIMEOUT
+        ))
+    return pool
+
+
+async def close_smtp_pool(pool: asyncio.Queue) -> None:
+    """Закрывает открытые соединения пула."""
+    while not pool.empty():
+        client = pool.get_nowait()
+        if client.is_connected:
+            try:
+                await client.quit()
+            except Exception:
+                client.close()
+
+
+async def send_pooled(pool: asyncio.Queue, message: EmailMessage) -> None:
+    """Отправляет письмо через свободное соединение пула; разорванное соединение переоткрывается один раз."""
+    client = await pool.get()
+    try:
+        if not client.is_connected:
+            await client.connect()
+        try:
+            await client.send_message(message)
+        except aiosmtplib.SMTPServerDisconnected:
+            await client.connect()
+            await client.send_message(message)
+    finally:
+        pool.put_nowait(client)
+
+
+async def dispatch_email_batch(pool: asyncio.Queue | None = None, limit: int = EMAIL_BATCH_SIZE) -> tuple:
+    """
+    Забирает пачку писем из очереди, отправляет их параллельно через пул и записывает результат
+    одной транзакцией. Без переданного пула создает временный. Возвращает (отправлено, ошибок).
+    """
+    if aiosmtplib is None or not SMTP_HOST:
+        logging.warning("Отправка email не настроена (нужны aiosmtplib и SMTP_HOST).")
+        return 0, 0
+
+    items = claim_email_batch(limit)
+    if not items:
+        return 0, 0
+
+    own_pool = pool is None
+    if own_pool:
+        pool = create_smtp_pool(min(SMTP_POOL_SIZE, len(items)))
+
+    async def send_one(item: dict):
+        # Рендер QR и PDF — работа CPU; в отдельном потоке он не задерживает отправку остальных писем
+        qr_png = await asyncio.to_thread(render_compact_qr_png, item['ticket_id'])
+        if qr_png is None:
+            raise RuntimeError("не удалось сгенерировать QR-код")
+        ticket_pdf = await asyncio.to_thread(render_ticket, item, 'PDF')
+        await send_pooled(pool, build_ticket_email(item, qr_png, ticket_pdf))
+
+    try:
+        results = await asyncio.gather(*(send_one(item) for item in items), return_exceptions=True)
+    finally:
+        if own_pool:
+            await close_smtp_pool(pool)
+
+    sent_ids = [item['id'] for item, result in zip(items, results) if not isinstance(result, BaseException)]
+    failures = [(item['id'], f"{type(result).__name__}: {result}")
+                for item, result in zip(items, results) if isinstance(result, BaseException)]
+    for item_id, error in failures:
+        logging.warning(f"Письмо {item_id} не отправлено: {error}")
+
+    finish_email_batch(sent_ids, failures)
+    increment('emails_sent', 'ok', len(sent_ids))
+    increment('emails_sent', 'error', len(failures))
+    logging.info(f"Отправлено писем с билетами: {len(sent_ids)}, ошибок: {len(failures)}.")
+    return len(sent_ids), len(failures)
+
+
+async def drain_outbox(max_batches: int = 10, budget_seconds: float = EMAIL_DISPATCH_BUDGET_SECONDS) -> tuple:
+    """
+    Разбирает очередь несколькими пачками через общий пул (для cron-запроса).
+    Новая пачка не начинается, если с начала вызова прошло budget_seconds. Возвращает (отправлено, ошибок).
+    """
+    if aiosmtplib is None or not SMTP_HOST:
+        logging.warning("Отправка email не настроена (нужны aiosmtplib и SMTP_HOST).")
+        return 0, 0
+
+    deadline = time.monotonic() + budget_seconds
+    pool = create_smtp_pool()
+    sent_total = failed_total = 0
+    try:
+        for _ in range(max_batches):
+            if time.monotonic() >= deadline:
+                logging.info("Время cron-запроса исчерпано, оставшиеся письма уйдут в следующий запуск.")
+                break
+            sent, failed = await dispatch_email_batch(pool)
+            sent_total += sent
+            failed_total += failed
+            if sent + failed < EMAIL_BATCH_SIZE:
+                break
+    finally:
+        await close_smtp_pool(pool)
+    return sent_total, failed_total
+
+
+async def run_loop() -> None:
+    """Бесконечный цикл отправки (для запуска на сервере); соединения пула переиспользуются между пачками."""
+    pool = create_smtp_pool()
+    try:
+        while True:
+            sent, failed = await dispatch_email_batch(pool)
+            if sent + failed < EMAIL_BATCH_SIZE:
+                await asyncio.sleep(EMAIL_POLL_INTERVAL)
+    finally:
+        await close_smtp_pool(pool)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Отправка билетов из очереди email_outbox.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--once', action='store_true', help="разобрать очередь и выйти (по умолчанию)")
+    mode.add_argument('--loop', action='store_true', help="работать постоянно, опрашивая очередь")
+    args = parser.parse_args()
+
+    if aiosmtplib is None or not SMTP_HOST:
+        parser.error("нужны установленный aiosmtplib и переменная SMTP_HOST")
+
+    if args.loop:
+        asyncio.run(run_loop())
+    else:
+        print(asyncio.run(drain_outbox()))
@@ -0,0 +1,56 @@
+# live_counters.py
+
+import os
+import time
+from datetime import datetime
+
+# Абсолютные импорты
+from db_utils import get_ticket_counters
+from utils import escape_html
+
+# Сколько секунд счетчики отдаются из памяти: табло на входе и /live опрашивают часто,
+# а в БД за это время уходит не больше одного запроса на инстанс
+LIVE_COUNTERS_TTL = float(os.getenv("LIVE_COUNTERS_TTL", "5"))
+
+# Последний снимок счетчиков
+counters_state = {'snapshot': None, 'fetched_at': None}
+
+
+def build_snapshot(rows: list) -> dict:
+    """Снимок для /live и /api/checkin: тарифы, итоги и время получения."""
+    sold = sum(row['sold'] for row in rows)
+    activated = sum(row['activated'] for row in rows)
+    return {
+        'products': rows,
+        'total': {'sold': sold, 'activated': activated, 'remaining': sold - activated},
+        'updated_at': datetime.now().isoformat(timespec='seconds'),
+    }
+
+
+def get_live_counters() -> dict | None:
+    """Счетчики входа; БД читается не чаще раза в LIVE_COUNTERS_TTL. При ошибке БД — прошлый снимок."""
+    now = time.monotonic()
+    if counters_state['fetched_at'] is not None and now - counters_state['fetched_at'] < LIVE_COUNTERS_TTL:
+        return counters_state['snapshot']
+
+    rows = get_ticket_counters()
+    counters_state['fetched_at'] = now
+    if rows is not None:
+        counters_state['snapshot'] = build_snapshot(rows)
+    return counters_state['snapshot']
+
+
+def format_live_counters(snapshot: dict | None) -> str:
+    """Текст (HTML) для команды /live."""
+    if snapshot is None:
+        return "❌ Не удалось получить счетчики входа."
+
+    total = snapshot['total']
+    lines = [
+        f"🚪 <b>Вход</b> (на {snapshot['updated_at'][11:]})",
+        f"Вошло: <b>{total['activated']}</b> из {total['sold']} (ожидается еще {total['remaining']})",
+        "",
+    ]
+    for row in snapshot['products']:
+        lines.append(f"{escape_html(row['product_name'])}: {row['activated']} / {row['sold']}")
+    return "\n".join(lines)
@@ -0,0 +1,304 @@
+# metrics.py
+
+import time
+import logging
+import inspect
+import functools
+import threading
+import contextvars
+from bisect import bisect_left
+
+from telegram.request import BaseRequest
+
+# Верхние границы корзин гистограммы задержек (секунды)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Модули, ошибки из которых (logging.error внутри except) засчитываются в error rate
+LOGGED_ERROR_KINDS = {
+    'db_utils': 'db',
+    'user_handlers': 'handler',
+    'admin_handlers': 'handler',
+    'bot': 'handler',
+    'utils': 'handler',
+}
+
+
+class LatencyStats:
+    """Счетчик вызовов, ошибок и гистограмма задержек одной операции."""
+    __slots__ = ('count', 'errors', 'total', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # последняя корзина — +Inf
+
+    def observe(self, seconds: float, error: bool) -> None:
+        self.count += 1
+        self.total += seconds
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        if error:
+            self.errors += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по гистограмме (верхняя граница корзины)."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float('inf')
+        return float('inf')
+
+
+# Реестр: (kind, name) -> LatencyStats; kind = 'handler' | 'db' | 'telegram'
+latency_registry = {}
+# Простые счетчики событий: (name, label) -> int
+event_counters = {}
+registry_lock = threading.Lock()
+# Необязательный счетчик вызовов текущей задачи: {kind: n}. Его выставляет нагрузочный
+# симулятор, чтобы привязать запросы к БД и Bot API к конкретному шагу диалога.
+call_counter = contextvars.ContextVar('call_counter', default=None)
+
+
+def observe(kind: str, name: str, seconds: float, error: bool = False) -> None:
+    """Записывает одно измерение задержки."""
+    counter = call_counter.get()
+    if counter is not None:
+        counter[kind] = counter.get(kind, 0) + 1
+    key = (kind, name)
+    with registry_lock:
+        stats = latency_registry.get(key)
+        if stats is None:
+            stats = latency_registry[key] = LatencyStats()
+        stats.observe(seconds, error)
+
+
+def record_error(kind: str, name: str) -> None:
+    """Засчитывает ошибку без измерения задержки (ошибка перехвачена внутри функции)."""
+    key = (kind, name)
+    with registry_lock:
+        stats = latency_registry.get(key)
+        if stats is None:
+            stats = latency_registry[key] = LatencyStats()
+        stats.errors += 1
+
+
+def increment(name: str, label: str = '', value: int = 1) -> None:
+    """Увеличивает счетчик события (например, отброшенных обновлений)."""
+    key = (name, label)
+    with registry_lock:
+        event_counters[key] = event_counters.get(key, 0) + value
+
+
+def timed(kind: str, name: str | None = None):
+    """Декоратор замера времени для обычных и асинхронных функций."""
+
+    def decorator(func):
+        metric_name = name or func.__qualname__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                error = False
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    error = True
+                    raise
+                finally:
+                    observe(kind, metric_name, time.perf_counter() - started, error)
+
+            async_wrapper.__instrumented__ = True
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            error = False
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                observe(kind, metric_name, time.perf_counter() - started, error)
+
+        wrapper.__instrumented__ = True
+        return wrapper
+
+    return decorator
+
+
+def instrument_functions(namespace: dict, kind: str, exclude: set = frozenset()) -> None:
+    """
+    Оборачивает замером все функции, объявленные в модуле (вызывается в конце модуля
+    через globals(), чтобы импортирующие модули получили уже обернутые функции).
+    exclude — имена функций, которые оборачивать не нужно.
+    """
+    module_name = namespace.get('__name__')
+    for attr, value in list(namespace.items()):
+        if (inspect.isfunction(value) and value.__module__ == module_name and attr not in exclude
+                and not getattr(value, '__instrumented__', False)):
+            namespace[attr] = timed(kind, attr)(value)
+
+
+def instrument_handler(handler) -> None:
+    """Оборачивает callback хендлера; для ConversationHandler — рекурсивно все вложенные хендлеры."""
+    nested = []
+    if hasattr(handler, 'entry_points') and hasattr(handler, 'states'):
+        nested.extend(handler.entry_points)
+        for state_handlers in handler.states.values():
+            nested.extend(state_handlers)
+        nested.extend(handler.fallbacks)
+
+    if nested:
+        for inner in nested:
+            instrument_handler(inner)
+        return
+
+    callback = getattr(handler, 'callback', None)
+    if callback is not None and not getattr(callback, '__instrumented__', False):
+        handler.callback = timed('handler')(callback)
+
+
+def instrument_application(application) -> None:
+    """Оборачивает замером все хендлеры, зарегистрированные в Application."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            instrument_handler(handler)
+
+
+class ErrorLogCounter(logging.Handler):
+    """Считает logging.error из функций бота: они перехватывают исключения и сами их не пробрасывают."""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        kind = LOGGED_ERROR_KINDS.get(record.module)
+        if kind:
+            record_error(kind, record.funcName)
+
+
+def install_error_counter() -> None:
+    """Подключает ErrorLogCounter к корневому логгеру (один раз)."""
+    root = logging.getLogger()
+    if not any(isinstance(h, ErrorLogCounter) for h in root.handlers):
+        root.addHandler(ErrorLogCounter())
+
+
+class InstrumentedRequest(BaseRequest):
+    """Обертка над транспортом Bot API: замеряет каждый исходящий вызов (sendMessage, sendPhoto, ...)."""
+
+    def __init__(self, inner: BaseRequest):
+        self._inner = inner
+
+    @property
+    def read_timeout(self):
+        return self._inner.read_timeout
+
+    async def initialize(self) -> None:
+        await self._inner.initialize()
+
+    async def shutdown(self) -> None:
+        await self._inner.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data=None,
+                         read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE,
+                         connect_timeout=BaseRequest.DEFAULT_NONE, pool_timeout=BaseRequest.DEFAULT_NONE):
+        endpoint = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        error = True
+        try:
+            code, payload = await self._inner.do_request(
+                url, method, request_data,
+                read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+            )
+            error = code >= 400
+            return code, payload
+        finally:
+            observe('telegram', endpoint, time.perf_counter() - started, error)
+
+
+# --- ВЫВОД ---
+
+def snapshot() -> list:
+    """Копия реестра в виде списка словарей, отсортированного по суммарному времени."""
+    with registry_lock:
+        items = [(kind, name, stats.count, stats.errors, stats.total, list(stats.buckets), stats)
+                 for (kind, name), stats in latency_registry.items()]
+    rows = []
+    for kind, name, count, errors, total, buckets, stats in items:
+        rows.append({
+            'kind': kind, 'name': name, 'count': count, 'errors': errors, 'total': total,
+            'avg': total / count if count else 0.0,
+            'p50': stats.quantile(0.5), 'p95': stats.quantile(0.95),
+            'buckets': buckets,
+        })
+    rows.sort(key=lambda r: r['total'], reverse=True)
+    return rows
+
+
+def format_seconds(value: float) -> str:
+    if value == float('inf'):
+        return '>10s'
+    return f"{value * 1000:.0f}ms" if value >= 0.001 else f"{value * 1000:.2f}ms"
+
+
+def render_text(limit: int = 25) -> str:
+    """Краткая таблица для команды /metrics (HTML, моноширинный блок)."""
+    rows = snapshot()[:limit]
+    if not rows:
+        return "📊 Метрик пока нет."
+
+    lines = [f"{'операция':<34} {'n':>6} {'err':>4} {'avg':>7} {'p50':>7} {'p95':>7}"]
+    for r in rows:
+        label = f"{r['kind']}:{r['name']}"[:34]
+        lines.append(f"{label:<34} {r['count']:>6} {r['errors']:>4} {format_seconds(r['avg']):>7} "
+                     f"{format_seconds(r['p50']):>7} {format_seconds(r['p95']):>7}")
+
+    with registry_lock:
+        counters = sorted(event_counters.items())
+    if counters:
+        lines.append("")
+        for (name, label), value in counters:
+            lines.append(f"{name}{'[' + label + ']' if label else ''}: {value}")
+
+    return "📊 <b>Метрики (с момента запуска инстанса)</b>\n<pre>" + "\n".join(lines) + "</pre>"
+
+
+def render_prometheus() -> str:
+    """Метрики в текстовом формате Prometheus."""
+    out = [
+        "# HELP readytodie_latency_seconds Latency of handlers, DB calls and Bot API calls.",
+        "# TYPE readytodie_latency_seconds histogram",
+    ]
+    rows = snapshot()
+    for r in rows:
+        labels = f'kind="{r["kind"]}",name="{r["name"]}"'
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS, r['buckets']):
+            cumulative += n
+            out.append(f'readytodie_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        out.append(f'readytodie_latency_seconds_bucket{{{labels},le="+Inf"}} {r["count"]}')
+        out.append(f'readytodie_latency_seconds_sum{{{labels}}} {r["total"]:.6f}')
+        out.append(f'readytodie_latency_seconds_count{{{labels}}} {r["count"]}')
+
+    out.append("# HELP readytodie_errors_total Errors raised or logged by instrumented operations.")
+    out.append("# TYPE readytodie_errors_total counter")
+    for r in rows:
+        out.append(f'readytodie_errors_total{{kind="{r["kind"]}",name="{r["name"]}"}} {r["errors"]}')
+
+    with registry_lock:
+        counters = sorted(event_counters.items())
+    out.append("# HELP readytodie_events_total Event counters (throttled updates, etc).")
+    out.append("# TYPE readytodie_events_total counter")
+    for (name, label), value in counters:
+        out.append(f'readytodie_events_total{{event="{name}",label="{label}"}} {value}')
+
+    return "\n".join(out) + "\n"
@@ -0,0 +1,99 @@
+# promo_index.py
+
+import os
+import time
+import logging
+from datetime import datetime
+
+# Абсолютные импорты
+from db_utils import get_promo_index_rows, reconcile_promo_uses
+from versioned_cache import new_cache_state, bump_version, is_current_version, is_fresh, store
+
+# Промокод, созданный или выключенный в другом инстансе, начинает (или перестает) приниматься
+# здесь не позже чем через этот срок; окончательное решение при списании принимает БД (redeem_promo)
+PROMO_INDEX_TTL = int(os.getenv("PROMO_INDEX_TTL", "60"))
+# Как часто суммы слотов сводятся в promocodes.uses (в serverless нет фоновых задач)
+PROMO_RECONCILE_INTERVAL = int(os.getenv("PROMO_RECONCILE_INTERVAL", "300"))
+
+# Версия привязок промокодов и последний собранный индекс (value); reconciled_at — время последней сверки
+promo_state = new_cache_state(reconciled_at=None)
+
+
+def bump_promo_version() -> int:
+    """Инвалидирует индекс (вызывается после создания промокода, смены статуса или привязок)."""
+    return bump_version(promo_state)
+
+
+def build_promo_index(rows: list) -> dict:
+    """
+    Собирает индекс из строк get_promo_index_rows:
+    'promos' — {code: данные промокода}, 'scoped' — множество пар (code, product_id).
+    Промокод без привязок действует на все тарифы и в 'scoped' не попадает.
+    """
+    promos = {}
+    scoped = set()
+    for code, promo_id, discount_percent, is_active, max_uses, expires_at, product_id in rows:
+        promo = promos.get(code)
+        if promo is None:
+            promo = promos[code] = {
+                'id': promo_id, 'code': code, 'discount_percent': discount_percent,
+                'is_active': is_active, 'max_uses': max_uses, 'expires_at': expires_at, 'scoped': False
+            }
+        if product_id is not None:
+            promo['scoped'] = True
+            scoped.add((code, product_id))
+    return {'promos': promos, 'scoped': scoped}
+
+
+def get_promo_index() -> dict | None:
+    """Возвращает индекс; БД читается только при смене версии или по истечении PROMO_INDEX_TTL."""
+    now = time.monotonic()
+    if is_fresh(promo_state, PROMO_INDEX_TTL, now):
+        return promo_state['value']
+
+    # После изменения промокодов в этом процессе (новая версия) читаем основную БД: реплика может отставать.
+    # Плановое обновление по PROMO_INDEX_TTL читает реплику
+    rows = get_promo_index_rows(allow_stale=is_current_version(promo_state))
+    if rows is None:
+        # Ошибка БД: отдаем прошлый индекс, если он есть, и повторим попытку при следующем вызове
+        return promo_state['value']
+
+    index = store(promo_state, build_promo_index(rows), now)
+    logging.info(f"Индекс промокодов пересобран (версия {promo_state['version']}, кодов: {len(index['promos'])}).")
+    return index
+
+
+def check_promo(code: str, product_id: int) -> tuple:
+    """
+    Проверяет промокод для тарифа одним поиском в индексе.
+    Возвращает (промокод, 'ok') или (None | промокод, причина):
+    'not_found', 'inactive', 'expired', 'wrong_product' или 'unavailable' (индекс не загружен).
+    Исчерпание лимита здесь не проверяется: счетчик живой и хранится в БД.
+    """
+    index = get_promo_index()
+    if index is None:
+        return None, 'unavailable'
+
+    promo = index['promos'].get(code)
+    if promo is None:
+        return None, 'not_found'
+    if not promo['is_active']:
+        return promo, 'inactive'
+    if promo['expires_at'] is not None and promo['expires_at'] <= datetime.now():
+        return promo, 'expired'
+    if promo['scoped'] and (code, product_id) not in index['scoped']:
+        return promo, 'wrong_product'
+    return promo, 'ok'
+
+
+def maybe_reconcile_promo_uses(force: bool = False) -> None:
+    """Сводит счетчики слотов в promocodes.uses не чаще раза в PROMO_RECONCILE_INTERVAL."""
+    now = time.monotonic()
+    last = promo_state['reconciled_at']
+    if not force and last is not None and now - last < PROMO_RECONCILE_INTERVAL:
+        return
+
+    promo_state['reconciled_at'] = now
+    updated = reconcile_promo_uses()
+    if updated:
+        logging.info(f"Сверены счетчики использований промокодов: {updated}.")
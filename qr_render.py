@@ -0,0 +1,100 @@
+# qr_render.py
+
+import os
+import logging
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+
+# Импорты для пакетного рендеринга QR-кодов
+try:
+    import qrcode
+    import numpy as np
+    from PIL import Image
+except ImportError:
+    logging.warning("qrcode, numpy или Pillow не установлены. Пакетный рендер QR-кодов работать не будет.")
+    qrcode = None
+    np = None
+    Image = None
+
+# Параметры по умолчанию совпадают с generate_qr_code в user_handlers.py
+QR_BOX_SIZE = 10
+QR_BORDER = 4
+
+# Компактный режим: 1-битный PNG с уменьшенным модулем и максимальным сжатием.
+# 8 px на модуль с рамкой 4 модуля дают ~230 px для билета версии 1 — с запасом для камеры телефона.
+QR_COMPACT_BOX_SIZE = int(os.getenv("QR_COMPACT_BOX_SIZE", "8"))
+
+# Сколько билетов отдается одному процессу за раз при параллельном рендере
+QR_BATCH_CHUNK_SIZE = int(os.getenv("QR_BATCH_CHUNK_SIZE", "256"))
+
+
+def qr_matrix(ticket_id: str, border: int = QR_BORDER):
+    """Возвращает матрицу модулей QR-кода (True = черный модуль) вместе с рамкой."""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        border=border,
+    )
+    qr.add_data(ticket_id)
+    qr.make(fit=True)
+    return np.array(qr.get_matrix(), dtype=bool)
+
+
+def render_matrix_png(matrix, box_size: int = QR_BOX_SIZE, **save_options) -> bytes:
+    """
+    Масштабирует матрицу модулей до 1-битного изображения и кодирует его в PNG.
+
+    Вместо отрисовки каждого модуля (как делает PIL-фабрика qrcode) матрица
+    растягивается целиком через np.repeat и упаковывается по 8 пикселей в байт.
+    """
+    # В режиме '1' у PIL бит 1 = белый пиксель, поэтому инвертируем матрицу
+    pixels = np.repeat(np.repeat(~matrix, box_size, axis=0), box_size, axis=1)
+    height, width = pixels.shape
+    image = Image.frombytes('1', (width, height), np.packbits(pixels, axis=1).tobytes())
+
+    bio = BytesIO()
+    image.save(bio, 'PNG', **save_options)
+    return bio.getvalue()
+
+
+def render_qr_png(ticket_id: str, box_size: int = QR_BOX_SIZE, border: int = QR_BORDER, **save_options) -> bytes:
+    """Рендерит PNG QR-кода для одного билета через векторизованный путь."""
+    return render_matrix_png(qr_matrix(ticket_id, border), box_size, **save_options)
+
+
+def render_compact_qr_png(ticket_id: str) -> bytes | None:
+    """Рендерит компактный 1-битный PNG (optimize + compress_level=9). None, если нет зависимостей."""
+    if qrcode is None or np is None or Image is None:
+        return None
+    return render_qr_png(ticket_id, box_size=QR_COMPACT_BOX_SIZE, optimize=True, compress_level=9)
+
+
+def render_qr_chunk(ticket_ids: list, box_size: int = QR_BOX_SIZE, border: int = QR_BORDER) -> list:
+    """Рендерит список билетов в одном процессе (единица работы для пула процессов)."""
+    return [render_qr_png(ticket_id, box_size, border) for ticket_id in ticket_ids]
+
+
+def render_qr_batch(ticket_ids: list, box_size: int = QR_BOX_SIZE, border: int = QR_BORDER,
+                    workers: int | None = None) -> dict:
+    """
+    Рендерит PNG QR-кодов для пачки билетов за один вызов.
+
+    Возвращает словарь {ticket_id: png_bytes}. При workers > 1 пачка делится на
+    чанки по QR_BATCH_CHUNK_SIZE и рендерится в пуле процессов.
+    """
+    if qrcode is None or np is None or Image is None:
+        return {}
+
+    ticket_ids = list(ticket_ids)
+
+    if not workers or workers <= 1 or len(ticket_ids) <= QR_BATCH_CHUNK_SIZE:
+        return dict(zip(ticket_ids, render_qr_chunk(ticket_ids, box_size, border)))
+
+    chunks = [ticket_ids[i:i + QR_BATCH_CHUNK_SIZE] for i in range(0, len(ticket_ids), QR_BATCH_CHUNK_SIZE)]
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(render_qr_chunk, chunk, box_size, border) for chunk in chunks]
+        for chunk, future in zip(chunks, futures):
+            results.update(zip(chunk, future.result()))
+
+    return results
@@ -0,0 +1,118 @@
+# rate_limit.py
+
+import os
+import time
+import logging
+from telegram import Update
+from telegram.ext import ContextTypes, ApplicationHandlerStop
+
+# Абсолютные импорты
+from metrics import increment
+from admin_roles import get_admin_role
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+# Не чаще раза в столько секунд пользователь получает сообщение "слишком часто"
+RATE_LIMIT_NOTICE_INTERVAL = int(os.getenv("RATE_LIMIT_NOTICE_INTERVAL", "30"))
+# Сколько ключей корзин держится в памяти до очистки заполненных
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "20000"))
+
+# Корзины токенов: действие -> (емкость, пополнение в секунду).
+# 'user' — общий лимит пользователя на любые апдейты; остальные — по типу апдейта/команде.
+BUCKETS = {
+    'user': (int(os.getenv("RATE_LIMIT_USER_BURST", "20")), float(os.getenv("RATE_LIMIT_USER_RATE", "1.0"))),
+    'text': (8, 0.5),
+    'callback': (15, 2.0),
+    'photo': (10, 1.0),
+    'command': (5, 0.2),
+    '/buy': (3, 0.1),
+    # Попытки промокода расходуются в process_promo_input (перебор кодов)
+    'promo': (int(os.getenv("RATE_LIMIT_PROMO_BURST", "5")), float(os.getenv("RATE_LIMIT_PROMO_RATE", "0.1"))),
+}
+
+# (user_id, действие) -> [токены, время последнего обновления]
+buckets = {}
+# user_id -> время последнего уведомления об ограничении
+notices = {}
+
+
+def prune_buckets(now: float) -> None:
+    """Удаляет корзины, которые за время простоя уже заполнились бы полностью."""
+    for key in [key for key, (tokens, updated) in buckets.items()
+                if tokens + (now - updated) * BUCKETS[key[1]][1] >= BUCKETS[key[1]][0]]:
+        del buckets[key]
+    for user_id in [u for u, at in notices.items() if now - at >= RATE_LIMIT_NOTICE_INTERVAL]:
+        del notices[user_id]
+
+
+def consume(user_id: int, action: str, now: float | None = None) -> bool:
+    """Забирает токен из корзины (user_id, action). False — лимит исчерпан."""
+    capacity, rate = BUCKETS[action]
+    now = time.monotonic() if now is None else now
+    key = (user_id, action)
+
+    bucket = buckets.get(key)
+    if bucket is None:
+        if len(buckets) >= RATE_LIMIT_MAX_KEYS:
+            prune_buckets(now)
+        bucket = buckets[key] = [float(capacity), now]
+    else:
+        bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+
+    if bucket[0] < 1.0:
+        return False
+    bucket[0] -= 1.0
+    return True
+
+
+def classify_update(update: Update) -> list:
+    """Список корзин, из которых апдейт забирает по токену (общая корзина пользователя — первой)."""
+    actions = ['user']
+    if update.callback_query:
+        actions.append('callback')
+    elif update.message:
+        text = update.message.text or ''
+        if text.startswith('/'):
+            command = text.split()[0].split('@')[0].lower()
+            actions.append(command if command in BUCKETS else 'command')
+        elif update.message.photo:
+            actions.append('photo')
+        else:
+            actions.append('text')
+    return actions
+
+
+def should_notify(user_id: int, now: float) -> bool:
+    """Уведомление об ограничении отправляется не чаще раза в RATE_LIMIT_NOTICE_INTERVAL."""
+    last = notices.get(user_id)
+    if last is not None and now - last < RATE_LIMIT_NOTICE_INTERVAL:
+        return False
+    notices[user_id] = now
+    return True
+
+
+async def throttle_updates(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Хендлер группы -3: отбрасывает апдейты сверх лимита до логирования и основных хендлеров.
+    Сотрудники (сканеры на входе, кассиры) не ограничиваются.
+    """
+    user = update.effective_user
+    if not RATE_LIMIT_ENABLED or user is None or get_admin_role(user.id) is not None:
+        return
+
+    now = time.monotonic()
+    for action in classify_update(update):
+        if consume(user.id, action, now):
+            continue
+
+        increment('throttled_updates', action)
+        if should_notify(user.id, now):
+            logging.warning(f"Пользователь {user.id} превысил лимит '{action}', апдейты отбрасываются.")
+            try:
+                if update.callback_query:
+                    await update.callback_query.answer("⏳ Слишком много запросов. Подождите немного.")
+                elif update.effective_message:
+                    await update.effective_message.reply_text("⏳ Слишком много запросов. Подождите немного.")
+            except Exception as e:
+                logging.warning(f"Не удалось отправить уведомление об ограничении {user.id}: {e}")
+        raise ApplicationHandlerStop
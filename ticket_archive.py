@@ -0,0 +1,133 @@
+# ticket_archive.py
+#
+# Обслуживание секционированной таблицы tickets (секции по месяцам purchase_date).
+#   python ticket_archive.py migrate                  — перевести старую несекционированную таблицу
+#   python ticket_archive.py ensure-partitions        — создать секции на текущий и следующие месяцы
+#   python ticket_archive.py list                     — показать секции и оценку числа билетов
+#   python ticket_archive.py archive --before 2025-09 — выгрузить в archive/*.csv.gz и удалить секции до сентября 2025
+#
+# Итоги продаж и счетчики входа (sales_daily, ticket_counters) хранятся отдельно и после архивации не меняются.
+
+import io
+import os
+import gzip
+import logging
+import argparse
+from datetime import date, datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Абсолютные импорты
+from db_utils import (
+    TICKET_PARTITION_MONTHS_AHEAD, TICKET_PARTITION_PREFIX, month_start, ticket_partition_name,
+    migrate_tickets_to_partitions, ensure_ticket_partitions_now, get_ticket_partitions, archive_ticket_partition
+)
+
+ARCHIVE_DIR = os.getenv("TICKET_ARCHIVE_DIR", "archive")
+
+
+def parse_month(value: str) -> date:
+    """Месяц в формате ГГГГ-ММ для argparse."""
+    try:
+        return datetime.strptime(value, "%Y-%m").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError("месяц нужно указать в формате ГГГГ-ММ")
+
+
+def partitions_before(partitions: list, before: date) -> list:
+    """Имена месячных секций, целиком лежащих раньше месяца before."""
+    limit = ticket_partition_name(before)
+    return [p['name'] for p in partitions
+            if p['name'].startswith(TICKET_PARTITION_PREFIX) and p['name'] < limit]
+
+
+def archive_partition_to_file(name: str, directory: str) -> int | None:
+    """
+    Архивирует секцию в directory/<name>.csv.gz. Файл пишется под временным именем; секция удаляется
+    только после того, как архив закрыт, сброшен на диск (fsync) и переименован в итоговое имя.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{name}.csv.gz")
+    tmp_path = path + ".part"
+    raw = open(tmp_path, 'wb')
+    text = io.TextIOWrapper(gzip.GzipFile(fileobj=raw, mode='wb'), encoding='utf-8', newline='')
+
+    def finalize():
+        # Закрытие дописывает трейлер gzip; ошибка здесь (например, нет места) отменяет удаление секции
+        text.close()
+        raw.flush()
+        os.fsync(raw.fileno())
+        raw.close()
+        os.replace(tmp_path, path)
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    try:
+        archived = archive_ticket_partition(name, text, finalize)
+    finally:
+        raw.close()
+    if archived is None:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+    return archived
+
+
+def main() -> int:
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Секции и архив таблицы билетов.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('migrate', help="секционировать существующую таблицу tickets")
+    ensure = commands.add_parser('ensure-partitions', help="создать секции на ближайшие месяцы")
+    ensure.add_argument('--months-ahead', type=int, default=TICKET_PARTITION_MONTHS_AHEAD)
+    commands.add_parser('list', help="показать секции")
+    archive = commands.add_parser('archive', help="выгрузить и удалить старые секции")
+    archive.add_argument('--before', type=parse_month, required=True, help="первый сохраняемый месяц, ГГГГ-ММ")
+    archive.add_argument('--dir', default=ARCHIVE_DIR, help=f"каталог архива (по умолчанию {ARCHIVE_DIR})")
+    archive.add_argument('--dry-run', action='store_true', help="только показать, что будет заархивировано")
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        moved = migrate_tickets_to_partitions()
+        if moved is None:
+            return 1
+        print(f"Перенесено билетов: {moved}." if moved else "Таблица уже секционирована.")
+        return 0
+
+    if args.command == 'ensure-partitions':
+        return 0 if ensure_ticket_partitions_now(args.months_ahead) else 1
+
+    partitions = get_ticket_partitions()
+    if partitions is None:
+        return 1
+
+    if args.command == 'list':
+        for partition in partitions:
+            print(f"{partition['name']:<20} ~{partition['rows']:>8}  {partition['bound']}")
+        return 0
+
+    if args.before > month_start(date.today()):
+        parser.error("нельзя архивировать текущий и будущие месяцы")
+
+    names = partitions_before(partitions, args.before)
+    if not names:
+        print("Нет секций для архивации.")
+        return 0
+    for name in names:
+        if args.dry_run:
+            print(f"Будет заархивирована: {name}")
+            continue
+        archived = archive_partition_to_file(name, args.dir)
+        if archived is None:
+            print(f"Ошибка при архивации {name}, остальные секции не тронуты.")
+            return 1
+        print(f"{name}: {archived} билетов -> {os.path.join(args.dir, name + '.csv.gz')}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,189 @@
+# ticket_render.py
+#
+# Печатный билет с оформлением мероприятия: тариф, имя покупателя, ID и QR-код.
+# Неизменная часть (фон, заголовок, подписи, логотип) рисуется один раз и хранится готовым изображением;
+# для каждого билета на копию шаблона наносятся только текст и QR. Готовые PNG/PDF кэшируются по билету,
+# а file_id отправленного в Telegram фото запоминается — повторная отправка не загружает файл заново.
+
+import os
+import logging
+from io import BytesIO
+from collections import OrderedDict
+
+try:
+    import numpy as np
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    logging.warning("numpy или Pillow не установлены. Оформленные билеты рендериться не будут.")
+    np = None
+    Image = None
+
+# Абсолютные импорты
+from qr_render import qr_matrix, qrcode
+
+# '0' — отправлять голый QR-код, как раньше
+TICKET_BRANDED = os.getenv("TICKET_BRANDED", "1") == "1"
+EVENT_NAME = os.getenv("EVENT_NAME", "ReadyToDie")
+# Оформление: цвета шаблона, необязательный логотип (PNG с прозрачностью) и шрифт с кириллицей
+TICKET_BG_COLOR = os.getenv("TICKET_BG_COLOR", "#141414")
+TICKET_ACCENT_COLOR = os.getenv("TICKET_ACCENT_COLOR", "#E63946")
+TICKET_LOGO_PATH = os.getenv("TICKET_LOGO_PATH")
+TICKET_FONT_PATH = os.getenv("TICKET_FONT_PATH")
+TICKET_BOLD_FONT_PATH = os.getenv("TICKET_BOLD_FONT_PATH")
+# Сколько готовых билетов и file_id держится в памяти
+TICKET_CACHE_SIZE = int(os.getenv("TICKET_CACHE_SIZE", "256"))
+
+# Геометрия билета (px): слева — текст, справа за линией отрыва — QR-код
+TICKET_SIZE = (1200, 560)
+QR_AREA = (800, 80, 1140, 420)
+FONT_CANDIDATES = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "DejaVuSans.ttf",
+]
+BOLD_FONT_CANDIDATES = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf",
+    "DejaVuSans-Bold.ttf",
+]
+
+# Шаблон и шрифты (собираются при первом рендере)
+template_state = {'image': None, 'fonts': None}
+# (ticket_id, формат, тариф, имя) -> байты файла
+rendered_cache = OrderedDict()
+# ticket_id -> file_id фото билета на серверах Telegram
+file_id_cache = OrderedDict()
+
+
+def load_font(paths: list, size: int):
+    """Первый доступный TrueType-шрифт из списка; встроенный шрифт Pillow — если ни одного нет."""
+    for path in paths:
+        if not path:
+            continue
+        try:
+            return ImageFont.truetype(path, size)
+        except OSError:
+            continue
+    logging.warning("Шрифт с кириллицей не найден (TICKET_FONT_PATH), используется встроенный.")
+    return ImageFont.load_default(size)
+
+
+def get_fonts() -> dict:
+    """Шрифты шаблона, загружаются один раз."""
+    if template_state['fonts'] is None:
+        regular = [TICKET_FONT_PATH] + FONT_CANDIDATES
+        bold = [TICKET_BOLD_FONT_PATH, TICKET_FONT_PATH] + BOLD_FONT_CANDIDATES
+        template_state['fonts'] = {
+            'title': load_font(bold, 56),
+            'label': load_font(regular, 22),
+            'value': load_font(bold, 40),
+            'id': load_font(bold, 34),
+            'note': load_font(regular, 20),
+        }
+    return template_state['fonts']
+
+
+def build_template():
+    """Рисует неизменную часть билета: фон, полосу, заголовок, подписи полей, линию отрыва и логотип."""
+    fonts = get_fonts()
+    width, height = TICKET_SIZE
+    image = Image.new('RGB', TICKET_SIZE, TICKET_BG_COLOR)
+    draw = ImageDraw.Draw(image)
+
+    draw.rectangle((0, 0, 24, height), fill=TICKET_ACCENT_COLOR)
+    draw.text((70, 50), EVENT_NAME, font=fonts['title'], fill='white')
+    for y, label in ((170, "ТАРИФ"), (270, "ИМЯ"), (370, "ID БИЛЕТА")):
+        draw.text((70, y), label, font=fonts['label'], fill=TICKET_ACCENT_COLOR)
+    draw.text((70, height - 90), "Билет активируется при сканировании на входе.", font=fonts['note'], fill='#9A9A9A')
+    draw.text((70, height - 60), "Не передавайте QR-код другим.", font=fonts['note'], fill='#9A9A9A')
+
+    # Линия отрыва и белая подложка под QR-код
+    for y in range(20, height - 20, 24):
+        draw.line((760, y, 760, y + 12), fill='#5A5A5A', width=3)
+    draw.rounded_rectangle(QR_AREA, radius=16, fill='white')
+
+    if TICKET_LOGO_PATH:
+        try:
+            logo = Image.open(TICKET_LOGO_PATH).convert('RGBA')
+            logo.thumbnail((200, 90))
+            image.paste(logo, (width - logo.width - 40, height - logo.height - 30), logo)
+        except OSError as e:
+            logging.warning(f"Не удалось загрузить логотип билета {TICKET_LOGO_PATH}: {e}")
+
+    return image
+
+
+def get_template():
+    """Готовый шаблон билета (рисуется один раз на процесс)."""
+    if template_state['image'] is None:
+        template_state['image'] = build_template()
+    return template_state['image']
+
+
+def fit_text(draw, text: str, font, max_width: int) -> str:
+    """Обрезает текст с многоточием, чтобы он поместился в max_width."""
+    if draw.textlength(text, font=font) <= max_width:
+        return text
+    while text and draw.textlength(text + '…', font=font) > max_width:
+        text = text[:-1]
+    return text + '…'
+
+
+def stamp_qr(image, ticket_id: str) -> None:
+    """Наносит QR-код в область QR_AREA: матрица растягивается целым числом пикселей на модуль."""
+    matrix = qr_matrix(ticket_id, border=2)
+    left, top, right, bottom = QR_AREA
+    box_size = min(right - left - 20, bottom - top - 20) // matrix.shape[0]
+    pixels = np.repeat(np.repeat(~matrix, box_size, axis=0), box_size, axis=1).astype(np.uint8) * 255
+    qr_image = Image.fromarray(pixels)
+    image.paste(qr_image, (left + (right - left - qr_image.width) // 2, top + (bottom - top - qr_image.height) // 2))
+
+
+def render_ticket(ticket: dict, fmt: str = 'PNG') -> bytes | None:
+    """
+    Рендерит оформленный билет в PNG или PDF.
+    ticket — словарь с ticket_id, product_name и buyer_name.
+    None, если оформление отключено (TICKET_BRANDED=0) или нет Pillow/numpy/qrcode.
+    """
+    if not TICKET_BRANDED or Image is None or np is None or qrcode is None:
+        return None
+
+    key = (ticket['ticket_id'], fmt, ticket['product_name'], ticket.get('buyer_name') or '')
+    cached = rendered_cache.get(key)
+    if cached is not None:
+        rendered_cache.move_to_end(key)
+        return cached
+
+    fonts = get_fonts()
+    image = get_template().copy()
+    draw = ImageDraw.Draw(image)
+    draw.text((70, 200), fit_text(draw, ticket['product_name'], fonts['value'], 660), font=fonts['value'], fill='white')
+    draw.text((70, 300), fit_text(draw, ticket.get('buyer_name') or '—', fonts['value'], 660),
+              font=fonts['value'], fill='white')
+    draw.text((70, 400), ticket['ticket_id'], font=fonts['id'], fill='white')
+    stamp_qr(image, ticket['ticket_id'])
+
+    bio = BytesIO()
+    if fmt == 'PDF':
+        image.save(bio, 'PDF', resolution=150)
+    else:
+        image.save(bio, 'PNG')
+    data = bio.getvalue()
+
+    rendered_cache[key] = data
+    if len(rendered_cache) > TICKET_CACHE_SIZE:
+        rendered_cache.popitem(last=False)
+    return data
+
+
+def get_ticket_file_id(ticket_id: str) -> str | None:
+    """file_id уже отправленного фото билета (для повторной отправки без загрузки)."""
+    return file_id_cache.get(ticket_id)
+
+
+def remember_ticket_file_id(ticket_id: str, file_id: str) -> None:
+    """Запоминает file_id отправленного фото билета."""
+    file_id_cache[ticket_id] = file_id
+    file_id_cache.move_to_end(ticket_id)
+    if len(file_id_cache) > TICKET_CACHE_SIZE:
+        file_id_cache.popitem(last=False)
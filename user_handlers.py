@@ -1,6 +1,7 @@
 # user_handlers.py
 
 import os
+import time
 import uuid
 import logging
 import re
@@ -11,34 +12,58 @@ from io import BytesIO
 from datetime import datetime
 
 # Абсолютные импорты
-from db_utils import get_all_products, get_product, find_promo, insert_ticket, activate_ticket
-from utils import cancel_global, escape_html
+from db_utils import (
+    find_promo, get_product, insert_ticket, new_ticket_id, reserve_product, extend_reservation, release_reservation,
+    create_pending_payment, expire_stale_payments, get_promo_remaining, redeem_promo,
+    release_promo_redemptions
+)
+from utils import cancel_global, escape_html, send_bulk_messages, run_throttled
+from qr_render import render_compact_qr_png
+from ticket_render import render_ticket, get_ticket_file_id, remember_ticket_file_id
+from catalog_cache import get_catalog_view, update_cached_stock
+from rate_limit import consume
+from promo_index import check_promo, maybe_reconcile_promo_uses
+from metrics import increment
+from admin_roles import next_cashier
 
 # Определяем состояния для ConversationHandler
 SELECTING_PRODUCT, ENTERING_NAME, ENTERING_EMAIL, CONFIRMING_PAYMENT, FINAL_STATE, WAITING_PROMO_OR_SKIP = range(6)
 
 ADMIN_ID = int(os.getenv("ADMIN_ID")) if os.getenv("ADMIN_ID") else None
 
+# Сколько держится резерв места, пока покупатель оформляет заказ (брошенный диалог освобождает место сам)
+RESERVATION_TTL_SECONDS = int(os.getenv("RESERVATION_TTL_MINUTES", "15")) * 60
+# Сколько держится резерв после нажатия "Я оплатил", пока администратор проверяет оплату
+PAYMENT_RESERVATION_TTL_SECONDS = int(os.getenv("PAYMENT_RESERVATION_TTL_HOURS", "24")) * 3600
+
+# Через сколько неподтвержденный запрос оплаты истекает, и как часто запускается очистка
+PENDING_PAYMENT_TTL_SECONDS = int(os.getenv("PENDING_PAYMENT_TTL_HOURS", "24")) * 3600
+PENDING_SWEEP_INTERVAL_SECONDS = int(os.getenv("PENDING_SWEEP_INTERVAL_MINUTES", "10")) * 60
+
+# Время последней очистки устаревших запросов оплаты в этом процессе
+sweep_state = {'last_run': None}
+
+# Компактный 1-битный PNG вместо стандартного вывода qrcode (QR_COMPACT_OUTPUT=0 возвращает старый формат)
+QR_COMPACT_OUTPUT = os.getenv("QR_COMPACT_OUTPUT", "1") == "1"
+
 
 # --- Хелперы ---
 
 
 async def send_admin_notification(context: ContextTypes.DEFAULT_TYPE, payment_ref: str, chat_id: int, name: str,
-                                  email: str, product: dict, final_price: int) -> None:
+                                  email: str, product: dict, final_price: int,
+                                  reservation_id: int | None = None, promo_code: str | None = None,
+                                  promo_redeemed: bool = False) -> bool:
     """
     Отправляет уведомление администратору о необходимости подтвердить оплату,
-    сохраняя данные транзакции в bot_data.
+    сохраняя данные транзакции в таблице pending_payments.
+    Возвращает False, если запрос не удалось сохранить.
     """
 
-    # 1. Сохраняем все данные в bot_data для последующего извлечения
-    context.application.bot_data[payment_ref] = {
-        'chat_id': chat_id,
-        'name': name,
-        'email': email,
-        'product_id': product['id'],
-        'final_price': final_price,
-        'product_name': product['name']
-    }
+    # 1. Сохраняем все данные в БД: они переживают холодный старт и доступны любому инстансу
+    if not create_pending_payment(payment_ref, chat_id, name, email, product['id'], product['name'],
+                                  final_price, promo_code, reservation_id, promo_redeemed):
+        return False
 
     text = (
         f"🚨 **ТРЕБУЕТСЯ ПОДТВЕРЖДЕНИЕ ОПЛАТЫ**\n\n"
@@ -48,17 +73,21 @@ async def send_admin_notification(context: ContextTypes.DEFAULT_TYPE, payment_re
         f"**Email:** {email}\n"
         f"**ID чата:** `{chat_id}`"
     )
+    if promo_code:
+        text += f"\n**Промокод:** `{promo_code}`"
+        if not promo_redeemed:
+            text += "\n⚠️ К моменту оплаты промокод был исчерпан, выключен или истек — скидка применена сверх правил."
 
     keyboard = [
-        # Callback data: issue_<payment_ref> - для выдачи
-        [InlineKeyboardButton("✅ Выдать билет (Оплачено)", callback_data=f"issue_{payment_ref}")],
-        # Callback data: reject_<payment_ref> - для отклонения
-        [InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_{payment_ref}")]
+        # Callback data: issue_ticket_<payment_ref> - для выдачи
+        [InlineKeyboardButton("✅ Выдать билет (Оплачено)", callback_data=f"issue_ticket_{payment_ref}")],
+        # Callback data: reject_ticket_<payment_ref> - для отклонения
+        [InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_ticket_{payment_ref}")]
     ]
 
     try:
         await context.bot.send_message(
-            chat_id=ADMIN_ID,
+            chat_id=next_cashier(),
             text=text,
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode='Markdown'
@@ -66,10 +95,47 @@ async def send_admin_notification(context: ContextTypes.DEFAULT_TYPE, payment_re
     except Exception as e:
         logging.error(f"Ошибка при отправке уведомления администратору: {e}")
 
+    return True
+
+
+async def sweep_pending_payments(bot) -> int:
+    """Пакетно истекает устаревшие запросы оплаты и уведомляет покупателей одной рассылкой."""
+    expired = expire_stale_payments(PENDING_PAYMENT_TTL_SECONDS)
+    if not expired:
+        return 0
+
+    release_promo_redemptions([promo_code for _, _, promo_code in expired])
+
+    messages = [
+        (chat_id, f"⌛ Запрос на подтверждение оплаты {payment_ref} истек. "
+                  "Если вы оплатили билет, свяжитесь с поддержкой, указав референс.")
+        for payment_ref, chat_id, _ in expired
+    ]
+    delivered = await send_bulk_messages(bot, messages)
+    logging.info(f"Истекло запросов оплаты: {len(expired)}, уведомлено покупателей: {delivered}")
+    return len(expired)
+
+
+async def maybe_sweep_pending_payments(bot) -> None:
+    """Запускает очистку не чаще раза в PENDING_SWEEP_INTERVAL_SECONDS (в serverless нет фоновых задач)."""
+    now = time.monotonic()
+    if sweep_state['last_run'] is not None and now - sweep_state['last_run'] < PENDING_SWEEP_INTERVAL_SECONDS:
+        return
+
+    sweep_state['last_run'] = now
+    await sweep_pending_payments(bot)
+
 
 # Предполагается, что у вас есть библиотека qrcode и PIL (Pillow)
-def generate_qr_code(ticket_id: str) -> BytesIO:
+def generate_qr_code(ticket_id: str, compact: bool = QR_COMPACT_OUTPUT) -> BytesIO:
     """Генерирует QR-код с заданным ID (использует библиотеку qrcode)."""
+    if compact:
+        png_bytes = render_compact_qr_png(ticket_id)
+        if png_bytes:
+            bio = BytesIO(png_bytes)
+            bio.name = 'qr_code.png'
+            return bio
+
     try:
         import qrcode
         from PIL import Image
@@ -106,8 +172,23 @@ def generate_qr_code(ticket_id: str) -> BytesIO:
 
 
 # НОВАЯ ФУНКЦИЯ: Отправка билета покупателю
-async def send_ticket_success_message(bot, ticket_data: dict, qr_bytes: BytesIO) -> None:
-    """Отправляет покупателю QR-код и информацию о билете."""
+def ticket_photo(ticket_data: dict):
+    """
+    Фото билета для send_photo: file_id, если билет уже отправлялся, иначе оформленный билет
+    (ticket_render) или голый QR-код, если оформление недоступно.
+    """
+    file_id = get_ticket_file_id(ticket_data['ticket_id'])
+    if file_id:
+        return file_id
+    png = render_ticket(ticket_data) or generate_qr_code(ticket_data['ticket_id']).getvalue()
+    return InputFile(png, filename=f"ticket_{ticket_data['ticket_id']}.png")
+
+
+async def send_ticket_success_message(bot, ticket_data: dict, qr_bytes: BytesIO | None = None) -> None:
+    """
+    Отправляет покупателю билет и информацию о нем.
+    Без qr_bytes отправляется оформленный билет; его file_id запоминается для повторных отправок.
+    """
 
     purchase_date_str = ticket_data.get('purchase_date')
     if isinstance(purchase_date_str, datetime):
@@ -116,52 +197,77 @@ async def send_ticket_success_message(bot, ticket_data: dict, qr_bytes: BytesIO)
         purchase_date_str = 'Дата неизвестна'  # В случае ручной выдачи
 
     message_text = (
-        f"🥳 **Поздравляем!** Ваш билет на мероприятие активирован!\n\n"
+        f"🥳 **Поздравляем!** Ваш билет на мероприятие оформлен!\n\n"
         f"**Тариф:** {ticket_data['product_name']}\n"
         f"**ID Билета:** `{ticket_data['ticket_id']}`\n"
         f"**Дата покупки:** {purchase_date_str}\n\n"
         f"Пожалуйста, сохраните этот QR-код. Он потребуется для входа."
     )
 
-    await bot.send_photo(
+    if qr_bytes is not None:
+        photo = InputFile(qr_bytes, filename=f"ticket_{ticket_data['ticket_id']}.png")
+    else:
+        photo = ticket_photo(ticket_data)
+
+    message = await bot.send_photo(
         chat_id=ticket_data['buyer_chat_id'],
-        photo=InputFile(qr_bytes, filename=f"ticket_{ticket_data['ticket_id']}.png"),
+        photo=photo,
         caption=message_text,
         parse_mode='Markdown'
     )
+    if qr_bytes is None and message.photo:
+        remember_ticket_file_id(ticket_data['ticket_id'], message.photo[-1].file_id)
+
+
+async def deliver_issued_tickets(bot, tickets: list) -> int:
+    """
+    Рассылает покупателям уже сохраненные в БД билеты через run_throttled
+    (пакетное подтверждение оплат). tickets — словари с ticket_id, product_name, chat_id.
+    Возвращает количество доставленных билетов.
+    """
+    async def deliver_one(ticket: dict) -> bool:
+        ticket_data = {
+            'ticket_id': ticket['ticket_id'], 'product_name': ticket['product_name'],
+            'buyer_name': ticket.get('buyer_name'), 'buyer_chat_id': ticket['chat_id'],
+            'purchase_date': datetime.now()
+        }
+        await send_ticket_success_message(bot, ticket_data)
+        return True
+
+    results = await run_throttled([lambda t=ticket: deliver_one(t) for ticket in tickets])
+    return sum(1 for r in results if r is True)
 
 
 # Этот хелпер используется для ручной выдачи билета в админке
 async def issue_ticket_to_user(bot, chat_id: int, user_data: dict) -> bool:
     """
-    Генерирует ID, сохраняет в БД (активирует) и отправляет билет пользователю,
-    а также отправляет админу для контроля.
+    Генерирует ID, сохраняет в БД (неактивным) и отправляет билет пользователю,
+    а также отправляет админу для контроля. Активация происходит на входе при сканировании.
     """
-    ticket_id = str(uuid.uuid4()).upper().replace('-', '')[:12]
-
     product_name = user_data['product_name']
     buyer_name = user_data['buyer_name']
     buyer_email = user_data['buyer_email']
     final_price = user_data['final_price']
     buyer_chat_id = user_data.get('buyer_chat_id', chat_id)  # Предполагается, что chat_id в ручном режиме - это админ
 
-    # 1. Запись в БД (активным)
-    # При ручной выдаче сразу сохраняем с is_active=FALSE, а затем активируем,
-    # чтобы дата покупки совпадала с датой активации.
-    if not insert_ticket(ticket_id, product_name, buyer_name, buyer_email, buyer_chat_id, final_price):
-        logging.error(
-            f"КРИТИЧЕСКАЯ ОШИБКА при ручной выдаче билета {ticket_id}: insert_ticket() не удалось сохранить запись.")
-        await bot.send_message(chat_id,
-                               f"❌ Произошла ошибка при регистрации билета {ticket_id} в БД. Свяжитесь с поддержкой.")
+    # 1. Запись в БД (is_active=FALSE)
+    # Билет активируется только при проходе через вход (check_in_ticket),
+    # иначе повторный скан нельзя отличить от первого.
+    # При совпадении ID insert_ticket сохраняет билет под новым ID и возвращает его.
+    # product_id передает только ручная выдача: место в лимите занимается вместе с билетом
+    saved = insert_ticket(new_ticket_id(), product_name, buyer_name, buyer_email, buyer_chat_id, final_price,
+                          product_id=user_data.get('product_id'))
+    if not saved:
+        logging.error("КРИТИЧЕСКАЯ ОШИБКА при ручной выдаче билета: insert_ticket() не удалось сохранить запись.")
+        await bot.send_message(chat_id, "❌ Произошла ошибка при регистрации билета в БД. Свяжитесь с поддержкой.")
         return False
+    ticket_id = saved['ticket_id']
 
-    if not activate_ticket(ticket_id):
-        logging.error(f"КРИТИЧЕСКАЯ ОШИБКА при ручной выдаче билета {ticket_id}: не удалось активировать билет.")
-        # Продолжаем отправку, так как вставка прошла
-
-    # Генерация двух отдельных объектов BytesIO для разных целей
-    qr_code_file_admin = generate_qr_code(ticket_id)
-    qr_code_file_user = generate_qr_code(ticket_id)
+    # Билет рендерится один раз: покупателю уходит file_id фото, отправленного администратору
+    ticket_data = {
+        'ticket_id': ticket_id, 'product_name': product_name, 'buyer_name': buyer_name,
+        'buyer_chat_id': buyer_chat_id, 'purchase_date': datetime.now()
+    }
 
     try:
         # 1. Сообщение администратору (с QR-кодом для контроля)
@@ -174,21 +280,21 @@ async def issue_ticket_to_user(bot, chat_id: int, user_data: dict) -> bool:
             f"💰 **Цена:** {final_price} ₽\n\n"
             f"QR-код отправлен покупателю {buyer_chat_id}."
         )
+        if not saved['within_limit']:
+            caption_admin += "\n\n⚠️ Лимит тарифа исчерпан — билет выдан сверх лимита."
 
-        await bot.send_photo(
+        admin_message = await bot.send_photo(
             chat_id=chat_id,
-            photo=InputFile(qr_code_file_admin),
+            photo=ticket_photo(ticket_data),
             caption=caption_admin,
             parse_mode='Markdown',
             reply_markup=ReplyKeyboardRemove()  # Удаляем клавиатуру
         )
+        if admin_message.photo:
+            remember_ticket_file_id(ticket_id, admin_message.photo[-1].file_id)
 
         # 2. Сообщение покупателю
-        ticket_data = {
-            'ticket_id': ticket_id, 'product_name': product_name, 'buyer_chat_id': buyer_chat_id,
-            'purchase_date': datetime.now()
-        }
-        await send_ticket_success_message(bot, ticket_data, qr_code_file_user)
+        await send_ticket_success_message(bot, ticket_data)
 
         return True
 
@@ -197,26 +303,37 @@ async def issue_ticket_to_user(bot, chat_id: int, user_data: dict) -> bool:
         return False
 
 
+def release_user_reservation(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Снимает резерв места, если покупатель ушел из диалога или выбрал другой тариф."""
+    reservation_id = context.user_data.pop('reservation_id', None)
+    if reservation_id is None:
+        return
+
+    released = release_reservation(reservation_id)
+    if released:
+        update_cached_stock(*released)
+
+
+async def cancel_buy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Отмена покупки: освобождает резерв и завершает диалог."""
+    release_user_reservation(context)
+    return await cancel_global(update, context)
+
+
 # --- Начало Диалога ---
 
 async def start_buy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Показывает список доступных тарифов."""
-    products_list = get_all_products()
+    """Показывает список доступных тарифов (готовый текст и клавиатура берутся из кэша каталога)."""
+    # Повторный /buy или "Назад к выбору" освобождает ранее занятое место
+    release_user_reservation(context)
+    catalog = get_catalog_view()
 
-    if not products_list:
-        await update.message.reply_text("К сожалению, на данный момент нет доступных тарифов.")
+    if not catalog:
+        await update.effective_message.reply_text("К сожалению, на данный момент нет доступных тарифов.")
         return ConversationHandler.END
 
-    keyboard = []
-    text = "Выберите желаемый тариф:\n\n"
-
-    for p in products_list:
-        text += f"<b>{escape_html(p['name'])}</b> - {p['price']} ₽\n"
-        text += f"<i>{escape_html(p['description'])}</i>\n\n"
-        keyboard.append([InlineKeyboardButton(f"🎫 {p['name']} ({p['price']} ₽)", callback_data=p['name'])])
-
-    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data='pay_cancel')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    text = catalog['buy_text']
+    reply_markup = catalog['buy_markup']
 
     if update.message:
         await update.message.reply_html(text, reply_markup=reply_markup)
@@ -232,12 +349,29 @@ async def product_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     await query.answer()
 
     product_name = query.data
-    product = get_product(product_name)
+    catalog = get_catalog_view()
+    product = catalog['products_by_name'].get(product_name) if catalog else None
+    # Каталог нужен только для показа: цена к оплате читается из основной БД, потому что после смены цены
+    # кэш других инстансов и реплика могут отставать
+    if product:
+        product = get_product(product_name, allow_stale=False)
+        if product and not product['is_available']:
+            product = None
 
     if not product:
         await query.edit_message_text("❌ Извините, выбранный тариф недоступен. Начните заново с /buy.")
         return ConversationHandler.END
 
+    # Резервируем место на время оформления; тарифы без лимита резерв не создают
+    reservation = reserve_product(product['id'], query.from_user.id, RESERVATION_TTL_SECONDS)
+    if reservation is None:
+        update_cached_stock(product['id'], 0)
+        await query.edit_message_text("🚫 К сожалению, билеты этого тарифа закончились. Выберите другой тариф: /buy")
+        return ConversationHandler.END
+
+    update_cached_stock(product['id'], reservation['remaining'])
+    context.user_data['reservation_id'] = reservation['reservation_id']
+    context.user_data['product_id'] = product['id']
     context.user_data['product_name'] = product_name
     context.user_data['initial_price'] = product['price']
     context.user_data['final_price'] = product['price']
@@ -260,19 +394,41 @@ async def product_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 async def process_promo_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Проверяет введенный промокод."""
     promo_code = update.message.text.strip().upper()
-    promo_data = find_promo(promo_code)
+
+    # Отдельный лимит на попытки ввода промокода (защита от перебора)
+    if update.effective_user.id != ADMIN_ID and not consume(update.effective_user.id, 'promo'):
+        increment('throttled_updates', 'promo')
+        await update.message.reply_text("⏳ Слишком много попыток ввода промокода. Попробуйте позже или нажмите 'Пропустить'.")
+        return WAITING_PROMO_OR_SKIP
+
     product_name = context.user_data['product_name']
     initial_price = context.user_data['initial_price']
 
-    # В этой версии проверка на привязку промокода к продукту опущена для упрощения.
-    # Реализация: if promo_data and product_name in promo_data['affected_products']: ...
-
-    if promo_data and promo_data['is_active']:
+    # Проверка по индексу (code, product_id); промокод без привязок действует на все тарифы
+    promo_data, status = check_promo(promo_code, context.user_data['product_id'])
+    if status == 'unavailable':
+        # Индекс не загружен (ошибка БД) — проверяем напрямую
+        promo_data = find_promo(promo_code)
+        if not promo_data or not promo_data['is_active']:
+            status = 'not_found'
+        elif promo_data['affected_products'] and product_name not in promo_data['affected_products']:
+            status = 'wrong_product'
+        elif promo_data['expires_at'] is not None and promo_data['expires_at'] <= datetime.now():
+            status = 'expired'
+        else:
+            status = 'ok'
+
+    # Для промокодов с лимитом проверяем живой остаток (списание — при подтверждении оплаты)
+    if status == 'ok' and promo_data.get('max_uses') is not None and get_promo_remaining(promo_data['id']) == 0:
+        status = 'exhausted'
+
+    if status == 'ok':
         discount = promo_data['discount_percent']
         final_price = int(initial_price * (100 - discount) / 100)
 
         context.user_data['final_price'] = final_price
         context.user_data['promo_code'] = promo_code
+        context.user_data['promo_id'] = promo_data['id']
 
         text = (
             f"✅ Промокод **{promo_code}** применен!\n"
@@ -283,10 +439,15 @@ async def process_promo_input(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text(text, parse_mode='Markdown', reply_markup=ReplyKeyboardRemove())
         return ENTERING_NAME
     else:
-        text = (
-            "❌ Промокод недействителен или не найден.\n"
-            "Введите другой промокод или нажмите 'Пропустить'."
-        )
+        if status == 'wrong_product':
+            reason = f"❌ Промокод не действует для тарифа «{product_name}».\n"
+        elif status == 'expired':
+            reason = "⌛ Срок действия промокода истек.\n"
+        elif status == 'exhausted':
+            reason = "🚫 Лимит использований промокода исчерпан.\n"
+        else:
+            reason = "❌ Промокод недействителен или не найден.\n"
+        text = reason + "Введите другой промокод или нажмите 'Пропустить'."
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("➡️ Пропустить", callback_data='skip_promo')],
             [InlineKeyboardButton("⬅️ Назад к выбору", callback_data='back_to_select')]
@@ -374,7 +535,7 @@ async def payment_options(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await query.answer()
 
     if query.data == 'pay_cancel':
-        return await cancel_global(update, context)
+        return await cancel_buy(update, context)
 
     final_price = context.user_data['final_price']
 
@@ -401,30 +562,57 @@ async def paid_confirmed(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await query.answer()
 
     # Извлекаем все необходимые данные, сохраненные на предыдущих шагах
-    name = context.user_data.get('name')
-    email = context.user_data.get('email')
-    product = context.user_data.get('product')
+    name = context.user_data.get('buyer_name')
+    email = context.user_data.get('buyer_email')
+    product_id = context.user_data.get('product_id')
+    product = {'id': product_id, 'name': context.user_data.get('product_name')} if product_id else None
     final_price = context.user_data.get('final_price')
 
     if not all([name, email, product, final_price is not None]):
         await query.edit_message_text("❌ Ошибка: Недостаточно данных для оформления. Попробуйте снова.")
+        release_user_reservation(context)
         context.user_data.clear()
         return ConversationHandler.END
 
+    # Резерв держится, пока администратор проверяет оплату.
+    # Если он успел истечь, место занимается заново.
+    reservation_id = context.user_data.get('reservation_id')
+    if reservation_id is not None and not extend_reservation(reservation_id, PAYMENT_RESERVATION_TTL_SECONDS):
+        reservation = reserve_product(product_id, update.effective_user.id, PAYMENT_RESERVATION_TTL_SECONDS)
+        if reservation is None:
+            await query.edit_message_text("🚫 Время резерва истекло, и билеты этого тарифа закончились.")
+            context.user_data.clear()
+            return ConversationHandler.END
+        reservation_id = reservation['reservation_id']
+
+    # Списание использования промокода. Если лимит исчерпан, пока покупатель оплачивал,
+    # запрос все равно регистрируется — администратор увидит предупреждение.
+    promo_code = context.user_data.get('promo_code')
+    promo_redeemed = bool(promo_code) and redeem_promo(context.user_data['promo_id'])
+
     # Генерация уникального референса транзакции
     payment_ref = str(uuid.uuid4()).split('-')[0].upper()
 
-    # Отправка уведомления администратору (и сохранение данных в bot_data)
-    await send_admin_notification(
+    # Отправка уведомления администратору (и сохранение данных в pending_payments)
+    saved = await send_admin_notification(
         context,
         payment_ref,
         update.effective_user.id,  # chat_id покупателя
         name,
         email,
         product,
-        final_price
+        final_price,
+        reservation_id,
+        promo_code,
+        promo_redeemed
     )
 
+    if not saved:
+        if promo_redeemed:
+            release_promo_redemptions([promo_code])
+        await query.edit_message_text("❌ Не удалось зарегистрировать запрос. Попробуйте нажать 'Я оплатил' еще раз.")
+        return CONFIRMING_PAYMENT
+
     await query.edit_message_text(
         f"✅ Ваш запрос отправлен администратору. Референс: `{payment_ref}`.\n"
         "Мы уведомим вас, как только оплата будет подтверждена и билет выдан."
@@ -432,6 +620,9 @@ async def paid_confirmed(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     # Очистка контекста пользователя для завершения диалога
     context.user_data.clear()
+
+    await maybe_sweep_pending_payments(context.bot)
+    maybe_reconcile_promo_uses()
     return ConversationHandler.END
 
 
@@ -442,7 +633,7 @@ buy_conv_handler = ConversationHandler(
     states={
         SELECTING_PRODUCT: [
             CallbackQueryHandler(product_selected, pattern=r'^(?!pay_cancel$).+'),
-            CallbackQueryHandler(cancel_global, pattern='^pay_cancel$')
+            CallbackQueryHandler(cancel_buy, pattern='^pay_cancel$')
         ],
         WAITING_PROMO_OR_SKIP: [
             MessageHandler(filters.TEXT & ~filters.COMMAND, process_promo_input),
@@ -453,10 +644,12 @@ buy_conv_handler = ConversationHandler(
         CONFIRMING_PAYMENT: [
             CallbackQueryHandler(payment_options, pattern='^pay_start$'),
             CallbackQueryHandler(paid_confirmed, pattern='^paid_confirmed$'),
-            CallbackQueryHandler(cancel_global, pattern='^pay_cancel$')
+            CallbackQueryHandler(cancel_buy, pattern='^pay_cancel$')
         ]
     },
-    fallbacks=[CommandHandler("cancel", cancel_global), CallbackQueryHandler(cancel_global, pattern='^pay_cancel$')],
+    fallbacks=[CommandHandler("cancel", cancel_buy), CallbackQueryHandler(cancel_buy, pattern='^pay_cancel$')],
+    # Повторный /buy посреди диалога начинает его заново: start_buy освобождает занятое место
+    allow_reentry=True,
     per_message=False,
     name="buy_conv_handler"
 )
\ No newline at end of file
@@ -1,9 +1,13 @@
 # utils.py
 
 from telegram import Update
+from telegram.error import RetryAfter
 from telegram.ext import ContextTypes, ConversationHandler
+import os
 import io
 import html
+import asyncio
+import logging
 
 # Импорты для чтения QR-кода
 try:
@@ -15,6 +19,12 @@ except ImportError:
     decode = None
 
 
+# Сколько сообщений отправляется одновременно при массовых уведомлениях
+BULK_SEND_CONCURRENCY = int(os.getenv("BULK_SEND_CONCURRENCY", "10"))
+# Сколько отправок в секунду допускается при рассылке (общий лимит Bot API — около 30)
+BULK_SEND_RATE = float(os.getenv("BULK_SEND_RATE", "25"))
+
+
 def escape_html(text: str) -> str:
     """Экранирует символы <, > и & для безопасного использования в HTML-разметке."""
     # Используем встроенную функцию html.escape
@@ -41,6 +51,57 @@ def read_qr_code_from_image(image_bytes: bytes) -> str | None:
         return None
 
 
+async def run_throttled(jobs: list, rate: float = BULK_SEND_RATE, concurrency: int = BULK_SEND_CONCURRENCY) -> list:
+    """
+    Выполняет задания (async-функции без аргументов), ограничивая параллельность и частоту
+    запуска (не больше rate в секунду). На RetryAfter задание повторяется один раз после паузы.
+    Ошибка отдельного задания не прерывает остальные: его результат — False.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    interval = 1.0 / rate if rate > 0 else 0.0
+    pacing = {'next_at': 0.0}
+    loop = asyncio.get_running_loop()
+
+    async def run_one(index: int, job):
+        async with semaphore:
+            now = loop.time()
+            start_at = max(now, pacing['next_at'])
+            pacing['next_at'] = start_at + interval
+            if start_at > now:
+                await asyncio.sleep(start_at - now)
+
+            for attempt in range(2):
+                try:
+                    return await job()
+                except RetryAfter as e:
+                    delay = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                    logging.warning(f"Bot API просит паузу {delay} с (задание {index}, попытка {attempt + 1}).")
+                    await asyncio.sleep(delay)
+                except Exception as e:
+                    logging.warning(f"Задание рассылки {index} завершилось ошибкой: {e}")
+                    return False
+            return False
+
+    return await asyncio.gather(*(run_one(i, job) for i, job in enumerate(jobs)))
+
+
+async def send_bulk_messages(bot, messages: list, concurrency: int = BULK_SEND_CONCURRENCY) -> int:
+    """
+    Рассылает сообщения [(chat_id, text), ...] через run_throttled.
+    Ошибки отдельных получателей (например, заблокировавших бота) не прерывают рассылку.
+    Возвращает количество доставленных сообщений.
+    """
+    async def send_one(chat_id, text) -> bool:
+        await bot.send_message(chat_id=chat_id, text=text)
+        return True
+
+    results = await run_throttled(
+        [lambda c=chat_id, t=text: send_one(c, t) for chat_id, text in messages],
+        concurrency=concurrency
+    )
+    return sum(1 for r in results if r is True)
+
+
 async def cancel_global(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Общий откат для всех диалогов."""
 
@@ -0,0 +1,33 @@
+# versioned_cache.py
+#
+# Общая часть кэшей справочников (каталог, индекс промокодов, сотрудники). Кэш пересобирается,
+# когда в этом процессе выросла версия (данные изменены здесь же) или истек его срок жизни:
+# версия локальна для процесса, поэтому изменения из других инстансов доходят только по TTL.
+
+def new_cache_state(**extra) -> dict:
+    """Состояние кэша: версия, значение, версия и время его сборки; extra — поля конкретного модуля."""
+    return {'version': 0, 'value': None, 'built_version': None, 'built_at': 0.0, **extra}
+
+
+def bump_version(state: dict) -> int:
+    """Инвалидирует кэш после изменения данных в этом процессе."""
+    state['version'] += 1
+    return state['version']
+
+
+def is_current_version(state: dict) -> bool:
+    """Собран ли кэш для текущей версии (False — данные только что изменены в этом процессе)."""
+    return state['built_version'] == state['version']
+
+
+def is_fresh(state: dict, ttl: float, now: float) -> bool:
+    """Можно ли отдать значение без обращения к БД."""
+    return state['value'] is not None and is_current_version(state) and now - state['built_at'] < ttl
+
+
+def store(state: dict, value, now: float):
+    """Запоминает собранное значение для текущей версии и возвращает его."""
+    state['value'] = value
+    state['built_version'] = state['version']
+    state['built_at'] = now
+    return value